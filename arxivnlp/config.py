@@ -32,6 +32,7 @@ class Config(object):
 
     # PERFORMANCE
     max_open_zip_files: Optional[int] = None
+    max_zip_cache_memory_mb: Optional[int] = None
     number_of_processes: Optional[int] = None
 
     @classmethod
@@ -47,7 +48,9 @@ class Config(object):
             config.cache_dir = to_path(parser['DATA'].get('CacheDir'))
             config.results_dir = to_path(parser['DATA'].get('ResultsDir'))
         if 'PERFORMANCE' in parser:
-            config.max_open_zip_files = to_int(parser['PERFORMANCE'].get('ZipFileCacheSize'))
+            config.max_open_zip_files = to_int(parser['PERFORMANCE'].get('ZipFileCacheSize',
+                                                                         parser['PERFORMANCE'].get('MaxOpenZipFiles')))
+            config.max_zip_cache_memory_mb = to_int(parser['PERFORMANCE'].get('ZipFileCacheMemoryMB'))
             config.number_of_processes = to_int(parser['PERFORMANCE'].get('NumberOfProcesses'))
         return config
 
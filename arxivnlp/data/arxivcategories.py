@@ -1,78 +1,325 @@
+import array
+import collections
+import datetime
+import itertools
 import json
 import logging
+import multiprocessing
+import zipfile
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, List, IO
+from typing import Dict, List, IO, Mapping, Iterator, Optional, Tuple, Union
 
 from . import utils
-from .cached import CachedData
-from ..config import Config
+from .arxmlivdocs import ArXMLivDocs
+from .bitset import Bitset
+from .cached import MappedCachedData
+from .exceptions import MissingDataException
+from .mapped import StringTable, StringList, CsrMap
+from ..config import Config, MissingConfigException
 
 
 class ArxivCategories(object):
+    """
+        The arxiv categories of documents.
+
+        The data is memory-mapped (i.e. it is shared between processes) and consists of the following sections:
+          * 'ids': the sorted, normalized arxiv ids (see ArXMLivDocs.normalize_arxiv_id) - the position of an id
+                   is its document number
+          * 'categories': the sorted category names - the position of a category is its category number
+          * 'doc_cats': document number -> category numbers (the primary category comes first)
+          * 'cat_docs': category number -> document numbers (ascending)
+        Sets of documents can be obtained as bitsets of document numbers (see `docs_in`), which supports queries
+        like `categories.ids_of(categories.docs_in('math.NT') - categories.docs_in('math.AG'))`.
+
+        The data is created by `update` (from the arxiv metadata). For backwards compatibility, it can also be
+        loaded from a categories.txt file in the directory for other data.
+    """
     def __init__(self, config: Config):
         self.config = config
-        self._doc_to_cats: CachedData[Dict[str, List[str]]] = CachedData(self.config, 'doc_to_cats', 'arxiv_categories',
-                                                                         'arxiv document-to-category data')
-        self._cat_to_docs: CachedData[Dict[str, List[str]]] = CachedData(self.config, 'cat_to_docs', 'arxiv_categories',
-                                                                         'arxiv category-to-document data')
+        self._index = MappedCachedData(self.config, 'categories', 'arxiv_categories', 'arxiv category data',
+                                       version=1, inputs=self._get_inputs)
 
-    @property
-    def doc_to_cats(self) -> Dict[str, List[str]]:
-        if not self._doc_to_cats.ensured():
+    def _get_inputs(self) -> List[Path]:
+        return [self.config.other_data_dir / 'categories.txt'] if self.config.other_data_dir is not None else []
+
+    def _get_index(self) -> Dict:
+        if not self._index.ensured():
             self._load_from_original()
-        assert self._doc_to_cats.data
-        return self._doc_to_cats.data
+        assert self._index.data is not None
+        return self._index.data
 
     @property
-    def cat_to_docs(self) -> Dict[str, List[str]]:
-        if not self._cat_to_docs.ensured():
-            self._load_from_original()
-        assert self._cat_to_docs.data
-        return self._cat_to_docs.data
+    def doc_to_cats(self) -> Mapping[str, List[str]]:
+        return _DocToCats(self)
+
+    @property
+    def cat_to_docs(self) -> Mapping[str, List[str]]:
+        return _CatToDocs(self)
+
+    def number_of_docs(self) -> int:
+        return len(self._get_index()['ids'])
+
+    def get_doc_number(self, arxiv_id: str) -> Optional[int]:
+        return self._get_index()['ids'].index_of(ArXMLivDocs.normalize_arxiv_id(arxiv_id))
+
+    def get_category_number(self, category: str) -> Optional[int]:
+        return self._get_index()['categories'].index_of(category)
+
+    def get_categories(self, arxiv_id: str) -> List[str]:
+        number = self.get_doc_number(arxiv_id)
+        if number is None:
+            raise KeyError(arxiv_id)
+        categories = self._get_index()['categories']
+        return [categories[i] for i in self._get_index()['doc_cats'][number]]
+
+    def get_docs(self, category: str) -> List[str]:
+        """ Returns the (normalized) ids of the documents in the category """
+        number = self.get_category_number(category)
+        if number is None:
+            raise KeyError(category)
+        ids = self._get_index()['ids']
+        return [ids[i] for i in self._get_index()['cat_docs'][number]]
+
+    def docs_in(self, category: str) -> Bitset:
+        """ Returns the set of document numbers in the category """
+        number = self.get_category_number(category)
+        if number is None:
+            raise KeyError(category)
+        return Bitset.from_indices(self.number_of_docs(), self._get_index()['cat_docs'][number])
+
+    def docs_in_any(self, categories: List[str]) -> Bitset:
+        result = Bitset(self.number_of_docs())
+        for category in categories:
+            result |= self.docs_in(category)
+        return result
+
+    def ids_of(self, docs: Bitset) -> List[str]:
+        """ Returns the (normalized) arxiv ids of a set of document numbers """
+        ids = self._get_index()['ids']
+        return [ids[i] for i in docs]
+
+    def get_cache_filepath(self) -> Path:
+        return self._index.get_filepath()
 
     def _load_from_original(self):
         logger = logging.getLogger(__name__)
-        path = utils.require_other_data(self.config, Path('categories.txt'))
+        try:
+            path = utils.require_other_data(self.config, Path('categories.txt'))
+        except (MissingConfigException, MissingDataException) as e:
+            raise MissingDataException(f'No arxiv category data found - run "update-arxiv-metadata" first ({e})')
         logger.info(f'Loading arxiv categories from {path}')
-        count = 0
-        self._doc_to_cats.data = {}
-        self._cat_to_docs.data = {}
+        doc_to_cats: Dict[str, List[str]] = {}
         with open(path) as fp:
             for line in fp:
-                count += 1
                 docid, cats = line.split(':')
-                for cat in cats.strip().split(', '):
-                    self._doc_to_cats.data.setdefault(docid, []).append(cat)
-                    self._cat_to_docs.data.setdefault(cat, []).append(docid)
+                doc_to_cats[ArXMLivDocs.normalize_arxiv_id(docid)] = cats.strip().split(', ')
 
-        self._doc_to_cats.write_to_cache()
-        self._cat_to_docs.write_to_cache()
+        ids = StringTable.from_strings(doc_to_cats)
+        categories = StringTable.from_strings(cat for cats in doc_to_cats.values() for cat in cats)
+        cat_numbers = {category: i for i, category in enumerate(categories)}
+        doc_cats = CsrMap.from_lists(([cat_numbers[cat] for cat in doc_to_cats[docid]] for docid in ids), 'H')
+        self.set_index(ids, categories, doc_cats)
 
+    def set_index(self, ids: StringTable, categories: StringTable, doc_cats: CsrMap):
+        """ Replaces the category data (and caches it) """
+        logger = logging.getLogger(__name__)
+        cat_docs: List[List[int]] = [[] for _ in categories]
+        for doc_number in range(len(doc_cats)):
+            for cat_number in doc_cats[doc_number]:
+                cat_docs[cat_number].append(doc_number)
+        logger.info(f'Found {len(categories)} categories for {len(ids)} documents')
+        self._index.snapshot_inputs()
+        self._index.data = {
+            'ids': ids,
+            'categories': categories,
+            'doc_cats': doc_cats,
+            'cat_docs': CsrMap.from_lists(cat_docs, 'i'),
+        }
+        self._index.write_to_cache()
 
-def update(metadatafile: Path, config: Config):
-    logger = logging.getLogger(__name__)
 
-    def actual(fp: IO):
-        data: Dict[str, List[str]] = {}
-        logger.info(f'Loading arxiv category data - this may take a moment')
-        for line in fp:
-            if not line:
-                continue
-            content = json.loads(line)
-            data[content['id']] = content['categories'].split()
-        logger.info(f'Found category data on {len(data)} documents')
-        if config.other_data_dir is None:
-            raise Exception('Directory for other data is not specified in config')
-        with open(config.other_data_dir / 'categories.txt', 'w') as fp:
-            for doc in sorted(data):
-                fp.write(f'{doc}: ' + ', '.join(data[doc]) + '\n')
+class _DocToCats(Mapping[str, List[str]]):
+    """ arxiv id -> categories (compatible with the dictionary that was used before) """
+    def __init__(self, categories: ArxivCategories):
+        self.categories = categories
+
+    def __getitem__(self, arxiv_id: str) -> List[str]:
+        return self.categories.get_categories(arxiv_id)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.categories._get_index()['ids'])
+
+    def __len__(self) -> int:
+        return self.categories.number_of_docs()
+
+
+class _CatToDocs(Mapping[str, List[str]]):
+    """ category -> (normalized) arxiv ids (compatible with the dictionary that was used before) """
+    def __init__(self, categories: ArxivCategories):
+        self.categories = categories
+
+    def __getitem__(self, category: str) -> List[str]:
+        return self.categories.get_docs(category)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.categories._get_index()['categories'])
+
+    def __len__(self) -> int:
+        return len(self.categories._get_index()['categories'])
 
+
+class ArxivMetadata(object):
+    """
+        Further metadata on arxiv documents (created by `update`).
+        The columns are aligned with the document numbers of ArxivCategories:
+          * 'versions': the number of versions
+          * 'update_date': the ordinal of the date of the last update (see datetime.date.toordinal, 0 if unknown)
+          * 'title_length': the number of characters in the title
+    """
+    columns: List[str] = ['versions', 'update_date', 'title_length']
+
+    def __init__(self, config: Config, arxiv_categories: ArxivCategories):
+        self.config = config
+        self.arxiv_categories = arxiv_categories
+        self._columns = MappedCachedData(self.config, 'metadata', 'arxiv_categories', 'arxiv metadata', version=1,
+                                         inputs=self._get_inputs)
+
+    def _get_inputs(self) -> List[Path]:
+        # the columns are aligned with the category data
+        return [self.arxiv_categories.get_cache_filepath()] if self.config.cache_dir is not None else []
+
+    def get_column(self, name: str) -> Union[array.array, memoryview]:
+        """ Returns a column (indexed by document number) """
+        if not self._columns.ensured():
+            raise MissingDataException('No (up-to-date) arxiv metadata found - run "update-arxiv-metadata" first')
+        assert self._columns.data is not None
+        return self._columns.data[name]   # type: ignore
+
+    def _get_value(self, name: str, arxiv_id: str) -> int:
+        number = self.arxiv_categories.get_doc_number(arxiv_id)
+        if number is None:
+            raise KeyError(arxiv_id)
+        return self.get_column(name)[number]
+
+    def get_versions(self, arxiv_id: str) -> int:
+        return self._get_value('versions', arxiv_id)
+
+    def get_update_date(self, arxiv_id: str) -> Optional[datetime.date]:
+        ordinal = self._get_value('update_date', arxiv_id)
+        return datetime.date.fromordinal(ordinal) if ordinal else None
+
+    def get_title_length(self, arxiv_id: str) -> int:
+        return self._get_value('title_length', arxiv_id)
+
+    def set_columns(self, columns: Dict[str, array.array]):
+        assert set(columns) == set(ArxivMetadata.columns)
+        self._columns.snapshot_inputs()
+        self._columns.data = dict(columns)
+        self._columns.write_to_cache()
+
+
+# ids, categories (space-separated), versions, update dates, title lengths
+_ParsedChunk = Tuple[List[str], List[str], array.array, array.array, array.array]
+
+
+def _parse_chunk(lines: List[bytes]) -> _ParsedChunk:
+    ids: List[str] = []
+    categories: List[str] = []
+    versions = array.array('H')
+    update_dates = array.array('i')
+    title_lengths = array.array('i')
+    for line in lines:
+        if not line.strip():
+            continue
+        content = json.loads(line)
+        ids.append(ArXMLivDocs.normalize_arxiv_id(content['id']))
+        categories.append(content['categories'])
+        versions.append(min(len(content.get('versions') or []), 0xFFFF))
+        update_date = content.get('update_date')
+        update_dates.append(datetime.date.fromisoformat(update_date).toordinal() if update_date else 0)
+        title_lengths.append(len(' '.join((content.get('title') or '').split())))   # titles contain line breaks
+    return ids, categories, versions, update_dates, title_lengths
+
+
+class _MetadataCollector(object):
+    """ Collects the parsed chunks in a columnar format """
+    def __init__(self):
+        self.ids: List[str] = []
+        self.cat_numbers: Dict[str, int] = {}   # in the order in which categories were encountered
+        self.cat_indptr = array.array('q', [0])
+        self.cat_indices = array.array('H')
+        self.columns: Dict[str, array.array] = {'versions': array.array('H'), 'update_date': array.array('i'),
+                                                'title_length': array.array('i')}
+
+    def add(self, chunk: _ParsedChunk):
+        ids, categories, versions, update_dates, title_lengths = chunk
+        self.ids.extend(ids)
+        for cats in categories:
+            for cat in cats.split():
+                self.cat_indices.append(self.cat_numbers.setdefault(cat, len(self.cat_numbers)))
+            self.cat_indptr.append(len(self.cat_indices))
+        self.columns['versions'].extend(versions)
+        self.columns['update_date'].extend(update_dates)
+        self.columns['title_length'].extend(title_lengths)
+
+    def store(self, arxiv_categories: ArxivCategories, arxiv_metadata: ArxivMetadata):
+        ids = self.ids
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        # keep the last entry for duplicate ids
+        order = [i for j, i in enumerate(order) if j + 1 == len(order) or ids[order[j + 1]] != ids[i]]
+        id_list = StringList.from_strings(ids[i] for i in order)
+        categories = StringTable.from_strings(self.cat_numbers)
+        renumber = array.array('H', bytes(2 * len(categories)))
+        for cat, number in self.cat_numbers.items():
+            renumber[number] = categories.index_of(cat)   # type: ignore
+        indptr, indices = self.cat_indptr, self.cat_indices
+        doc_cats = CsrMap.from_lists(([renumber[c] for c in indices[indptr[i]:indptr[i + 1]]] for i in order), 'H')
+        arxiv_categories.set_index(StringTable(id_list.offsets, id_list.blob), categories, doc_cats)
+        arxiv_metadata.set_columns({name: array.array(column.typecode, (column[i] for i in order))
+                                    for name, column in self.columns.items()})
+
+
+@contextmanager
+def _open_metadata(metadatafile: Path) -> Iterator[IO[bytes]]:
     if metadatafile.name.endswith('.zip'):
-        import zipfile
         with zipfile.ZipFile(metadatafile) as file:
             assert len(file.namelist()) == 1
             with file.open(file.namelist()[0]) as fp:
-                actual(fp)
+                yield fp
     else:
-        with open(metadatafile) as mfp:
-            actual(mfp)
+        with open(metadatafile, 'rb') as fp:
+            yield fp
+
+
+def _read_chunks(fp: IO[bytes], chunk_size: int) -> Iterator[List[bytes]]:
+    while True:
+        chunk = list(itertools.islice(fp, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def update(metadatafile: Path, config: Config, chunk_size: int = 20000):
+    """
+        Creates the category data and further metadata from the arxiv metadata file (JSON lines, possibly zipped).
+        The file is streamed and the lines are parsed in parallel chunks.
+    """
+    logger = logging.getLogger(__name__)
+    if config.cache_dir is None:
+        raise MissingConfigException('No cache directory was specified in the configuration')
+    processes = config.number_of_processes if config.number_of_processes else 1
+    collector = _MetadataCollector()
+    logger.info(f'Loading arxiv metadata from {metadatafile} - this may take a moment')
+    with _open_metadata(metadatafile) as fp, multiprocessing.Pool(processes) as pool:
+        # only a few chunks are in flight at any time (Pool.imap would read the whole file in advance)
+        pending: collections.deque = collections.deque()
+        for chunk in _read_chunks(fp, chunk_size):
+            pending.append(pool.apply_async(_parse_chunk, (chunk,)))
+            if len(pending) >= 2 * processes:
+                collector.add(pending.popleft().get())
+        while pending:
+            collector.add(pending.popleft().get())
+    logger.info(f'Found metadata on {len(collector.ids)} documents')
+    arxiv_categories = ArxivCategories(config)
+    collector.store(arxiv_categories, ArxivMetadata(config, arxiv_categories))
@@ -1,13 +1,15 @@
+import array
 import io
 import itertools
 import logging
 import re
-import zipfile
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
 from pathlib import Path
-from typing import IO, List, Set, Optional, Iterator, Dict
+from typing import IO, List, Optional, Iterator, Dict, Union, Sequence, Iterable
 
-from .cached import ZipFileCache, CachedData
+from .cached import ZipFileCache, MappedCachedData
+from .docindex import DocIndex, DocLocation
+from .zipreader import MappedZipFile, StaleLocation
 from .exceptions import BadArxivId, MissingDataException
 from ..config import Config
 
@@ -19,18 +21,97 @@ class ArXMLivDocs(object):
         if self.zipfile_cache is None:
             logger = logging.getLogger()
             logger.warning('No ZipFileCache was provided - this might significantly slow down the opening of files')
-        self.list_of_arxiv_ids: CachedData[List[str]] = \
-            CachedData(self.config, 'arxiv-ids', data_descr='list of arxiv ids')
-        self.arxivid_by_severity: CachedData[Dict[str, Set[str]]] = \
-            CachedData(self.config, 'arxivid-by-severity', data_descr='latexml errors for arXMLiv documents')
+        self.doc_index = DocIndex(self.config, self.zipfile_cache)
+        # one byte per document (aligned with the ids of the document index)
+        self.severities = MappedCachedData(self.config, 'arxmliv-severities',
+                                           data_descr='latexml errors for arXMLiv documents', version=1,
+                                           inputs=self._get_severity_inputs)
+
+    severity_levels: List[str] = ['no-problem', 'warning', 'error']   # the severity codes are the positions
+    NO_SEVERITY: int = 255
 
     arxiv_id_regex = re.compile(r'[^0-9]*(?P<yymm>[0-9]{4}).*')
 
-    @contextmanager
-    def open(self, arxiv_id: str, read_as_text: bool = True) -> Iterator[IO]:
+    @staticmethod
+    def normalize_arxiv_id(arxiv_id: str) -> str:
         if arxiv_id.endswith('.html'):
             arxiv_id = arxiv_id[:-5]
-        arxiv_id = arxiv_id.replace('/', '')  # e.g. 'cond-mat/9807111' -> 'cond-mat9807111'
+        return arxiv_id.replace('/', '')  # e.g. 'cond-mat/9807111' -> 'cond-mat9807111'
+
+    @contextmanager
+    def open(self, arxiv_id: str, read_as_text: bool = True) -> Iterator[IO]:
+        arxiv_id = ArXMLivDocs.normalize_arxiv_id(arxiv_id)
+        file: Optional[IO] = None
+        location = self.doc_index.get(arxiv_id) if self.doc_index.ensured() else None
+        if location is not None:
+            try:
+                file = self._open_location(location, read_as_text)
+            except (StaleLocation, FileNotFoundError) as e:
+                logger = logging.getLogger(__name__)
+                logger.warning(f'The document index is outdated ({e}) - consider updating it')
+        if file is None:
+            file = self._search_and_open(arxiv_id, read_as_text)
+        try:
+            yield file
+        finally:
+            file.close()
+
+    def read_bytes(self, arxiv_id: str) -> Union[bytes, memoryview]:
+        """
+            Returns the raw content of the html file.
+            This avoids file objects altogether and, for stored zip members, does not even copy the data.
+        """
+        arxiv_id = ArXMLivDocs.normalize_arxiv_id(arxiv_id)
+        location = self.doc_index.get(arxiv_id) if self.doc_index.ensured() else None
+        if location is not None and location.in_zip:
+            assert self.config.arxmliv_dir is not None
+            try:
+                with self._mapped_zip(self.config.arxmliv_dir / location.container) as archive:
+                    return archive.read_at(location.member, location.header_offset, location.compress_type,
+                                           location.compress_size, location.file_size)
+            except (StaleLocation, FileNotFoundError) as e:
+                logger = logging.getLogger(__name__)
+                logger.warning(f'The document index is outdated ({e}) - consider updating it')
+        with self.open(arxiv_id, read_as_text=False) as fp:
+            return fp.read()
+
+    def iter_chunks(self, arxiv_id: str, chunk_size: int = 2**18) -> Iterator[Union[bytes, memoryview]]:
+        """
+            Yields the raw content of the html file in chunks.
+            Deflated zip members are inflated incrementally, i.e. consumers that stop early (e.g. after finding a
+            substring) do not pay for inflating the rest of the document.
+        """
+        arxiv_id = ArXMLivDocs.normalize_arxiv_id(arxiv_id)
+        location = self.doc_index.get(arxiv_id) if self.doc_index.ensured() else None
+        if location is not None and location.in_zip:
+            assert self.config.arxmliv_dir is not None
+            with ExitStack() as stack:   # the archive is pinned until the chunks have been consumed
+                try:
+                    archive = stack.enter_context(self._mapped_zip(self.config.arxmliv_dir / location.container))
+                    chunks = archive.iter_chunks_at(location.member, location.header_offset, location.compress_type,
+                                                    location.compress_size, location.file_size, chunk_size)
+                except (StaleLocation, FileNotFoundError) as e:
+                    logger = logging.getLogger(__name__)
+                    logger.warning(f'The document index is outdated ({e}) - consider updating it')
+                else:
+                    yield from chunks
+                    return
+        yield self.read_bytes(arxiv_id)
+
+    def get_batches(self, arxiv_ids: Iterable[str], batch_size: int) -> List[List[str]]:
+        """
+            Splits the (normalized) ids into batches of at most `batch_size` documents from the same container,
+            ordered by their position in the container (see DocIndex.group_by_container).
+        """
+        arxiv_ids = [ArXMLivDocs.normalize_arxiv_id(arxiv_id) for arxiv_id in arxiv_ids]
+        self.doc_index.ensure_up_to_date()
+        batches: List[List[str]] = []
+        for _, group in self.doc_index.group_by_container(arxiv_ids):
+            for i in range(0, len(group), batch_size):
+                batches.append(group[i:i + batch_size])
+        return batches
+
+    def _search_and_open(self, arxiv_id: str, read_as_text: bool) -> IO:
         match = ArXMLivDocs.arxiv_id_regex.match(arxiv_id)
         if not match:
             raise BadArxivId(f'Failed to infer yymm from arxiv id "{arxiv_id}"')
@@ -39,7 +120,6 @@ class ArXMLivDocs(object):
 
         # Go throught different directory structure options
         attempts: List[Path] = []
-        found: bool = False
         b = self.config.arxmliv_dir
         if b is None:
             raise MissingDataException(f'Path to arXMLiv not specified in config')
@@ -50,94 +130,125 @@ class ArXMLivDocs(object):
         for path in [b / filename, b / 'data' / filename, b / yymm / filename, b / 'data' / yymm / filename]:
             attempts.append(path)
             if path.is_file():
-                file = open(path, 'r' if read_as_text else 'rb')
-                try:
-                    found = True
-                    yield file
-                    return
-                finally:
-                    file.close()
+                return open(path, 'r' if read_as_text else 'rb')
 
         # option 2: it's in a zip file
         for path in [b / f'{yymm}.zip', b / 'data' / f'{yymm}.zip']:
             attempts.append(path)
             if path.is_file():
-                file_zip = self.zipfile_cache[path] if self.zipfile_cache is not None else zipfile.ZipFile(str(path))
-                name = Path(yymm) / filename
+                name = f'{yymm}/{filename}'
                 try:
-                    actual_file = file_zip.open(str(name), 'r')
+                    with self._mapped_zip(path) as archive:
+                        data = archive.read(name)
                 except KeyError as e:
                     missing = MissingDataException(f'Failed to find {name} in {path}: {e}')
                     missing.__suppress_context__ = True
                     raise missing
-                try:
-                    found = True
-                    result: IO
-                    if read_as_text:
-                        result = io.TextIOWrapper(actual_file, encoding='utf-8')
-                    else:
-                        result = actual_file
-                    yield result
-                    return
-                finally:
-                    actual_file.close()
+                return self._wrap_data(data, read_as_text)
+
+        raise MissingDataException(f'Failed to locate {arxiv_id} after looking in the following places:\n' +
+                                   '\n'.join(f' * {a}' for a in attempts))
 
-        if not found:
-            raise MissingDataException(f'Failed to locate {arxiv_id} after looking in the following places:\n' +
-                                       '\n'.join(f' * {a}' for a in attempts))
+    @contextmanager
+    def _mapped_zip(self, path: Path) -> Iterator[MappedZipFile]:
+        """ The archive is not closed by the cache (e.g. because another thread requests archives) in the block """
+        if self.zipfile_cache is None:
+            yield MappedZipFile(path)
+        else:
+            with self.zipfile_cache.mapped(path) as archive:
+                yield archive
+
+    @staticmethod
+    def _wrap_data(data: Union[bytes, memoryview], read_as_text: bool) -> IO:
+        # decoding everything at once is faster than going through io.TextIOWrapper
+        with memoryview(data) as view:
+            return io.StringIO(str(view, 'utf-8')) if read_as_text else io.BytesIO(view)
+
+    def _open_location(self, location: DocLocation, read_as_text: bool) -> IO:
+        assert self.config.arxmliv_dir is not None
+        path = self.config.arxmliv_dir / location.container
+        if not location.in_zip:
+            return open(path, 'r' if read_as_text else 'rb')
+        with self._mapped_zip(path) as archive:
+            data = archive.read_at(location.member, location.header_offset, location.compress_type,
+                                   location.compress_size, location.file_size)
+        return self._wrap_data(data, read_as_text)
 
     def arxiv_ids(self) -> List[str]:
-        if self.list_of_arxiv_ids.ensured():
-            assert self.list_of_arxiv_ids.data
-            return self.list_of_arxiv_ids.data
-        self.list_of_arxiv_ids.data = []
-        yymm_regex = re.compile(r'^[0-9][0-9][0-9][0-9](\.zip)?$')
-        processed_yymm: Set[str] = set()
+        return self.doc_index.arxiv_ids()
+
+    def update_index(self):
+        """ Updates the document index (only containers that changed since the last update are rescanned) """
+        self.doc_index.update()
+        self.severities.data = None   # has to be re-aligned with the new index
+
+    def _get_severity_inputs(self) -> List[Path]:
+        inputs: List[Path] = []
+        if self.config.arxmliv_dir is not None:
+            inputs.append(self.config.arxmliv_dir / 'meta' / 'grouped_by_severity.zip')
+        if self.config.cache_dir is not None:
+            inputs.append(self.doc_index.index.get_filepath())   # the array is aligned with the index
+        return inputs
+
+    def _get_severities(self) -> Union[array.array, memoryview]:
+        """ Returns the severity codes of all documents (indexed by document number) """
+        self.doc_index.ensure_up_to_date()
+        if self.severities.ensured():
+            return self.severities.data['severity']   # type: ignore
         if self.config.arxmliv_dir is None:
             raise MissingDataException(f'ArXMLiv directory not specified in config')
-        for path in itertools.chain(self.config.arxmliv_dir.iterdir(), (self.config.arxmliv_dir / 'data').iterdir()):
-            if not yymm_regex.match(path.name):
-                continue
-            yymm = path.name[:4]
-            if yymm in processed_yymm:
-                continue
-            processed_yymm.add(yymm)
-            if path.name.endswith('.zip'):
-                file_zip = self.zipfile_cache[path] if self.zipfile_cache is not None else zipfile.ZipFile(str(path))
-                for name in file_zip.namelist():
-                    if name.endswith('.html'):
-                        self.list_of_arxiv_ids.data.append(name.split('/')[-1][:-5])
-            elif path.is_dir():
-                for filename in path.iterdir():
-                    if filename.name.endswith('.html'):
-                        self.list_of_arxiv_ids.data.append(filename.name[:-5])
-        self.list_of_arxiv_ids.write_to_cache()
-        return self.list_of_arxiv_ids.data
+        path = self.config.arxmliv_dir / 'meta' / 'grouped_by_severity.zip'
+        if not path.is_file():
+            raise MissingDataException(f'No such file {path}')
+        self.severities.snapshot_inputs()
+        ids = self.doc_index.get_ids()
+        severity = array.array('B', bytes([ArXMLivDocs.NO_SEVERITY]) * len(ids))
+        with self._mapped_zip(path) as file_zip:
+            contents = [str(file_zip.read(f'{level}-tasks.txt'), 'utf-8') for level in ArXMLivDocs.severity_levels]
+        for code, content in enumerate(contents):
+            lines = [line[:-5] for line in map(str.strip, content.splitlines()) if line.endswith('.html')]
+            for number in self.doc_index.get_doc_numbers(lines):
+                if number >= 0:
+                    severity[number] = code
+        self.severities.data = {'severity': severity}
+        self.severities.write_to_cache()
+        return severity
 
     def arxiv_id_to_severity(self, arxivid: str) -> str:
-        def actual() -> str:
-            assert self.arxivid_by_severity.data
-            for k in self.arxivid_by_severity.data:
-                if arxivid in self.arxivid_by_severity.data[k]:
-                    return k
+        severity = self._get_severities()
+        number = self.doc_index.get_doc_number(ArXMLivDocs.normalize_arxiv_id(arxivid))
+        if number is None or severity[number] == ArXMLivDocs.NO_SEVERITY:
             raise Exception(f'No severity data for {arxivid}')
+        return ArXMLivDocs.severity_levels[severity[number]]
 
-        if self.arxivid_by_severity.ensured():
-            return actual()
-        if self.config.arxmliv_dir is None:
-            raise MissingDataException(f'ArXMLiv directory not specified in config')
-        self.arxivid_by_severity.data = {}
-        for level in ['no-problem', 'warning', 'error']:
-            path = self.config.arxmliv_dir / 'meta' / 'grouped_by_severity.zip'
-            if not path.is_file():
-                raise MissingDataException(f'No such file {path}')
-            file_zip = self.zipfile_cache[path] if self.zipfile_cache is not None else zipfile.ZipFile(str(path))
-            self.arxivid_by_severity.data[level] = set()
-            with io.TextIOWrapper(file_zip.open(f'{level}-tasks.txt'), encoding='utf-8') as fp:
-                for line in fp:
-                    line = line.strip()
-                    if line:
-                        assert line.endswith('.html')
-                        self.arxivid_by_severity.data[level].add(line[:-5])
-        self.arxivid_by_severity.write_to_cache()
-        return actual()
+    def get_severity_codes(self, arxiv_ids: Sequence[str]) -> bytes:
+        """
+            Returns the severity codes (positions in `severity_levels` or NO_SEVERITY) for many (normalized) ids.
+            The result has one byte per id.
+        """
+        severity = self._get_severities()
+        table = bytes(severity) + bytes([ArXMLivDocs.NO_SEVERITY])
+        return bytes(map(table.__getitem__, self.doc_index.get_doc_numbers(arxiv_ids, missing=len(severity))))
+
+    @staticmethod
+    def _severity_mask(codes: bytes, levels: Iterable[str]) -> bytes:
+        """ maps the codes of the specified levels to 1 and everything else to 0 """
+        selected = bytearray(256)
+        for level in levels:
+            selected[ArXMLivDocs.severity_levels.index(level)] = 1
+        return codes.translate(selected)
+
+    def filter_by_severity(self, arxiv_ids: Sequence[str], levels: Iterable[str]) -> List[str]:
+        """ Returns the ids (in the original order) whose severity is one of `levels` """
+        mask = ArXMLivDocs._severity_mask(self.get_severity_codes(arxiv_ids), levels)
+        return list(itertools.compress(arxiv_ids, mask))
+
+    def partition_by_severity(self, arxiv_ids: Sequence[str]) -> Dict[str, List[str]]:
+        """ Groups the ids by severity level (ids without severity data are grouped under 'unknown') """
+        codes = self.get_severity_codes(arxiv_ids)
+        result: Dict[str, List[str]] = {}
+        groups = list(enumerate(ArXMLivDocs.severity_levels)) + [(ArXMLivDocs.NO_SEVERITY, 'unknown')]
+        for code, level in groups:
+            mask = codes.translate(bytes(int(i == code) for i in range(256)))
+            result[level] = list(itertools.compress(arxiv_ids, mask))
+        return result
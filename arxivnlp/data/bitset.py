@@ -0,0 +1,82 @@
+"""
+    Sets of document numbers (or other small non-negative integers) represented as bitsets.
+    The bits are stored in a Python int, which makes set operations on millions of elements very fast.
+"""
+
+import re
+from typing import Iterable, Iterator
+
+_NON_ZERO_BYTE = re.compile(b'[^\x00]')
+_BITS_OF_BYTE = [[i for i in range(8) if byte & (1 << i)] for byte in range(256)]
+
+
+class Bitset(object):
+    def __init__(self, size: int, value: int = 0):
+        """ `size` is the size of the universe, i.e. the elements are 0, 1, ..., size-1 """
+        assert 0 <= value and value.bit_length() <= size
+        self.size = size
+        self.value = value
+
+    @classmethod
+    def from_indices(cls, size: int, indices: Iterable[int]) -> 'Bitset':
+        bits = bytearray((size + 7) // 8)
+        for i in indices:
+            if not 0 <= i < size:
+                raise IndexError(i)
+            bits[i >> 3] |= 1 << (i & 7)
+        return cls(size, int.from_bytes(bits, 'little'))
+
+    @classmethod
+    def full(cls, size: int) -> 'Bitset':
+        return cls(size, (1 << size) - 1)
+
+    def _check_compatible(self, other: 'Bitset'):
+        if not isinstance(other, Bitset):
+            raise TypeError(f'Expected Bitset, got {type(other)}')
+        if self.size != other.size:
+            raise ValueError(f'Bitsets have different sizes ({self.size} and {other.size})')
+
+    def __and__(self, other: 'Bitset') -> 'Bitset':
+        self._check_compatible(other)
+        return Bitset(self.size, self.value & other.value)
+
+    def __or__(self, other: 'Bitset') -> 'Bitset':
+        self._check_compatible(other)
+        return Bitset(self.size, self.value | other.value)
+
+    def __xor__(self, other: 'Bitset') -> 'Bitset':
+        self._check_compatible(other)
+        return Bitset(self.size, self.value ^ other.value)
+
+    def __sub__(self, other: 'Bitset') -> 'Bitset':
+        self._check_compatible(other)
+        return Bitset(self.size, self.value & ~other.value)
+
+    def __invert__(self) -> 'Bitset':
+        return Bitset(self.size, self.value ^ ((1 << self.size) - 1))
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Bitset) and self.size == other.size and self.value == other.value
+
+    def __hash__(self) -> int:
+        return hash((self.size, self.value))
+
+    def __len__(self) -> int:
+        return self.value.bit_count()
+
+    def __bool__(self) -> bool:
+        return self.value != 0
+
+    def __contains__(self, i: object) -> bool:
+        return isinstance(i, int) and 0 <= i < self.size and bool((self.value >> i) & 1)
+
+    def __iter__(self) -> Iterator[int]:
+        """ Yields the elements in ascending order """
+        bits = self.value.to_bytes((self.size + 7) // 8, 'little')
+        for match in _NON_ZERO_BYTE.finditer(bits):   # skipping empty bytes is done by the regex engine
+            offset = match.start() * 8
+            for i in _BITS_OF_BYTE[bits[match.start()]]:
+                yield offset + i
+
+    def __repr__(self) -> str:
+        return f'Bitset(size={self.size}, elements={len(self)})'
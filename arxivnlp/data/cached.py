@@ -1,50 +1,143 @@
+import contextlib
+import dataclasses
 import gzip
-import io
+import hashlib
+import json
 import logging
+import os
 import pickle
+import threading
+import weakref
 import zipfile
-from collections import deque
+from collections import OrderedDict
 from pathlib import Path
-from typing import TypeVar, Generic, Optional, Dict, Tuple, Deque, Set, IO, List
+from typing import TypeVar, Generic, Optional, Dict, Tuple, IO, List, Union, Callable, Any, Iterable, Set, Iterator
 
 from arxivnlp.config import Config
+from .mapped import Section, read_sections, write_sections
+from .zipreader import MappedZipFile, MemberInfo, BadZipFile, parse_central_directory, get_member_count
 
 T = TypeVar('T')
 
 
+# size and modification time of a file (None if it does not exist)
+InputSignature = Optional[Tuple[int, int]]
+
+
 class CachedData(Generic[T]):
-    def __init__(self, config: Config, name: str, dirname: Optional[str] = None, data_descr: str = 'data'):
+    """
+        Data that is stored in the cache directory (as gzip-compressed pickle).
+
+        Optionally, the data can declare the files it is computed from (`inputs`) and a code `version`.
+        Both are recorded in a separate file when the data is cached and the cached data is considered outdated
+        if the version or the size/modification time of an input changed.
+        `changed_inputs` can be used to update outdated data incrementally.
+    """
+    suffix: str = '.dmp.gz'
+
+    def __init__(self, config: Config, name: str, dirname: Optional[str] = None, data_descr: str = 'data',
+                 version: int = 0, inputs: Optional[Callable[[], Iterable[Path]]] = None):
         self.config = config
         self.name = name
         self.dirname = dirname
         self.data_descr = data_descr
+        self.version = version
+        self.inputs = inputs
 
         self.data: Optional[T] = None
+        self._inputs_snapshot: Optional[Dict[str, InputSignature]] = None
 
-    def _get_filepath(self) -> Path:
+    def get_filepath(self) -> Path:
         path = self.config.cache_dir
         assert path is not None
         if self.dirname is not None:
             path = path / self.dirname
-        return path / (self.name + '.dmp.gz')
+        return path / (self.name + self.suffix)
+
+    def _load(self, path: Path) -> T:
+        with gzip.open(path, 'rb') as fp:
+            return pickle.load(fp)  # type: ignore
+
+    def _dump(self, path: Path):
+        # write to a temporary file first - other processes might read the cache concurrently
+        # and crashes should not leave truncated files behind
+        tmp_path = path.parent / f'.{path.name}.{os.getpid()}.tmp'
+        try:
+            with gzip.open(tmp_path, 'wb', compresslevel=3) as fp:
+                pickle.dump(self.data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def _get_inputs_filepath(self) -> Path:
+        path = self.get_filepath()
+        return path.parent / (path.name + '.inputs.json')
+
+    @property
+    def tracks_inputs(self) -> bool:
+        return self.inputs is not None or self.version != 0
+
+    def _get_current_inputs(self) -> Dict[str, InputSignature]:
+        result: Dict[str, InputSignature] = {}
+        for path in (self.inputs() if self.inputs is not None else []):
+            try:
+                stat = path.stat()
+                result[str(path)] = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                result[str(path)] = None
+        return result
 
-    def ensured(self) -> bool:
+    def snapshot_inputs(self):
+        """ Records the current state of the inputs (call it before computing the data from them) """
+        self._inputs_snapshot = self._get_current_inputs()
+
+    def changed_inputs(self) -> Optional[Set[Path]]:
+        """
+            Returns the inputs that were added, removed or modified since the data was cached.
+            If everything has to be recomputed (e.g. because the version changed), None is returned.
+        """
+        if self.config.cache_dir is None:
+            return None
+        try:
+            with open(self._get_inputs_filepath()) as fp:
+                recorded = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+        if recorded['version'] != self.version:
+            return None
+        recorded_inputs = {path: tuple(signature) if signature is not None else None
+                           for path, signature in recorded['inputs'].items()}
+        current_inputs = self._get_current_inputs()
+        return {Path(path) for path in set(recorded_inputs) | set(current_inputs)
+                if recorded_inputs.get(path) != current_inputs.get(path)}
+
+    def is_up_to_date(self) -> bool:
+        """ Checks that the cached data is based on the current inputs and version """
+        if not self.tracks_inputs:
+            return True
+        return self.changed_inputs() == set()
+
+    def ensured(self, check_inputs: bool = True) -> bool:
         if self.data is None:
-            return self.try_load_from_cache()
+            return self.try_load_from_cache(check_inputs)
         return True
 
-    def try_load_from_cache(self) -> bool:
+    def try_load_from_cache(self, check_inputs: bool = True) -> bool:
+        """ Loads the cached data (unless it is outdated and `check_inputs` is set) """
         logger = logging.getLogger(__name__)
         logger.info(f'Attempting to load {self.data_descr} from cache')
         if self.config.cache_dir is None:
             logger.error(f'No cache directory is specified in the config')
             return False
-        path = self._get_filepath()
+        path = self.get_filepath()
         if path.is_file():
-            with gzip.open(path, 'rb') as fp:
-                self.data = pickle.load(fp)  # type: ignore
-                logger.info(f'Successfully loaded {self.data_descr} from {path}')
-                return True
+            if check_inputs and not self.is_up_to_date():
+                logger.info(f'Cached {self.data_descr} at {path} is outdated')
+                return False
+            self.data = self._load(path)
+            logger.info(f'Successfully loaded {self.data_descr} from {path}')
+            return True
         else:
             logger.info(f'Failed to load {self.data_descr} from cache ({path} does not exist)')
         return False
@@ -55,25 +148,116 @@ class CachedData(Generic[T]):
         if self.config.cache_dir is None:
             logger.error(f'Failed to cache {self.data_descr}: no cache directory is specified in the config')
             return
-        path = self._get_filepath()
+        path = self.get_filepath()
         logger.info(f'Attempting to cache {self.data_descr} at {path}')
         if not path.parent.exists():
             logger.info(f'Creating {path.parent}')
-            path.parent.mkdir(parents=True)
-        with gzip.open(path, 'wb', compresslevel=3) as fp:
-            pickle.dump(self.data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            path.parent.mkdir(parents=True, exist_ok=True)
+        if self.tracks_inputs:
+            # the record of the inputs is only valid for the old data
+            try:
+                self._get_inputs_filepath().unlink()
+            except FileNotFoundError:
+                pass
+        self._dump(path)
+        if self.tracks_inputs:
+            inputs = self._inputs_snapshot if self._inputs_snapshot is not None else self._get_current_inputs()
+            inputs_path = self._get_inputs_filepath()
+            tmp_path = inputs_path.parent / f'.{inputs_path.name}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as fp:
+                json.dump({'version': self.version, 'inputs': inputs}, fp)
+            os.replace(tmp_path, inputs_path)
+            self._inputs_snapshot = None
         logger.info(f'Successfully cached {self.data_descr} at {path}')
 
 
+class MappedCachedData(CachedData[Dict[str, Section]]):
+    """
+        Data consisting of large, regular sections (arrays, string tables, ...), which are stored uncompressed.
+        Loading the data only maps the file into memory, i.e. lookups are possible without reading everything
+        (see arxivnlp.data.mapped).
+    """
+    suffix: str = '.map'
+
+    def _load(self, path: Path) -> Dict[str, Section]:
+        return read_sections(path)
+
+    def _dump(self, path: Path):
+        assert self.data is not None
+        write_sections(path, self.data)
+
+
+class ZipDirectoryCache(object):
+    """
+        Caches the parsed central directories of zip files, so that they do not have to be parsed again
+        in other processes or later runs. Cached directories are only used if size and modification time of
+        the zip file did not change.
+    """
+    def __init__(self, config: Config):
+        self.config = config
+        self.enabled: bool = config.cache_dir is not None
+
+    def _get_cached_data(self, path: Path, kind: str) -> CachedData[Tuple[Tuple[int, int], Any]]:
+        path_hash = hashlib.md5(str(path.resolve()).encode('utf-8')).hexdigest()[:12]
+        return CachedData(self.config, f'{path.stem}-{path_hash}.{kind}', 'zip-directories',
+                          data_descr=f'central directory of {path}')
+
+    @staticmethod
+    def get_signature(path: Path) -> Tuple[int, int]:
+        stat = path.stat()
+        return stat.st_size, stat.st_mtime_ns
+
+    def load(self, path: Path, kind: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        cached = self._get_cached_data(path, kind)
+        try:
+            if not cached.ensured():
+                return None
+        except (EOFError, OSError, pickle.UnpicklingError) as e:
+            logger = logging.getLogger(__name__)
+            logger.warning(f'Failed to load cached central directory of {path}: {e}')
+            return None
+        assert cached.data is not None
+        signature, directory = cached.data
+        return directory if signature == self.get_signature(path) else None
+
+    def store(self, path: Path, kind: str, directory: Any, signature: Tuple[int, int]):
+        if not self.enabled:
+            return
+        cached = self._get_cached_data(path, kind)
+        cached.data = (signature, directory)
+        cached.write_to_cache()
+
+
+# rough estimates of the memory needed for an entry of a parsed central directory
+ZIPINFO_MEMORY: int = 500
+MEMBERINFO_MEMORY: int = 250
+
+
 class OpenedZipFile(zipfile.ZipFile):
-    expiry: int
     opened_files: List[IO]
 
-    def __init__(self, filename: str, expiry: int):
+    def __init__(self, filename: str, directory_cache: Optional[ZipDirectoryCache] = None):
+        self.directory_cache = directory_cache
         zipfile.ZipFile.__init__(self, filename)
-        self.expiry = expiry
         self.opened_files = []
 
+    def _RealGetContents(self):
+        # Called by zipfile.ZipFile.__init__ to parse the central directory - we try to use a cached one instead.
+        # Note that this overrides a private method of zipfile.ZipFile.
+        if self.directory_cache is None:
+            return super()._RealGetContents()
+        path = Path(self.filename)
+        infolist: Optional[List[zipfile.ZipInfo]] = self.directory_cache.load(path, 'infolist')
+        if infolist is not None:
+            self.filelist = infolist
+            self.NameToInfo = {info.filename: info for info in infolist}
+            return
+        signature = self.directory_cache.get_signature(path)
+        super()._RealGetContents()
+        self.directory_cache.store(path, 'infolist', self.filelist, signature)
+
     def open(self, *args, **kwargs) -> IO:
         file = super().open(*args, **kwargs)
         self.opened_files.append(file)
@@ -82,73 +266,214 @@ class OpenedZipFile(zipfile.ZipFile):
     def clean(self):
         self.opened_files = [file for file in self.opened_files if not file.closed]
 
+    def is_in_use(self) -> bool:
+        self.clean()
+        return bool(self.opened_files)
+
+    def estimated_memory(self) -> int:
+        return len(self.filelist) * ZIPINFO_MEMORY
+
+
+class OpenedMappedZipFile(MappedZipFile):
+    def __init__(self, filename: str, directory_cache: Optional[ZipDirectoryCache] = None):
+        MappedZipFile.__init__(self, filename)
+        # memoryviews do not prevent closing (see MappedZipFile.close), so readers pin the archive instead
+        self.pins: int = 0
+        self.directory_cache = directory_cache
+        self._member_count: Optional[int] = None
+
+    @property
+    def members(self) -> Dict[str, MemberInfo]:
+        if self._members is None and self.directory_cache is not None:
+            path = Path(self.filename)
+            self._members = self.directory_cache.load(path, 'members')
+            if self._members is None:
+                signature = self.directory_cache.get_signature(path)
+                self._members = parse_central_directory(self.mmap)
+                self.directory_cache.store(path, 'members', self._members, signature)
+        return super().members
+
+    def is_in_use(self) -> bool:
+        return self.pins > 0
+
+    def estimated_memory(self) -> int:
+        # the central directory is only parsed when needed, but it will be once the archive is used
+        if self._members is not None:
+            return len(self._members) * MEMBERINFO_MEMORY
+        if self._member_count is None:
+            try:
+                self._member_count = get_member_count(self.mmap)
+            except BadZipFile:
+                self._member_count = 0   # reported when the directory is parsed
+        return self._member_count * MEMBERINFO_MEMORY
+
+
+OpenedArchive = Union[OpenedZipFile, OpenedMappedZipFile]
+
+
+@dataclasses.dataclass
+class ZipArchiveStats(object):
+    hits: int = 0
+    misses: int = 0           # the archive had to be opened
+    evictions: int = 0        # the archive was closed to stay within the limits
+    pushed_because_open: int = 0   # the archive could not be closed because it was still in use (open files, pins)
+
+    @property
+    def requested(self) -> int:
+        return self.hits + self.misses
+
 
 class ZipFileCache(object):
+    """
+        Keeps recently used zip files open.
+        Archives are closed in least-recently-used order if there are too many of them or if the (estimated) memory
+        needed for their central directories exceeds the configured limit.
+    """
+
+    # all instances (e.g. for collecting statistics in pool workers)
+    instances: 'weakref.WeakSet[ZipFileCache]' = weakref.WeakSet()
+
     def __init__(self, config: Config):
-        # filename -> zipfile, expiry
-        self.zipfiles: Dict[str, OpenedZipFile] = {}
-        # (filename, expiry when entered (only delete if it hasn't been extended))
-        self.zipfiledeque: Deque[Tuple[str, int]] = deque()
-        # files currently open from zip file
-        self.currently_open: Dict[zipfile.ZipFile, Set[io.FileIO]] = {}
+        # key -> archive, in least-recently-used order
+        self.zipfiles: 'OrderedDict[str, OpenedArchive]' = OrderedDict()
+        # key -> estimated memory (as of the last access)
+        self.memory: Dict[str, int] = {}
+        self.total_memory: int = 0
 
         self.max_open: int = config.max_open_zip_files if config.max_open_zip_files else 50
+        self.max_memory: Optional[int] = \
+            config.max_zip_cache_memory_mb * 2**20 if config.max_zip_cache_memory_mb else None
+        self.directory_cache = ZipDirectoryCache(config)
+
+        # statistics (file name -> stats)
+        self.archive_stats: Dict[str, ZipArchiveStats] = {}
 
-        # statistics
-        self.stat_requested: int = 0
-        self.stat_successes: int = 0
-        self.stat_pushed_because_open: int = 0
+        # the process that opened the zip files (see _check_process)
+        self.pid: int = os.getpid()
+        # archives can be requested from several threads (e.g. by a Prefetcher)
+        self._lock = threading.RLock()
+        ZipFileCache.instances.add(self)
+
+    def _check_process(self):
+        """
+            A forked process inherits the open zip files, but the file offsets are shared with the parent process.
+            Therefore the zip files are reopened lazily in the child process.
+        """
+        if self.pid != os.getpid():
+            self.reset()
+
+    def reset(self):
+        """ Closes all zip files and resets the statistics """
+        for zf in self.zipfiles.values():
+            zf.close()
+        self.zipfiles = OrderedDict()
+        self.memory = {}
+        self.total_memory = 0
+        self.archive_stats = {}
+        self.pid = os.getpid()
+        self._lock = threading.RLock()   # the lock might have been held by another thread when forking
+
+    def get_archive_stats(self) -> Dict[str, ZipArchiveStats]:
+        return self.archive_stats
+
+    def get_stats(self) -> Dict[str, int]:
+        """ Statistics summed over all archives """
+        stats = {'requested': 0, 'hits': 0, 'misses': 0, 'evictions': 0, 'pushed_because_open': 0}
+        for archive_stats in self.archive_stats.values():
+            stats['requested'] += archive_stats.requested
+            for field in dataclasses.fields(archive_stats):
+                stats[field.name] += getattr(archive_stats, field.name)
+        return stats
+
+    def _update_memory(self, key: str):
+        memory = self.zipfiles[key].estimated_memory()
+        self.total_memory += memory - self.memory.get(key, 0)
+        self.memory[key] = memory
+
+    def _over_limit(self, extra_archives: int = 0) -> bool:
+        return len(self.zipfiles) - extra_archives > self.max_open or \
+               (self.max_memory is not None and self.total_memory > self.max_memory)
 
     def delete_old(self):
-        while len(self.zipfiles) > self.max_open:
-            name, expiry = self.zipfiledeque.popleft()
-            ozf = self.zipfiles[name]
-            ozf.clean()
-            if ozf.expiry == expiry:
-                if not ozf.opened_files:
-                    self.zipfiles[name].close()
-                    del self.zipfiles[name]
-                else:
-                    self.stat_pushed_because_open += 1
-                    self.push_back(ozf, name)
-
-    def push_back(self, ozf: OpenedZipFile, name: str):
-        if ozf.expiry < self.zipfiledeque[-1][1]:
-            ozf.expiry = self.zipfiledeque[-1][1] + 1
-            self.zipfiledeque.append((name, ozf.expiry))
-
-    def cleanup(self):
-        old = self.zipfiledeque
-        self.zipfiledeque = deque()
-        for e in old:
-            if self.zipfiles[e[0]].expiry == e[1]:
-                self.zipfiledeque.append(e)
+        """ Closes least-recently-used archives until the limits are satisfied (the newest one is always kept) """
+        if not self._over_limit():
+            return
+        to_delete: List[str] = []
+        newest = next(reversed(self.zipfiles))
+        for key in self.zipfiles:
+            if key == newest:
+                break
+            ozf = self.zipfiles[key]
+            if ozf.is_in_use():
+                self.archive_stats[ozf.filename].pushed_because_open += 1
+                continue
+            to_delete.append(key)
+            self.total_memory -= self.memory.pop(key)
+            if not self._over_limit(extra_archives=len(to_delete)):
+                break
+        for key in to_delete:
+            ozf = self.zipfiles.pop(key)
+            self.archive_stats[ozf.filename].evictions += 1
+            ozf.close()
 
-    def __getitem__(self, path: Path) -> zipfile.ZipFile:
-        self.stat_requested += 1
-        name = str(path.resolve())
-        if name not in self.zipfiles:
-            expiry = self.zipfiledeque[-1][1] + 1 if len(self.zipfiledeque) else 0
-            ozf = OpenedZipFile(name, expiry=expiry)
-            self.zipfiles[name] = ozf
-            self.zipfiledeque.append((name, expiry))
+    def _get(self, key: str, factory: Callable[[], OpenedArchive], pin: bool = False) -> OpenedArchive:
+        self._check_process()
+        with self._lock:
+            if key in self.zipfiles:
+                ozf = self.zipfiles[key]
+                self.zipfiles.move_to_end(key)
+                self.archive_stats[ozf.filename].hits += 1
+            else:
+                ozf = factory()
+                self.zipfiles[key] = ozf
+                self.archive_stats.setdefault(ozf.filename, ZipArchiveStats()).misses += 1
+            if pin:
+                assert isinstance(ozf, OpenedMappedZipFile)
+                ozf.pins += 1
+            self._update_memory(key)
             self.delete_old()
             return ozf
-        else:
-            self.stat_successes += 1
-            ozf = self.zipfiles[name]
-            self.push_back(ozf, name)
-            if len(self.zipfiledeque) > 20 * self.max_open:
-                self.cleanup()
-            return ozf
+
+    def __getitem__(self, path: Path) -> zipfile.ZipFile:
+        name = str(path.resolve())
+        ozf = self._get(name, lambda: OpenedZipFile(name, self.directory_cache))
+        assert isinstance(ozf, OpenedZipFile)
+        return ozf
+
+    def get_mapped(self, path: Path) -> MappedZipFile:
+        """
+            Like __getitem__, but returns a (faster) memory-mapped zip file.
+            The archive can be closed by the cache when other archives are requested (e.g. by other threads),
+            i.e. use `mapped` to read from it.
+        """
+        return self._get_mapped(path)
+
+    def _get_mapped(self, path: Path, pin: bool = False) -> OpenedMappedZipFile:
+        name = str(path.resolve())
+        # the mapped zip files are stored separately from the zipfile.ZipFile objects
+        ozf = self._get(name + '#mmap', lambda: OpenedMappedZipFile(name, self.directory_cache), pin)
+        assert isinstance(ozf, OpenedMappedZipFile)
+        return ozf
+
+    @contextlib.contextmanager
+    def mapped(self, path: Path) -> Iterator[MappedZipFile]:
+        """ Like get_mapped, but the archive is not closed by the cache before the block is left """
+        ozf = self._get_mapped(path, pin=True)
+        try:
+            yield ozf
+        finally:
+            with self._lock:
+                ozf.pins -= 1
 
     def close(self):
         logger = logging.getLogger(__name__)
+        self._check_process()
         for zf in self.zipfiles.values():
-            zf.clean()
-            if zf.opened_files:
-                logger.warning(f'{zf.filename} still has open files')
+            if zf.is_in_use():
+                logger.warning(f'{zf.filename} is still in use')
             zf.close()
-        if self.stat_requested:
-            logger.info(f'Closing ZipFileCache. Cache hits: {self.stat_successes}/{self.stat_requested}. '
-                        f'Pushbacks because of open files: {self.stat_pushed_because_open}')
+        stats = self.get_stats()
+        if stats['requested']:
+            logger.info(f'Closing ZipFileCache. Cache hits: {stats["hits"]}/{stats["requested"]}. '
+                        f'Evictions: {stats["evictions"]}. '
+                        f'Pushbacks because of open files: {stats["pushed_because_open"]}')
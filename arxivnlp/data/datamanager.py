@@ -1,14 +1,25 @@
-from typing import Optional, Any, IO
+import logging
+import multiprocessing
+import os
+import threading
+from multiprocessing import util as mp_util
+from pathlib import Path
+from typing import Optional, Any, Callable, Dict, Tuple, Iterable, Iterator, List, Union
+
 from lxml import etree
 
-from .arxivcategories import ArxivCategories
+from .arxivcategories import ArxivCategories, ArxivMetadata
 from .arxmlivdocs import ArXMLivDocs
 from .cached import ZipFileCache
-from .dnm import DnmConfig, Dnm, DEFAULT_DNM_CONFIG
+from .dnm import DnmConfig, Dnm, DEFAULT_DNM_CONFIG, parse_pruned
+from .dnmcache import DnmCache, CachedDnm
+from .prefetch import Prefetcher
 from ..config import Config
 
 
 class DataManager(object):
+    _process_instance: Optional['DataManager'] = None
+
     def __init__(self, config: Optional[Config] = None):
         if config:
             self.config = config
@@ -16,19 +27,201 @@ class DataManager(object):
             self.config = Config.get()
         self.zipfile_cache = ZipFileCache(self.config)
         self.arxiv_categories = ArxivCategories(self.config)
+        self.arxiv_metadata = ArxivMetadata(self.config, self.arxiv_categories)
         self.arxmliv_docs = ArXMLivDocs(self.config, self.zipfile_cache)
+        self.dnm_cache = DnmCache(self.config, self.load_tree, self._get_dnm_inputs)
+
+    @classmethod
+    def get(cls) -> 'DataManager':
+        """ Returns the DataManager of the current process (in pool workers, it is created by the initializer) """
+        if cls._process_instance is None:
+            cls._process_instance = DataManager()
+        return cls._process_instance
 
     html_parser: Any = etree.HTMLParser()    # Setting type to Any suppress annoying warnings
+    html_bytes_parser: Any = etree.HTMLParser(encoding='utf-8')
+
+    def load_tree(self, arxiv_id: str) -> Any:
+        with self.arxmliv_docs.open(arxiv_id) as fp:
+            return etree.parse(fp, self.html_parser)
 
-    def load_dnm(self, arxiv_id: str, dnm_config: Optional[DnmConfig] = None) -> Dnm:
+    def load_dnm(self, arxiv_id: str, dnm_config: Optional[DnmConfig] = None, prune: bool = False) -> Dnm:
+        """
+            If `prune` is set, the content of nodes that are skipped or replaced in the Dnm is discarded while parsing
+            (see parse_pruned), which saves time and memory, but the tree of the Dnm is incomplete.
+        """
         if dnm_config is None:
             dnm_config = DEFAULT_DNM_CONFIG
-        with self.arxmliv_docs.open(arxiv_id) as fp:
-            tree = etree.parse(fp, self.html_parser)
-        return Dnm(tree, dnm_config)
+        if prune:
+            with self.arxmliv_docs.open(arxiv_id, read_as_text=False) as fp:
+                return Dnm(parse_pruned(fp, dnm_config), dnm_config)
+        return Dnm(self.load_tree(arxiv_id), dnm_config)
+
+    def load_cached_dnm(self, arxiv_id: str, dnm_config: Optional[DnmConfig] = None) -> CachedDnm:
+        """
+            Like load_dnm, but the string and back references are cached (requires a cache directory),
+            so that later calls do not have to parse the document unless the tree is needed (see CachedDnm).
+        """
+        if dnm_config is None:
+            dnm_config = DEFAULT_DNM_CONFIG
+        return self.dnm_cache.load(ArXMLivDocs.normalize_arxiv_id(arxiv_id), dnm_config)
+
+    def _get_dnm_inputs(self, arxiv_id: str) -> List[Path]:
+        assert self.config.arxmliv_dir is not None
+        location = self.arxmliv_docs.doc_index.get(arxiv_id) if self.arxmliv_docs.doc_index.ensured() else None
+        return [self.config.arxmliv_dir / location.container] if location is not None else []
+
+    def parse_html(self, data: Union[bytes, memoryview]) -> Any:
+        """ Parses the raw html of a document (see ArXMLivDocs.read_bytes) """
+        return etree.fromstring(bytes(data), self.html_bytes_parser).getroottree()
+
+    def iter_documents(self, arxiv_ids: Iterable[str], parse: bool = False, pool: Optional['WorkerPool'] = None,
+                       batch_size: int = 64) -> Iterator[Tuple[str, Any]]:
+        """
+            Lazily yields (arxiv id, content) for the documents, where the content is the raw html or the
+            parsed tree (if `parse` is set). The ids are normalized.
+            The documents are read in the order in which they are stored (grouped by zip file and sorted by offset)
+            rather than in the order of `arxiv_ids`, which keeps disk reads sequential and the ZipFileCache small.
+            With a `pool`, each worker reads runs of `batch_size` documents from the same archive (trees cannot be
+            pickled, so they are parsed in this process).
+        """
+        batches = self.arxmliv_docs.get_batches(arxiv_ids, batch_size)
+        if pool is None:
+            for batch in batches:
+                for arxiv_id in batch:
+                    data = self.arxmliv_docs.read_bytes(arxiv_id)
+                    yield arxiv_id, self.parse_html(data) if parse else data
+        else:
+            for results in pool.imap(_read_batch, batches):
+                for arxiv_id, data in results:
+                    yield arxiv_id, self.parse_html(data) if parse else data
+
+    def map_documents(self, function: Callable[[str, Any], Any], arxiv_ids: Iterable[str], pool: 'WorkerPool',
+                      parse: bool = False, batch_size: int = 64) -> Iterator[Tuple[str, Any]]:
+        """
+            Like iter_documents, but `function(arxiv_id, content)` is called in the workers.
+            Yields (arxiv id, result) in the order in which the batches are completed.
+        """
+        tasks = [(batch, function, parse) for batch in self.arxmliv_docs.get_batches(arxiv_ids, batch_size)]
+        for results in pool.imap_unordered(_process_batch, tasks):
+            yield from results
+
+    def prefetch(self, arxiv_ids: Iterable[str], depth: int = 8, max_bytes: int = 256 * 2**20, threads: int = 2,
+                 parse: bool = False) -> Prefetcher:
+        """ Iterates over the documents, reading the next ones on background threads (see Prefetcher) """
+        return Prefetcher(self.arxmliv_docs, arxiv_ids, depth, max_bytes, threads, parse)
+
+    def pool(self, processes: Optional[int] = None, initializer: Optional[Callable] = None, initargs: Tuple = (),
+             start_method: Optional[str] = None) -> 'WorkerPool':
+        """
+            Creates a multiprocessing pool for this DataManager's config.
+            Each worker gets its own DataManager (see DataManager.get) and the zip file statistics of the workers
+            are collected when the pool is closed.
+            `processes` defaults to the number of processes from the config.
+        """
+        if processes is None:
+            processes = self.config.number_of_processes if self.config.number_of_processes else 1
+        return WorkerPool(self.config, processes, initializer, initargs, start_method)
 
     def close(self):
         self.zipfile_cache.close()
 
     def __del__(self):
-        self.close()
\ No newline at end of file
+        self.close()
+
+    def __getstate__(self):
+        # open zip files cannot be shared with other processes
+        return {'config': self.config}
+
+    def __setstate__(self, state):
+        self.__init__(state['config'])
+
+
+def _read_batch(batch: List[str]) -> List[Tuple[str, bytes]]:
+    arxmliv_docs = DataManager.get().arxmliv_docs
+    return [(arxiv_id, bytes(arxmliv_docs.read_bytes(arxiv_id))) for arxiv_id in batch]
+
+
+def _process_batch(task: Tuple[List[str], Callable[[str, Any], Any], bool]) -> List[Tuple[str, Any]]:
+    batch, function, parse = task
+    data_manager = DataManager.get()
+    results: List[Tuple[str, Any]] = []
+    for arxiv_id in batch:
+        data = data_manager.arxmliv_docs.read_bytes(arxiv_id)
+        results.append((arxiv_id, function(arxiv_id, data_manager.parse_html(data) if parse else data)))
+    return results
+
+
+def _init_worker(config: Config, stats_queue: Any, initializer: Optional[Callable], initargs: Tuple):
+    config.set_as_default()
+    DataManager._process_instance = DataManager(config)
+    mp_util.Finalize(None, _report_worker_stats, args=(stats_queue,), exitpriority=10)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _report_worker_stats(stats_queue: Any):
+    stats: Dict[str, int] = {}
+    for cache in list(ZipFileCache.instances):
+        if cache.pid != os.getpid():
+            continue   # inherited from the parent process and never used
+        for key, value in cache.get_stats().items():
+            stats[key] = stats.get(key, 0) + value
+    stats_queue.put((os.getpid(), stats))
+
+
+class WorkerPool(object):
+    """ Wraps multiprocessing.Pool (see DataManager.pool) """
+    def __init__(self, config: Config, processes: int, initializer: Optional[Callable], initargs: Tuple,
+                 start_method: Optional[str]):
+        context = multiprocessing.get_context(start_method)
+        self._stats_queue = context.SimpleQueue()
+        self.pool = context.Pool(processes, initializer=_init_worker,
+                                 initargs=(config, self._stats_queue, initializer, initargs))
+        self.worker_stats: Dict[int, Dict[str, int]] = {}   # pid -> zip file cache statistics
+        self._closed: bool = False
+
+    def __getattr__(self, item):
+        # map, imap, apply_async, ...
+        if item == 'pool':
+            raise AttributeError(item)
+        return getattr(self.pool, item)
+
+    def __enter__(self) -> 'WorkerPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def _collect_stats(self):
+        while True:
+            result = self._stats_queue.get()
+            if result is None:
+                return
+            pid, stats = result
+            self.worker_stats[pid] = stats
+
+    def close(self):
+        """ Waits for the workers to finish and collects their statistics """
+        if self._closed:
+            return
+        self._closed = True
+        self.pool.close()
+        # workers block at exit if nobody reads their statistics
+        collector = threading.Thread(target=self._collect_stats, daemon=True)
+        collector.start()
+        self.pool.join()
+        self._stats_queue.put(None)
+        collector.join()
+        logger = logging.getLogger(__name__)
+        for pid, stats in sorted(self.worker_stats.items()):
+            if stats.get('requested'):
+                logger.info(f'Worker {pid}: zip file cache hits: {stats["hits"]}/{stats["requested"]}')
+
+    def terminate(self):
+        self._closed = True
+        self.pool.terminate()
+        self.pool.join()
@@ -1,36 +1,63 @@
-from typing import Set, List, Tuple, Dict, Optional
-
+import array
+import bisect
+import hashlib
+import itertools
+import json
+import re
+from typing import Set, List, Tuple, Dict, Optional, Any, IO, Union, Sequence, Callable, Pattern, Iterable, \
+    overload
+
+from lxml import etree
 from lxml.etree import _Element, _ElementTree
 
 from arxivnlp.utils import get_node_classes
 
 
 class DnmPoint(object):
+    # ids that can be used as anchors (they must not contain the separators of the string representation)
+    _anchor_id_regex = re.compile(r'^[A-Za-z0-9._:-]+$')
+
     def __init__(self, node: _Element, text_offset: Optional[int] = None, tail_offset: Optional[int] = None):
         assert text_offset is None or tail_offset is None
         self.node = node
         self.text_offset = text_offset
         self.tail_offset = tail_offset
 
-    def to_string(self) -> str:
-        xpath = self.node.getroottree().getpath(self.node)
+    def get_path(self, use_ids: bool = True) -> str:
+        """
+            Returns '#id' for the closest ancestor-or-self with a (usable) id attribute, followed by the steps from it
+            to the node (e.g. '#S1.p2/span[3]').
+            Without such an ancestor (or if `use_ids` is not set), the absolute XPath of the node is returned.
+            The ids have to be unique (which LaTeXML ids are).
+        """
+        if use_ids:
+            steps: List[str] = []
+            node: Optional[_Element] = self.node
+            while node is not None:
+                id_ = node.get('id') if isinstance(node.tag, str) else None
+                if id_ is not None and DnmPoint._anchor_id_regex.match(id_):
+                    return '/'.join(['#' + id_] + steps[::-1])
+                step = _get_step(node)
+                if step is None:
+                    break
+                steps.append(step)
+                node = node.getparent()
+        return self.node.getroottree().getpath(self.node)
+
+    def to_string(self, use_ids: bool = True) -> str:
+        path = self.get_path(use_ids)
         if self.text_offset is not None:
-            return f'{xpath}+text{self.text_offset}'
+            return f'{path}+text{self.text_offset}'
         if self.tail_offset is not None:
-            return f'{xpath}+tail{self.tail_offset}'
-        return xpath
+            return f'{path}+tail{self.tail_offset}'
+        return path
 
     @classmethod
-    def from_string(cls, string: str, root: _ElementTree) -> 'DnmPoint':
-        if '+' in string:
-            xpath, offset = string.split('+')
-            node = root.xpath(xpath)[0]
-            if offset.startswith('text'):
-                return DnmPoint(node, text_offset=int(offset[4:]))
-            else:
-                assert offset.startswith('tail')
-                return DnmPoint(node, tail_offset=int(offset[4:]))
-        return DnmPoint(root.xpath(string)[0])
+    def from_string(cls, string: str, root: _ElementTree, resolver: Optional['DnmPointResolver'] = None) -> 'DnmPoint':
+        """ Reads both the id-anchored strings and the (older) XPath strings """
+        if resolver is None:
+            resolver = DnmPointResolver(root, build_id_map=False)
+        return resolver.resolve_point(string)
 
 
 class DnmRange(object):
@@ -39,13 +66,122 @@ class DnmRange(object):
         self.to = to
         self.right_closed = right_closed  # `to` is included in range
 
-    def to_string(self) -> str:
-        return f'{self.from_.to_string()}&{self.to.to_string()}&{self.right_closed}'
+    def to_string(self, use_ids: bool = True) -> str:
+        return f'{self.from_.to_string(use_ids)}&{self.to.to_string(use_ids)}&{self.right_closed}'
 
     @classmethod
-    def from_string(cls, string: str, root: _ElementTree) -> 'DnmRange':
+    def from_string(cls, string: str, root: _ElementTree, resolver: Optional['DnmPointResolver'] = None) -> 'DnmRange':
+        if resolver is None:
+            resolver = DnmPointResolver(root, build_id_map=False)
+        return resolver.resolve_range(string)
+
+
+_step_regex = re.compile(r'^(?P<tag>[A-Za-z_][A-Za-z0-9_.-]*|comment\(\))(\[(?P<index>[0-9]+)\])?$')
+
+
+def _get_step(node: _Element) -> Optional[str]:
+    """ The step from the parent to the node (like in getpath) or None if it cannot be expressed """
+    parent = node.getparent()
+    if parent is None:
+        return None
+    if node.tag is etree.Comment:
+        tag = 'comment()'
+    elif isinstance(node.tag, str) and _step_regex.match(node.tag):
+        tag = node.tag
+    else:
+        return None    # processing instructions, namespaced tags, ...
+    index = 0
+    count = 0
+    for child in parent:
+        if child.tag == node.tag:
+            count += 1
+            if child is node:
+                index = count
+    return tag if count == 1 else f'{tag}[{index}]'
+
+
+class DnmPointResolver(object):
+    """
+        Resolves the string representations of DnmPoints and DnmRanges for one document.
+        The map from ids to nodes is built once (on first use), which makes resolving many stored ranges cheap.
+        Simple paths are followed step by step instead of evaluating them as XPath.
+    """
+
+    def __init__(self, tree: _ElementTree, build_id_map: bool = True):
+        """ If `build_id_map` is not set, ids are looked up individually (cheaper for a single string) """
+        self.tree = tree
+        self._id_map: Optional[Dict[str, _Element]] = None
+        self._build_id_map = build_id_map
+        self._nodes: Dict[str, _Element] = {}
+
+    def _get_by_id(self, id_: str) -> _Element:
+        if not self._build_id_map:
+            nodes = self.tree.xpath('//*[@id=$id]', id=id_)
+            if not nodes:
+                raise KeyError(f'No node with id {id_!r}')
+            return nodes[0]
+        if self._id_map is None:
+            self._id_map = {}
+            for node in self.tree.iter():
+                if isinstance(node.tag, str):
+                    id_of_node = node.get('id')
+                    if id_of_node is not None:
+                        self._id_map.setdefault(id_of_node, node)
+        return self._id_map[id_]
+
+    def get_node(self, path: str) -> _Element:
+        """ Returns the node for the path part of a DnmPoint string """
+        node = self._nodes.get(path)
+        if node is not None:
+            return node
+        if path.startswith('#'):
+            id_, *steps = path[1:].split('/')
+            node = self._get_by_id(id_)
+        else:
+            steps = path.split('/')
+            node = self.tree.getroot()
+            if steps[:2] != ['', node.tag]:
+                steps = []
+                node = None
+            else:
+                steps = steps[2:]
+        for step in steps:
+            match = _step_regex.match(step)
+            if match is None:
+                node = None
+                break
+            tag: Any = etree.Comment if match.group('tag') == 'comment()' else match.group('tag')
+            index = int(match.group('index') or 1)
+            assert node is not None
+            for child in node:
+                if child.tag == tag:
+                    index -= 1
+                    if not index:
+                        node = child
+                        break
+            else:
+                raise KeyError(f'Failed to resolve {path!r}')
+        if node is None:    # fall back to evaluating the path as XPath
+            node = self.tree.xpath(path)[0]
+        self._nodes[path] = node
+        return node
+
+    def resolve_point(self, string: str) -> DnmPoint:
+        path, _, offset = string.partition('+')
+        node = self.get_node(path)
+        if not offset:
+            return DnmPoint(node)
+        if offset.startswith('text'):
+            return DnmPoint(node, text_offset=int(offset[4:]))
+        assert offset.startswith('tail')
+        return DnmPoint(node, tail_offset=int(offset[4:]))
+
+    def resolve_range(self, string: str) -> DnmRange:
         x, y, b = string.split('&')
-        return DnmRange(DnmPoint.from_string(x, root), DnmPoint.from_string(y, root), {'True': True, 'False': False}[b])
+        return DnmRange(self.resolve_point(x), self.resolve_point(y), {'True': True, 'False': False}[b])
+
+    def resolve_ranges(self, strings: Iterable[str]) -> List[DnmRange]:
+        return [self.resolve_range(string) for string in strings]
 
 
 class DnmConfig(object):
@@ -56,6 +192,15 @@ class DnmConfig(object):
         self.nodes_to_replace = nodes_to_replace
         self.classes_to_replace = classes_to_replace
 
+    def fingerprint(self) -> str:
+        """ Identifies the configuration (e.g. for caching) """
+        description = json.dumps([sorted(self.nodes_to_skip), sorted(self.classes_to_skip),
+                                  sorted(self.nodes_to_replace.items()), sorted(self.classes_to_replace.items())])
+        return hashlib.md5(description.encode('utf-8')).hexdigest()[:16]
+
+    def compile(self) -> 'CompiledDnmConfig':
+        return CompiledDnmConfig(self)
+
     def skip_node(self, node: _Element) -> bool:
         for e in get_node_classes(node):
             if e in self.classes_to_skip:
@@ -73,13 +218,101 @@ class DnmConfig(object):
         return None
 
 
+class CompiledDnmConfig(object):
+    """
+        A DnmConfig prepared for deciding about many nodes (see get_action).
+        It is a snapshot, i.e. later changes of the DnmConfig are not reflected.
+    """
+    SKIP: Any = object()
+
+    def __init__(self, dnm_config: DnmConfig):
+        self.skip_classes: Set[str] = frozenset(dnm_config.classes_to_skip)
+        self.replace_classes: Dict[str, str] = dict(dnm_config.classes_to_replace)
+        self.check_classes: bool = bool(self.skip_classes or self.replace_classes)
+        # the action for a tag if the classes of the node do not matter
+        self.tag_actions: Dict[Any, Any] = dict(dnm_config.nodes_to_replace)
+        self.tag_actions.update((tag, CompiledDnmConfig.SKIP) for tag in dnm_config.nodes_to_skip)
+
+    def get_action(self, node: _Element) -> Any:
+        """ Returns SKIP, the replacement string or None (same result as DnmConfig.skip_node and replace_node) """
+        action = self.tag_actions.get(node.tag)
+        if action is CompiledDnmConfig.SKIP or not self.check_classes:
+            return action
+        classes = node.get('class')
+        if classes is None:
+            return action
+        classes_of_node = classes.split()
+        if not self.skip_classes.isdisjoint(classes_of_node):
+            return CompiledDnmConfig.SKIP
+        if action is None and self.replace_classes:
+            for e in classes_of_node:
+                if e in self.replace_classes:
+                    return self.replace_classes[e]
+        return action
+
+
+class _PruningTarget(object):
+    """ A parser target that builds the tree, but drops the content of nodes that the Dnm skips or replaces """
+    def __init__(self, dnm_config: DnmConfig):
+        self.builder = etree.TreeBuilder()
+        self.tags: Set[str] = dnm_config.nodes_to_skip | set(dnm_config.nodes_to_replace)
+        self.classes: Set[str] = dnm_config.classes_to_skip | set(dnm_config.classes_to_replace)
+        self.depth: int = 0   # > 0 while inside a pruned node
+
+    def start(self, tag: str, attrib: Dict[str, str]):
+        if self.depth:
+            self.depth += 1
+            return
+        self.builder.start(tag, attrib)
+        if tag in self.tags:
+            self.depth = 1
+        else:
+            classes = attrib.get('class')
+            if classes is not None and not self.classes.isdisjoint(classes.split()):
+                self.depth = 1
+
+    def end(self, tag: str):
+        if self.depth > 1:
+            self.depth -= 1
+            return
+        self.depth = 0
+        self.builder.end(tag)
+
+    def data(self, data: str):
+        if not self.depth:
+            self.builder.data(data)
+
+    def comment(self, text: str):
+        if not self.depth:
+            self.builder.comment(text)
+
+    def pi(self, target: str, data: Optional[str] = None):
+        if not self.depth:
+            self.builder.pi(target, data)
+
+    def close(self) -> _Element:
+        return self.builder.close()
+
+
+def parse_pruned(source: Union[str, IO[bytes]], dnm_config: DnmConfig) -> _ElementTree:
+    """
+        Parses a (utf-8 encoded) html document, but the content of nodes that are skipped or replaced according to
+        `dnm_config` is never added to the tree (e.g. the MathML and TeX annotations of math nodes).
+        The nodes themselves (with attributes and tail) are kept, so a Dnm of the pruned tree with the same config
+        has the same string and the same back references as a Dnm of the complete tree.
+    """
+    parser: Any = etree.HTMLParser(target=_PruningTarget(dnm_config), encoding='utf-8')
+    return etree.parse(source, parser).getroottree()
+
+
 class Token(object):
     start_pos_in_dnm: Optional[int] = None
 
     def get_string(self) -> str:
         raise NotImplemented
 
-    def insert_node(self, node: _Element, pos: int, after: bool = False):
+    def insert_node(self, node: _Element, pos: int, after: bool = False) -> Optional['StringToken']:
+        """ Inserts node into the tree and returns the token for the text behind it if this token was split """
         raise NotImplemented
 
     def get_surrounding_node(self) -> _Element:
@@ -95,21 +328,23 @@ class StringToken(Token):
     def get_string(self) -> str:
         return self.content
 
-    def insert_node(self, node: _Element, pos: int, after: bool = False):
+    def insert_node(self, node: _Element, pos: int, after: bool = False) -> 'StringToken':
         if after:
             pos += 1
         if self.backref_type == 'text':
             self.backref_node.insert(0, node)  # 0 means child no. 0
-            assert self.backref_node.text is not None
-            node.tail = self.backref_node.text[pos:]
-            self.backref_node.text = self.backref_node.text[:pos]
+            text = self.backref_node.text or ''
+            node.tail = text[pos:]
+            self.backref_node.text = text[:pos]
         elif self.backref_type == 'tail':
             self.backref_node.addnext(node)  # add a new sibling and move tail behind
-            assert node.tail is not None
-            self.backref_node.tail = node.tail[:pos]
-            node.tail = node.tail[pos:]
+            text = node.tail or ''
+            self.backref_node.tail = text[:pos]
+            node.tail = text[pos:]
         else:
             raise Exception(f'Unsupported backref type {self.backref_type}')
+        self.content = text[:pos]
+        return StringToken(content=text[pos:], backref_node=node, backref_type='tail')
 
     def get_surrounding_node(self) -> _Element:
         if self.backref_type == 'text':
@@ -130,9 +365,9 @@ class NodeToken(Token):
     def get_string(self) -> str:
         return self.replaced_string
 
-    def insert_node(self, node: _Element, pos: int, after: bool = False):
+    def insert_node(self, node: _Element, pos: int, after: bool = False) -> None:
         if after:
-            self.backref_node.addnext(node)
+            self.backref_node.addnext(node)   # note that the tail of backref_node is moved to node
         else:
             self.backref_node.addprevious(node)
 
@@ -140,52 +375,165 @@ class NodeToken(Token):
         return self.backref_node
 
 
+class _BackrefsView(Sequence):
+    """ Per-character view of the back references of a Dnm (computed on access from the token offsets) """
+    def __init__(self, dnm: 'Dnm', relative: bool):
+        self.dnm = dnm
+        self.relative = relative
+
+    def __len__(self) -> int:
+        return len(self.dnm.string)
+
+    def _get(self, pos: int) -> Any:
+        token = self.dnm.get_token(pos)
+        if self.relative:
+            assert token.start_pos_in_dnm is not None
+            return pos - token.start_pos_in_dnm
+        return token
+
+    @overload
+    def __getitem__(self, item: int) -> Any: ...
+
+    @overload
+    def __getitem__(self, item: slice) -> List[Any]: ...
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._get(pos) for pos in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        return self._get(item)
+
+
 class Dnm(object):
-    def __init__(self, tree: _ElementTree, dnm_config: DnmConfig):
+    def __init__(self, tree: _ElementTree, dnm_config: DnmConfig, root: Optional[_Element] = None, offset: int = 0):
+        """
+            If `root` is specified, only the subtree of root is linearized (without the tail of root).
+            `offset` is the position of the string in the Dnm of the whole tree (see LazyDnm).
+        """
         self.tree = tree
         self.dnm_config = dnm_config
-        self.is_clean: bool = True  # backrefs are still consistent with tree
+        self.root: _Element = root if root is not None else tree.getroot()
+        self.offset = offset
 
         self.tokens: List[Token] = []
         self.node_to_token_range: Dict[_Element, Tuple[int, int]] = {}
         self.node_to_text_token: Dict[_Element, StringToken] = {}
         self.node_to_tail_token: Dict[_Element, StringToken] = {}
-        self._append_to_tokens(tree.getroot())
-        self.string: str = ''
-        self.backrefs_token: List[Token] = []
-        self.backrefs_pos: List[int] = []
-        self.string = ''.join(token.get_string() for token in self.tokens)
-        self.backrefs_token = []
-        self.backrefs_pos = []
-        for token in self.tokens:
-            token.start_pos_in_dnm = len(self.backrefs_token)
-            for pos in range(len(token.get_string())):
-                self.backrefs_token.append(token)
-                self.backrefs_pos.append(pos)
+        self._append_to_tokens(self.root)
+        self.string: str = ''.join(token.get_string() for token in self.tokens)
+        # token_starts[i] is the offset of token i in the string (the last entry is the length of the string)
+        self.token_starts: array.array = array.array('q')
+        self._update_token_starts()
 
         self.nodes_to_add: List[Tuple[_Element, int, bool]] = []
+        self._node_ranges: Optional[Dict[_Element, Tuple[int, int]]] = None   # created on first use
+
+    def _update_token_starts(self):
+        self.token_starts = array.array('q', itertools.accumulate((len(t.get_string()) for t in self.tokens),
+                                                                  initial=0))
+        for token, start in zip(self.tokens, self.token_starts):
+            token.start_pos_in_dnm = start
+
+    def get_token_index(self, pos: int) -> int:
+        """ Returns the index of the token that contains the character at pos """
+        if not 0 <= pos < len(self.string):
+            raise IndexError(f'Position {pos} is out of range')
+        # tokens with an empty string share their offset with the next token and are never returned
+        return bisect.bisect_right(self.token_starts, pos) - 1
+
+    def get_token(self, pos: int) -> Token:
+        return self.tokens[self.get_token_index(pos)]
+
+    def get_backref(self, pos: int) -> Tuple[Token, int]:
+        """ Returns the token that contains the character at pos and the position in the token """
+        index = self.get_token_index(pos)
+        return self.tokens[index], pos - self.token_starts[index]
+
+    @property
+    def backrefs_token(self) -> Sequence[Token]:
+        """ The token of every character (prefer get_token) """
+        return _BackrefsView(self, relative=False)
+
+    @property
+    def backrefs_pos(self) -> Sequence[int]:
+        """ The position of every character in its token (prefer get_backref) """
+        return _BackrefsView(self, relative=True)
+
+    def _build_node_ranges(self) -> Dict[_Element, Tuple[int, int]]:
+        """
+            Computes the range in the string of every node in the subtree (in a single pass).
+            The nodes in a replaced node get the range of the replaced node and skipped nodes get an empty range
+            at their position (as do the nodes in them).
+        """
+        tokens = self.tokens
+        token_starts = self.token_starts
+        node_to_token_range = self.node_to_token_range
+        node_ranges: Dict[_Element, Tuple[int, int]] = {}
+        opaque: Set[_Element] = set()    # skipped and replaced nodes (their descendants are not in the Dnm)
+        for node in self.root.iter():
+            parent = node.getparent() if node is not self.root else None
+            if parent in opaque:
+                node_ranges[node] = node_ranges[parent]
+                opaque.add(node)
+                continue
+            token_range = node_to_token_range.get(node)
+            if token_range is not None:
+                start, end = token_range
+                node_ranges[node] = (token_starts[start], token_starts[end])
+                if end == start + 1 and isinstance(tokens[start], NodeToken) and tokens[start].backref_node is node:
+                    opaque.add(node)
+                continue
+            # a skipped node: its position is behind the preceding content
+            previous = node.getprevious()
+            if previous is not None:
+                tail_token = self.node_to_tail_token.get(previous)
+                pos = tail_token.start_pos_in_dnm + len(tail_token.content) if tail_token is not None \
+                    else node_ranges[previous][1]
+            elif parent is not None:
+                text_token = self.node_to_text_token.get(parent)
+                pos = text_token.start_pos_in_dnm + len(text_token.content) if text_token is not None \
+                    else node_ranges[parent][0]
+            else:
+                pos = 0
+            node_ranges[node] = (pos, pos)
+            opaque.add(node)
+        return node_ranges
+
+    def get_node_range(self, node: _Element) -> Tuple[int, int]:
+        """ Returns the range (start, end) of the content of node in the string (see _build_node_ranges) """
+        if self._node_ranges is None:
+            self._node_ranges = self._build_node_ranges()
+        return self._node_ranges[node]
 
     def dnm_point_to_pos(self, point: DnmPoint) -> Tuple[int, Optional[int]]:
+        """
+            Returns (pos, None) for points in the text or tail of a node (if it is part of the string)
+            and the range of the node otherwise.
+        """
         if point.tail_offset is not None:
             if point.node in self.node_to_tail_token:
                 return self.node_to_tail_token[point.node].start_pos_in_dnm + point.tail_offset, None
         if point.text_offset is not None:
             if point.node in self.node_to_text_token:
                 return self.node_to_text_token[point.node].start_pos_in_dnm + point.text_offset, None
-        if point.node in self.node_to_token_range:
-            start, end = self.node_to_token_range[point.node]
-            start_offset = self.tokens[start].start_pos_in_dnm
-            end_token = self.tokens[end]
-            if isinstance(end_token, StringToken) and end_token.backref_type == 'tail':
-                return start_offset, end_token.start_pos_in_dnm
-            if end + 1 < len(self.tokens):
-                return start_offset, self.tokens[end + 1].start_pos_in_dnm
-            return start_offset, len(self.string)
-        return self.dnm_point_to_pos(DnmPoint(point.node.getparent()))  # ignore tail/text
+        return self.get_node_range(point.node)
+
+    def dnm_points_to_pos(self, points: Iterable[Union[DnmPoint, _Element]]) -> List[Tuple[int, Optional[int]]]:
+        """ Like dnm_point_to_pos for many points at once (nodes are treated like DnmPoint(node)) """
+        if self._node_ranges is None:
+            self._node_ranges = self._build_node_ranges()
+        node_ranges = self._node_ranges
+        result: List[Tuple[int, Optional[int]]] = []
+        for point in points:
+            if isinstance(point, DnmPoint):
+                result.append(self.dnm_point_to_pos(point))
+            else:
+                result.append(node_ranges[point])
+        return result
 
     def get_dnm_point(self, pos: int) -> DnmPoint:
-        token = self.backrefs_token[pos]
-        rel_pos = self.backrefs_pos[pos]
+        token, rel_pos = self.get_backref(pos)
         if isinstance(token, StringToken):
             if token.backref_type == 'text':
                 return DnmPoint(token.backref_node, text_offset=rel_pos)
@@ -194,52 +542,244 @@ class Dnm(object):
         assert isinstance(token, NodeToken)
         return DnmPoint(token.backref_node)
 
-    def _append_to_tokens(self, node: _Element):
-        if not self.dnm_config.skip_node(node):
-            start_range = len(self.tokens)
-            replacement = self.dnm_config.replace_node(node)
-            if replacement is not None:
-                self.tokens.append(NodeToken(backref_node=node, replaced_string=replacement))
+    def _append_to_tokens(self, root: _Element):
+        """ Appends the tokens of the subtree (with an explicit stack - deep trees exceed the recursion limit) """
+        get_action = self.dnm_config.compile().get_action
+        skip = CompiledDnmConfig.SKIP
+        tokens = self.tokens
+        node_to_token_range = self.node_to_token_range
+        # nodes that still have to be processed and (node, start of token range) once its children are complete
+        work: List[Union[_Element, Tuple[_Element, int]]] = [root]
+        while work:
+            item = work.pop()
+            if type(item) is tuple:
+                node, start_range = item
+                node_to_token_range[node] = (start_range, len(tokens))
             else:
-                if node.text:
-                    token = StringToken(content=node.text, backref_node=node, backref_type='text')
-                    self.tokens.append(token)
-                    self.node_to_text_token[node] = token
-                for child in node:
-                    self._append_to_tokens(child)
-                    if child.tail:
-                        token = StringToken(content=child.tail, backref_node=child, backref_type='tail')
-                        self.tokens.append(token)
-                        self.node_to_tail_token[child] = token
-            self.node_to_token_range[node] = (start_range, len(self.tokens))
+                node = item
+                action = get_action(node)
+                if action is None:
+                    start_range = len(tokens)
+                    if node.text:
+                        token = StringToken(content=node.text, backref_node=node, backref_type='text')
+                        tokens.append(token)
+                        self.node_to_text_token[node] = token
+                    children = list(node)
+                    if children:
+                        work.append((node, start_range))
+                        children.reverse()
+                        work.extend(children)
+                        continue
+                    node_to_token_range[node] = (start_range, len(tokens))
+                elif action is not skip:
+                    tokens.append(NodeToken(backref_node=node, replaced_string=action))
+                    node_to_token_range[node] = (len(tokens) - 1, len(tokens))
+            # node is complete - its tail belongs to the parent
+            if node is not root and node.tail:
+                token = StringToken(content=node.tail, backref_node=node, backref_type='tail')
+                tokens.append(token)
+                self.node_to_tail_token[node] = token
 
     def add_node(self, node: _Element, pos: int, after: bool = False):
         self.nodes_to_add.append((node, pos, after))
 
-    def insert_added_nodes(self, ignore_is_clean: bool = False):
-        if (not self.is_clean) and not ignore_is_clean:
-            raise Exception('Nodes have already been added to the tree and some back references may be wrong. '
-                            'Adding new nodes can lead to undefined behaviour')
-        if self.nodes_to_add:
-            self.is_clean = False
+    def insert_added_nodes(self):
+        """
+            Inserts the added nodes into the tree.
+            The tokens are split where nodes are inserted, so the string, all positions and the back references
+            stay valid and this can be called repeatedly (e.g. for words after sentences).
+            The content of the inserted nodes is not part of the Dnm.
+            Changes of the tree that are not made via add_node are not reflected in the Dnm.
+        """
         l = list(enumerate(self.nodes_to_add))
         # Sorting strategy:
         # 1. from back to front
         # 2. first after
         # 3. prefer the ones inserted first, unless it is a string token (and not after)
         l.sort(key=lambda e: (-e[1][1], -int(e[1][2]),
-                              -e[0] if isinstance(self.backrefs_token[e[1][1]], StringToken) and not e[1][2] else e[0]))
+                              -e[0] if isinstance(self.get_token(e[1][1]), StringToken) and not e[1][2] else e[0]))
+        split_tokens: Dict[int, List[StringToken]] = {}   # token index -> new tokens behind it
         for node, pos, after in (e[1] for e in l):
-            token, pos_relative = self.backrefs_token[pos], self.backrefs_pos[pos]
-            token.insert_node(node, pos_relative, after)
+            index = self.get_token_index(pos)
+            token = self.tokens[index]
+            new_token = token.insert_node(node, pos - self.token_starts[index], after)
+            if new_token is not None:
+                # we go from back to front, i.e. the new token comes before the ones created earlier
+                split_tokens.setdefault(index, []).insert(0, new_token)
+                self.node_to_tail_token[node] = new_token
+            elif after and isinstance(token, NodeToken) and token.backref_node in self.node_to_tail_token:
+                tail_token = self.node_to_tail_token.pop(token.backref_node)
+                tail_token.backref_node = node
+                self.node_to_tail_token[node] = tail_token
         self.nodes_to_add = []
+        self._node_ranges = None
+        if split_tokens:
+            self._insert_tokens(split_tokens)
+
+    def _insert_tokens(self, split_tokens: Dict[int, List[StringToken]]):
+        tokens: List[Token] = []
+        new_index = array.array('q')   # old token index -> new token index
+        for i, token in enumerate(self.tokens):
+            new_index.append(len(tokens))
+            tokens.append(token)
+            tokens.extend(split_tokens.get(i, ()))
+        new_index.append(len(tokens))
+        # the new tokens belong to the same nodes as the token that was split
+        self.node_to_token_range = {node: (new_index[start], new_index[end])
+                                    for node, (start, end) in self.node_to_token_range.items()}
+        for i, new_tokens in split_tokens.items():
+            for j, new_token in enumerate(new_tokens, new_index[i] + 1):
+                # the inserted node has an empty range (directly before its tail)
+                self.node_to_token_range[new_token.backref_node] = (j, j)
+        self.tokens = tokens
+        self._update_token_starts()
 
     def get_full_dnmstr(self) -> 'DnmStr':
-        return DnmStr(self.string, backrefs=list(range(len(self.string))), dnm=self)
+        return DnmStr(self.string, backrefs=range(len(self.string)), dnm=self)
+
+
+class LazyDnm(object):
+    """
+        Creates Dnms for subtrees (e.g. sections or paragraphs) when they are needed.
+        The positions are consistent with the Dnm of the whole tree: the Dnm of a subtree knows the position
+        of its string in the whole Dnm (Dnm.offset), which is computed from the lengths of the preceding content.
+        Computing lengths does not create tokens, i.e. it is much cheaper than creating the Dnm, and the lengths
+        are cached.
+        The Dnms of subtrees are independent of each other (positions in them are relative to their string).
+        Strings spanning several subtrees can be obtained with get_string.
+    """
+    def __init__(self, tree: _ElementTree, dnm_config: DnmConfig):
+        self.tree = tree
+        self.dnm_config = dnm_config
+        self._compiled = dnm_config.compile()
+        self._lengths: Dict[_Element, int] = {}
+        self._dnms: Dict[_Element, Dnm] = {}
+
+    def get_length(self, node: _Element) -> int:
+        """ The length of the string of the subtree (without the tail of node) """
+        lengths = self._lengths
+        if node not in lengths:
+            get_action = self._compiled.get_action
+            # the lengths of the children are computed (and cached) first
+            work: List[Tuple[_Element, bool]] = [(node, False)]
+            while work:
+                n, children_done = work.pop()
+                if children_done:
+                    lengths[n] = len(n.text or '') + sum(lengths[c] + len(c.tail or '') for c in n)
+                    continue
+                action = get_action(n)
+                if action is None and len(n):
+                    work.append((n, True))
+                    work.extend((c, False) for c in n if c not in lengths)
+                elif action is None:
+                    lengths[n] = len(n.text or '')
+                else:
+                    lengths[n] = 0 if action is CompiledDnmConfig.SKIP else len(action)
+        return lengths[node]
+
+    def _get_container(self, node: _Element) -> _Element:
+        """ The outermost skipped or replaced ancestor of node (or node itself) """
+        container = node
+        for ancestor in node.iterancestors():
+            if self._compiled.get_action(ancestor) is not None:
+                container = ancestor
+        return container
+
+    def get_offset(self, node: _Element) -> int:
+        """ The position of (the string of) node in the Dnm of the whole tree """
+        node = self._get_container(node)
+        offset = 0
+        for parent in node.iterancestors():
+            offset += len(parent.text or '')
+            for sibling in parent:
+                if sibling is node:
+                    break
+                offset += self.get_length(sibling) + len(sibling.tail or '')
+            node = parent
+        return offset
+
+    def get_dnm(self, node: Optional[_Element] = None) -> Dnm:
+        """
+            The Dnm of the subtree of node (or the whole tree).
+            If node is in a skipped or replaced subtree, the Dnm of that subtree is returned.
+        """
+        node = self._get_container(node if node is not None else self.tree.getroot())
+        if node not in self._dnms:
+            self._dnms[node] = Dnm(self.tree, self.dnm_config, root=node, offset=self.get_offset(node))
+        return self._dnms[node]
+
+    def get_range(self, node: _Element) -> Tuple[int, int]:
+        """ The range of (the string of) node in the Dnm of the whole tree """
+        offset = self.get_offset(node)
+        return offset, offset + self.get_length(self._get_container(node))
+
+    def get_string(self, start: int = 0, end: Optional[int] = None) -> str:
+        """ Like Dnm.string[start:end] for the Dnm of the whole tree (only subtrees in the range are visited) """
+        get_action = self._compiled.get_action
+        root = self.tree.getroot()
+        end = self.get_length(root) if end is None else end
+        parts: List[str] = []
+        # (offset, node or string) in reverse order
+        work: List[Tuple[int, Union[_Element, str]]] = [(0, root)]
+        while work:
+            offset, item = work.pop()
+            if isinstance(item, str):
+                parts.append(item[max(start - offset, 0):max(end - offset, 0)])
+                continue
+            if offset >= end or offset + self.get_length(item) <= start:
+                continue
+            action = get_action(item)
+            if action is not None:
+                if action is not CompiledDnmConfig.SKIP:
+                    work.append((offset, action))
+                continue
+            items: List[Tuple[int, Union[_Element, str]]] = [(offset, item.text or '')]
+            offset += len(item.text or '')
+            for child in item:
+                items.append((offset, child))
+                offset += self.get_length(child)
+                if child.tail:
+                    items.append((offset, child.tail))
+                    offset += len(child.tail)
+            items.reverse()
+            work.extend(items)
+        return ''.join(parts)
+
+    def get_dnm_point(self, pos: int) -> DnmPoint:
+        """ Like Dnm.get_dnm_point for the Dnm of the whole tree (without creating it) """
+        node = self.tree.getroot()
+        if not 0 <= pos < self.get_length(node):
+            raise IndexError(f'Position {pos} is out of range')
+        while True:
+            action = self._compiled.get_action(node)
+            if action is not None:
+                return DnmPoint(node)   # skipped nodes have a length of 0
+            text_length = len(node.text or '')
+            if pos < text_length:
+                return DnmPoint(node, text_offset=pos)
+            pos -= text_length
+            for child in node:
+                length = self.get_length(child)
+                if pos < length:
+                    node = child
+                    break
+                pos -= length
+                tail_length = len(child.tail or '')
+                if pos < tail_length:
+                    return DnmPoint(child, tail_offset=pos)
+                pos -= tail_length
+            else:
+                raise Exception('Inconsistent lengths (was the tree modified?)')
+
+
+# Positions in the Dnm string for every character of a DnmStr.
+# Contiguous backrefs are ranges, others (e.g. after normalize_spaces) are memoryviews of arrays.
+# Slicing either of them does not copy the positions.
+Backrefs = Union[range, memoryview, Sequence[int]]
 
 
 class DnmStr(object):
-    def __init__(self, string: str, backrefs: List[int], dnm: Dnm):
+    def __init__(self, string: str, backrefs: Backrefs, dnm: Dnm):
         assert len(string) == len(backrefs)
         self.string = string
         self.backrefs = backrefs
@@ -249,14 +789,18 @@ class DnmStr(object):
         return len(self.string)
 
     def __getitem__(self, item) -> 'DnmStr':
-        backrefs = [self.backrefs[item]] if isinstance(item, int) else self.backrefs[item]
-        return DnmStr(string=self.string[item], backrefs=backrefs, dnm=self.dnm)
+        string = self.string[item]
+        if isinstance(item, int):
+            if item < 0:
+                item += len(self.string)
+            item = slice(item, item + 1)
+        return DnmStr(string=string, backrefs=self.backrefs[item], dnm=self.dnm)
 
     def __repr__(self):
         return f'DnmStr({repr(self.string)})'
 
     def get_node(self, pos: int) -> _Element:
-        return self.dnm.backrefs_token[self.backrefs[pos]].get_surrounding_node()
+        return self.dnm.get_token(self.backrefs[pos]).get_surrounding_node()
 
     def get_dnm_point(self, pos: int) -> DnmPoint:
         return self.dnm.get_dnm_point(self.backrefs[pos])
@@ -264,31 +808,75 @@ class DnmStr(object):
     def get_dnm_range(self, start: int, end: int, right_closed: bool = False) -> DnmRange:
         return DnmRange(self.get_dnm_point(start), self.get_dnm_point(end), right_closed)
 
+    def _concat(self, segments: List[Tuple[int, int]]) -> Backrefs:
+        """ The backrefs of the concatenation of the segments [start, stop) of this string """
+        if len(segments) == 1:
+            start, stop = segments[0]
+            return self.backrefs[start:stop]
+        backrefs = array.array('q')
+        for start, stop in segments:
+            backrefs.extend(self.backrefs[start:stop])
+        return memoryview(backrefs)
+
     def strip(self) -> 'DnmStr':
-        str_start = 0
-        str_end = 0
-        for i in range(len(self.string)):
-            if not self.string[i].isspace():
-                str_start = i
-                break
-        for i in range(len(self.string) - 1, -1, -1):
-            if not self.string[i].isspace():
-                str_end = i + 1
-                break
-        return self[str_start:str_end]
+        return self[len(self.string) - len(self.string.lstrip()):len(self.string.rstrip())]
 
     def normalize_spaces(self) -> 'DnmStr':
-        new_string = ''
-        new_backrefs = []
-        for i in range(len(self)):
-            if not self.string[i].isspace():
-                new_string += self.string[i]
-                new_backrefs.append(self.backrefs[i])
-            else:
-                if not (i >= 1 and self.string[i - 1].isspace()):
-                    new_string += ' '
-                    new_backrefs.append(self.backrefs[i])
-        return DnmStr(string=new_string, backrefs=new_backrefs, dnm=self.dnm)
+        """ Replaces every sequence of whitespace characters by a single space (referring to the first one) """
+        segments: List[Tuple[int, int]] = []
+        start = 0
+        for match in _space_run_regex.finditer(self.string):
+            segments.append((start, match.start() + 1))
+            start = match.end()
+        segments.append((start, len(self.string)))
+        return DnmStr(string=_space_regex.sub(' ', self.string), backrefs=self._concat(segments), dnm=self.dnm)
+
+    def _map_chars(self, function: Callable[[str], str]) -> 'DnmStr':
+        """ Applies a character-wise transformation (like str.lower) that can turn a character into several """
+        string = function(self.string)
+        if len(string) == len(self.string):
+            return DnmStr(string=string, backrefs=self.backrefs, dnm=self.dnm)
+        backrefs = array.array('q')
+        for char, backref in zip(self.string, self.backrefs):
+            backrefs.extend([backref] * len(function(char)))
+        return DnmStr(string=string, backrefs=memoryview(backrefs), dnm=self.dnm)
+
+    def lower(self) -> 'DnmStr':
+        return self._map_chars(str.lower)
+
+    def casefold(self) -> 'DnmStr':
+        return self._map_chars(str.casefold)
+
+    def replace(self, old: Union[str, Pattern], new: str, count: int = 0) -> 'DnmStr':
+        """
+            Replaces (the first `count`) occurrences of `old`, which is a string or a compiled regular expression,
+            by `new` (unlike re.sub, group references are not expanded).
+            The characters of `new` refer to the first replaced character (or the next one for empty matches).
+        """
+        regex = old if isinstance(old, re.Pattern) else re.compile(re.escape(old))
+        strings: List[str] = []
+        backrefs = array.array('q')
+        start = 0
+        for i, match in enumerate(regex.finditer(self.string)):
+            if count and i >= count:
+                break
+            strings.append(self.string[start:match.start()])
+            backrefs.extend(self.backrefs[start:match.start()])
+            if new:
+                if not self.string:
+                    raise ValueError('Cannot insert characters into an empty DnmStr')
+                strings.append(new)
+                backrefs.extend([self.backrefs[min(match.start(), len(self.string) - 1)]] * len(new))
+            start = match.end()
+        if not strings:
+            return self   # nothing was replaced
+        strings.append(self.string[start:])
+        backrefs.extend(self.backrefs[start:])
+        return DnmStr(string=''.join(strings), backrefs=memoryview(backrefs), dnm=self.dnm)
+
+
+_space_regex = re.compile(r'\s+')      # \s matches exactly the characters for which str.isspace() is true
+_space_run_regex = re.compile(r'\s\s+')
 
 
 DEFAULT_DNM_CONFIG = DnmConfig(nodes_to_skip={'head', 'figure'},
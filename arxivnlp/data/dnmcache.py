@@ -0,0 +1,157 @@
+"""
+    An (opt-in) on-disk cache for the results of creating a Dnm.
+    A CachedDnm contains the string of a Dnm and the information needed to map offsets back to the tree.
+    The tree is only loaded if this information is actually used.
+"""
+
+import array
+import bisect
+import re
+from pathlib import Path
+from typing import Callable, Optional, Dict, Any, Union, List
+
+from lxml.etree import _Element, _ElementTree
+
+from .cached import MappedCachedData
+from .dnm import Dnm, DnmConfig, DnmPoint, StringToken, NodeToken
+from .mapped import Section
+from ..config import Config
+
+# changes in the way the Dnm is created have to increase the version
+DNM_CACHE_VERSION = 1
+
+TEXT_TOKEN = 0
+TAIL_TOKEN = 1
+NODE_TOKEN = 2
+
+
+class CachedDnm(object):
+    def __init__(self, string: str, token_starts: Union[array.array, memoryview],
+                 token_kinds: Union[array.array, memoryview], token_nodes: Union[array.array, memoryview],
+                 dnm_config: DnmConfig, load_tree: Callable[[], _ElementTree]):
+        """
+            The tokens are described by
+              * token_starts: the offset of the token in the string (plus the length of the string at the end)
+              * token_kinds: TEXT_TOKEN, TAIL_TOKEN or NODE_TOKEN
+              * token_nodes: the node that the token refers to (position in tree.iter())
+        """
+        self.string = string
+        self.token_starts = token_starts
+        self.token_kinds = token_kinds
+        self.token_nodes = token_nodes
+        self.dnm_config = dnm_config
+        self._load_tree = load_tree
+        self._tree: Optional[_ElementTree] = None
+        self._nodes: Optional[List[_Element]] = None
+        self._dnm: Optional[Dnm] = None
+
+    @classmethod
+    def from_dnm(cls, dnm: Dnm) -> 'CachedDnm':
+        node_numbers = {node: i for i, node in enumerate(dnm.tree.iter())}
+        token_kinds = array.array('B')
+        token_nodes = array.array('q')
+        for token in dnm.tokens:
+            if isinstance(token, StringToken):
+                token_kinds.append(TEXT_TOKEN if token.backref_type == 'text' else TAIL_TOKEN)
+            else:
+                assert isinstance(token, NodeToken)
+                token_kinds.append(NODE_TOKEN)
+            token_nodes.append(node_numbers[token.backref_node])
+        cached = cls(dnm.string, dnm.token_starts, token_kinds, token_nodes, dnm.dnm_config, lambda: dnm.tree)
+        cached._dnm = dnm
+        return cached
+
+    def to_sections(self) -> Dict[str, Section]:
+        return {'string': self.string.encode('utf-8'), 'token_starts': self.token_starts,
+                'token_kinds': self.token_kinds, 'token_nodes': self.token_nodes}
+
+    @classmethod
+    def from_sections(cls, sections: Dict[str, Any], dnm_config: DnmConfig,
+                      load_tree: Callable[[], _ElementTree]) -> 'CachedDnm':
+        return cls(str(sections['string'], 'utf-8'), sections['token_starts'], sections['token_kinds'],
+                   sections['token_nodes'], dnm_config, load_tree)
+
+    def __len__(self) -> int:
+        return len(self.string)
+
+    @property
+    def tree(self) -> _ElementTree:
+        """ The tree of the document (loaded on first use) """
+        if self._tree is None:
+            self._tree = self._load_tree()
+        return self._tree
+
+    @property
+    def dnm(self) -> Dnm:
+        """ A complete Dnm for the document (created on first use) """
+        if self._dnm is None:
+            self._dnm = Dnm(self.tree, self.dnm_config)
+            assert self._dnm.string == self.string, 'The cached Dnm does not match the document'
+        return self._dnm
+
+    def _get_node(self, token: int) -> _Element:
+        if self._nodes is None:
+            self._nodes = list(self.tree.iter())
+        return self._nodes[self.token_nodes[token]]
+
+    def get_token(self, pos: int) -> int:
+        """ Returns the (number of the) token that contains the character at pos """
+        if not 0 <= pos < len(self.string):
+            raise IndexError(pos)
+        return bisect.bisect_right(self.token_starts, pos) - 1
+
+    def get_dnm_point(self, pos: int) -> DnmPoint:
+        token = self.get_token(pos)
+        node = self._get_node(token)
+        kind = self.token_kinds[token]
+        if kind == TEXT_TOKEN:
+            return DnmPoint(node, text_offset=pos - self.token_starts[token])
+        if kind == TAIL_TOKEN:
+            return DnmPoint(node, tail_offset=pos - self.token_starts[token])
+        return DnmPoint(node)
+
+    def get_node(self, pos: int) -> _Element:
+        """ Returns the node that surrounds the character at pos (see Token.get_surrounding_node) """
+        token = self.get_token(pos)
+        node = self._get_node(token)
+        if self.token_kinds[token] == TAIL_TOKEN:
+            parent = node.getparent()
+            assert parent is not None
+            return parent
+        return node
+
+
+class DnmCache(object):
+    """
+        Caches the Dnms of documents by (normalized) arxiv id, DnmConfig and DNM_CACHE_VERSION.
+        Cached Dnms are recreated if one of the files returned by `get_inputs(arxiv_id)` changed.
+    """
+    yymm_regex = re.compile(r'[^0-9]*(?P<yymm>[0-9]{4}).*')
+
+    def __init__(self, config: Config, load_tree: Callable[[str], _ElementTree],
+                 get_inputs: Optional[Callable[[str], List[Path]]] = None):
+        self.config = config
+        self.load_tree = load_tree
+        self.get_inputs = get_inputs
+
+    def _get_cached_data(self, arxiv_id: str, dnm_config: DnmConfig) -> MappedCachedData:
+        match = DnmCache.yymm_regex.match(arxiv_id)
+        yymm = match.group('yymm') if match else 'other'
+        get_inputs = self.get_inputs
+        return MappedCachedData(self.config, arxiv_id, f'dnm-cache/{dnm_config.fingerprint()}/{yymm}',
+                                f'Dnm of {arxiv_id}', version=DNM_CACHE_VERSION,
+                                inputs=(lambda: get_inputs(arxiv_id)) if get_inputs is not None else None)
+
+    def load(self, arxiv_id: str, dnm_config: DnmConfig) -> CachedDnm:
+        """ Loads the CachedDnm from the cache (or creates it from the document and caches it) """
+        cached_data = self._get_cached_data(arxiv_id, dnm_config)
+        if self.config.cache_dir is None:
+            return CachedDnm.from_dnm(Dnm(self.load_tree(arxiv_id), dnm_config))
+        if cached_data.try_load_from_cache():
+            assert cached_data.data is not None
+            return CachedDnm.from_sections(cached_data.data, dnm_config, lambda: self.load_tree(arxiv_id))
+        cached_data.snapshot_inputs()
+        cached = CachedDnm.from_dnm(Dnm(self.load_tree(arxiv_id), dnm_config))
+        cached_data.data = cached.to_sections()
+        cached_data.write_to_cache()
+        return cached
@@ -0,0 +1,274 @@
+import array
+import bisect
+import dataclasses
+import itertools
+import logging
+import re
+import zipfile
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple, Iterator, Sequence
+
+from .cached import ZipFileCache, MappedCachedData
+from .exceptions import MissingDataException
+from .mapped import StringTable, StringList
+from .zipreader import MappedZipFile
+from ..config import Config
+
+
+@dataclasses.dataclass(frozen=True)
+class DocLocation(object):
+    """ Where the html file of a document is stored (paths are relative to the arXMLiv directory) """
+    container: str                  # the html file itself or the zip file containing it
+    member: Optional[str] = None    # name in the zip file (None for plain files)
+    header_offset: int = 0          # offset of the local file header in the zip file
+    compress_type: int = zipfile.ZIP_STORED
+    compress_size: int = 0
+    file_size: int = 0
+
+    @property
+    def in_zip(self) -> bool:
+        return self.member is not None
+
+
+# (arxiv id, member name (file name for plain files), header offset, compress type, compress size, file size)
+Entry = Tuple[str, str, int, int, int, int]
+
+
+class DocIndex(object):
+    """
+        Maps arxiv ids to the physical location of the corresponding html file.
+        The index is stored in the cache and can be updated incrementally: only containers (zip files or yymm
+        directories) whose size or modification time changed are rescanned.
+
+        The index is memory-mapped. It consists of the following sections:
+          * 'ids': the sorted arxiv ids (StringTable) - the position of an id is its document number
+          * 'id_entry': the entry with the location of the document (aligned with 'ids')
+          * 'entry_*': the documents found in each container (entries of container i are
+                       container_entries[i] to container_entries[i+1]-1)
+          * 'container*': the containers (in the order in which ArXMLivDocs.open tries them) and whether they
+                          are zip files
+        The containers are the inputs of the cached index, i.e. changes are detected by comparing their size and
+        modification time.
+    """
+
+    yymm_regex = re.compile(r'^[0-9][0-9][0-9][0-9](\.zip)?$')
+
+    def __init__(self, config: Config, zipfile_cache: Optional[ZipFileCache] = None):
+        self.config = config
+        self.zipfile_cache = zipfile_cache
+        self.index = MappedCachedData(self.config, 'arxmliv-doc-index',
+                                      data_descr='index of arXMLiv document locations', version=1,
+                                      inputs=lambda: [path for _, path in self._containers()])
+        self._tried_loading: bool = False   # avoids retrying to load a missing index on every lookup
+        self._checked: bool = False         # the index is known to be up-to-date
+        self._numbers: Optional[Dict[str, int]] = None   # arxiv id -> document number (for bulk lookups)
+
+    def _get_base(self) -> Path:
+        base = self.config.arxmliv_dir
+        if base is None:
+            raise MissingDataException('ArXMLiv directory not specified in config')
+        return base
+
+    def ensured(self) -> bool:
+        """
+            Loads the index without checking if it is up-to-date
+            (outdated entries are detected by ArXMLivDocs when they are used).
+        """
+        if self.index.data is None and not self._tried_loading:
+            self._tried_loading = True
+            self.index.try_load_from_cache(check_inputs=False)
+        return self.index.data is not None
+
+    def ensure_up_to_date(self):
+        """ Loads the index and updates it if containers changed """
+        if self._checked:
+            return
+        if not (self.ensured() and self.index.is_up_to_date()):
+            self.update()
+        self._checked = True
+
+    def __len__(self) -> int:
+        self.ensure_up_to_date()
+        assert self.index.data is not None
+        return len(self.index.data['ids'])
+
+    def get_doc_number(self, arxiv_id: str) -> Optional[int]:
+        """ Returns the position of the document in the (sorted) list of arxiv ids """
+        if self.index.data is None:
+            return None
+        ids = self.index.data['ids']
+        assert isinstance(ids, StringTable)
+        return ids.index_of(arxiv_id)
+
+    def get_doc_numbers(self, arxiv_ids: Sequence[str], missing: int = -1) -> List[int]:
+        """
+            Returns the document numbers for many ids at once (`missing` for ids that are not in the index).
+            For large queries, a dictionary of all ids is created once instead of doing a binary search per id.
+        """
+        if self.index.data is None:
+            return [missing] * len(arxiv_ids)
+        ids = self.index.data['ids']
+        assert isinstance(ids, StringTable)
+        if self._numbers is None and len(arxiv_ids) * 16 < len(ids):
+            numbers = []
+            for arxiv_id in arxiv_ids:
+                number = ids.index_of(arxiv_id)
+                numbers.append(missing if number is None else number)
+            return numbers
+        if self._numbers is None:
+            self._numbers = {arxiv_id: number for number, arxiv_id in enumerate(ids)}
+        return list(map(self._numbers.get, arxiv_ids, itertools.repeat(missing)))
+
+    def group_by_container(self, arxiv_ids: Sequence[str]) -> List[Tuple[Optional[str], List[str]]]:
+        """
+            Groups the ids by container (in the order of the index) and sorts each group by the position of the
+            documents in the container. Ids that are not in the index are returned last with container None.
+        """
+        if not self.ensured():
+            return [(None, list(arxiv_ids))] if arxiv_ids else []
+        data = self.index.data
+        assert data is not None
+        id_entry = data['id_entry']
+        header_offsets = data['entry_header_offset']
+        container_entries = data['container_entries']
+        located: List[Tuple[int, int, int, str]] = []
+        missing: List[str] = []
+        for arxiv_id, number in zip(arxiv_ids, self.get_doc_numbers(arxiv_ids)):
+            if number < 0:
+                missing.append(arxiv_id)
+                continue
+            entry = id_entry[number]
+            container = bisect.bisect_right(container_entries, entry) - 1
+            located.append((container, header_offsets[entry], entry, arxiv_id))
+        located.sort()
+        groups: List[Tuple[Optional[str], List[str]]] = []
+        for container, items in itertools.groupby(located, key=lambda item: item[0]):
+            groups.append((data['containers'][container], [item[3] for item in items]))
+        if missing:
+            groups.append((None, missing))
+        return groups
+
+    def get_ids(self) -> StringTable:
+        """ Returns the (memory-mapped) table of arxiv ids - the position of an id is its document number """
+        self.ensure_up_to_date()
+        assert self.index.data is not None
+        ids = self.index.data['ids']
+        assert isinstance(ids, StringTable)
+        return ids
+
+    def get(self, arxiv_id: str) -> Optional[DocLocation]:
+        """ Returns the location of the document (if the index is loaded and contains it) """
+        number = self.get_doc_number(arxiv_id)
+        if number is None:
+            return None
+        assert self.index.data is not None
+        return self._get_location(self.index.data['id_entry'][number])
+
+    def _get_location(self, entry: int) -> DocLocation:
+        data = self.index.data
+        assert data is not None
+        container = bisect.bisect_right(data['container_entries'], entry) - 1
+        container_name = data['containers'][container]
+        member = data['entry_member'][entry]
+        if not data['container_is_zip'][container]:
+            return DocLocation(container=str(Path(container_name) / member))
+        return DocLocation(container=container_name, member=member, header_offset=data['entry_header_offset'][entry],
+                           compress_type=data['entry_compress_type'][entry],
+                           compress_size=data['entry_compress_size'][entry], file_size=data['entry_file_size'][entry])
+
+    def arxiv_ids(self) -> List[str]:
+        """ Returns the sorted list of arxiv ids """
+        self.ensure_up_to_date()
+        assert self.index.data is not None
+        return list(self.index.data['ids'])
+
+    def _containers(self) -> Iterator[Tuple[str, Path]]:
+        """ Yields the containers in the order in which they are tried by ArXMLivDocs.open """
+        base = self._get_base()
+        directories = [base, base / 'data']
+        yymm_dirs: List[Path] = []
+        yymm_zips: List[Path] = []
+        for directory in directories:
+            if not directory.is_dir():
+                continue
+            yield str(directory.relative_to(base)), directory   # plain html files directly in the directory
+            for path in sorted(directory.iterdir()):
+                if self.yymm_regex.match(path.name):
+                    (yymm_zips if path.name.endswith('.zip') else yymm_dirs).append(path)
+        for path in yymm_dirs + yymm_zips:
+            yield str(path.relative_to(base)), path
+
+    def _scan_container(self, path: Path) -> Iterator[Entry]:
+        if path.is_dir():
+            for file in path.iterdir():
+                if file.name.endswith('.html'):
+                    yield file.name[:-5], file.name, 0, zipfile.ZIP_STORED, 0, 0
+        elif path.is_file():
+            if self.zipfile_cache is not None:
+                with self.zipfile_cache.mapped(path) as archive:
+                    members = archive.members
+            else:
+                archive = MappedZipFile(path)
+                members = archive.members
+                archive.close()
+            for member, (header_offset, compress_type, compress_size, file_size) in members.items():
+                if member.endswith('.html'):
+                    yield member.split('/')[-1][:-5], member, header_offset, compress_type, compress_size, file_size
+
+    def _get_old_entries(self) -> Dict[str, List[Entry]]:
+        """ container -> entries for the currently loaded index """
+        data = self.index.data
+        if data is None:
+            return {}
+        result: Dict[str, List[Entry]] = {}
+        columns = [data['entry_ids'], data['entry_member'], data['entry_header_offset'], data['entry_compress_type'],
+                   data['entry_compress_size'], data['entry_file_size']]
+        container_entries = data['container_entries']
+        for i, container in enumerate(data['containers']):
+            start, end = container_entries[i], container_entries[i + 1]
+            result[container] = list(zip(*(column[start:end] for column in columns)))
+        return result
+
+    def update(self):
+        """ Creates the index or updates it for containers that changed """
+        logger = logging.getLogger(__name__)
+        self.ensured()
+        changed = self.index.changed_inputs() if self.index.data is not None else None
+        old_entries = self._get_old_entries() if changed is not None else {}
+        self.index.snapshot_inputs()
+        containers: List[str] = []
+        is_zip = array.array('B')
+        container_entries = array.array('q', [0])
+        entries: List[Entry] = []
+        rescanned = 0
+        for name, path in self._containers():
+            if changed is not None and name in old_entries and path not in changed:
+                entries.extend(old_entries[name])
+            else:
+                rescanned += 1
+                entries.extend(self._scan_container(path))
+            containers.append(name)
+            is_zip.append(path.is_file())
+            container_entries.append(len(entries))
+
+        winners: Dict[str, int] = {}
+        for i, entry in enumerate(entries):
+            winners.setdefault(entry[0], i)
+        ids = sorted(winners)
+        logger.info(f'Indexed {len(ids)} documents ({rescanned} of {len(containers)} containers were scanned)')
+        self.index.data = {
+            'ids': StringTable.from_strings(ids),
+            'id_entry': array.array('q', (winners[arxiv_id] for arxiv_id in ids)),
+            'entry_ids': StringList.from_strings(entry[0] for entry in entries),
+            'entry_member': StringList.from_strings(entry[1] for entry in entries),
+            'entry_header_offset': array.array('q', (entry[2] for entry in entries)),
+            'entry_compress_type': array.array('B', (entry[3] for entry in entries)),
+            'entry_compress_size': array.array('q', (entry[4] for entry in entries)),
+            'entry_file_size': array.array('q', (entry[5] for entry in entries)),
+            'containers': StringList.from_strings(containers),
+            'container_is_zip': is_zip,
+            'container_entries': container_entries,
+        }
+        self._numbers = None
+        self.index.write_to_cache()
+        self._checked = True
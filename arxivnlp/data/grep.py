@@ -0,0 +1,112 @@
+"""
+    Searching documents for substrings or regular expressions without decoding them.
+    The patterns are encoded (utf-8) once and the raw html is searched - for deflated zip members, the document is
+    inflated incrementally and the search stops as soon as the result is known.
+"""
+
+import logging
+import re
+from typing import Iterable, Union, Optional, List, Set, Iterator, Tuple, FrozenSet, Dict
+
+from .arxmlivdocs import ArXMLivDocs
+from .datamanager import DataManager, WorkerPool
+from .exceptions import MissingDataException
+
+Buffer = Union[bytes, memoryview]
+
+
+class BytesGrep(object):
+    def __init__(self, patterns: Iterable[Union[str, bytes]], regex: bool = False, require_all: bool = False,
+                 max_match_length: Optional[int] = None):
+        """
+            A document matches if it contains any (or all if `require_all` is set) of the patterns.
+            If `regex` is set, the patterns are regular expressions (over bytes).
+            Streamed documents are searched chunk by chunk, which requires knowing how long a match can be
+            (`max_match_length`, which is inferred for substrings). Without it, regexes are only applied to
+            complete documents.
+        """
+        self.patterns: List[bytes] = [p.encode('utf-8') if isinstance(p, str) else p for p in patterns]
+        assert self.patterns, 'No patterns were provided'
+        self.regex = regex
+        self.require_all = require_all
+        if not regex:
+            max_match_length = max(len(p) for p in self.patterns)
+        self.max_match_length = max_match_length
+        self._regexes: Dict[FrozenSet[int], re.Pattern] = {}
+
+    def _get_regex(self, remaining: FrozenSet[int]) -> re.Pattern:
+        """ A regex that matches any of the remaining patterns (the group name tells which one matched) """
+        if remaining not in self._regexes:
+            self._regexes[remaining] = re.compile(b'|'.join(
+                b'(?P<p%d>%s)' % (i, self.patterns[i] if self.regex else re.escape(self.patterns[i]))
+                for i in sorted(remaining)))
+        return self._regexes[remaining]
+
+    def _is_done(self, found: Set[int]) -> bool:
+        return len(found) == len(self.patterns) if self.require_all else bool(found)
+
+    def find_patterns(self, data: Buffer, found: Optional[Set[int]] = None) -> Set[int]:
+        """ Returns the (indices of the) patterns that occur in data (stops once the result is known) """
+        found = set() if found is None else found
+        pos = 0
+        while not self._is_done(found):
+            match = self._get_regex(frozenset(range(len(self.patterns))) - found).search(data, pos)
+            if match is None:
+                break
+            assert match.lastgroup is not None
+            found.add(int(match.lastgroup[1:]))
+            pos = match.start()   # other patterns might match at the same position
+        return found
+
+    def matches(self, data: Buffer) -> bool:
+        return self._is_done(self.find_patterns(data))
+
+    def matches_chunks(self, chunks: Iterable[Buffer]) -> bool:
+        """ Like matches, but for a document that is streamed (the remaining chunks are not requested after a hit) """
+        if self.max_match_length is None:
+            return self.matches(b''.join(chunks))
+        overlap = max(self.max_match_length - 1, 0)
+        found: Set[int] = set()
+        tail = b''
+        for chunk in chunks:
+            buffer = tail + chunk if tail else chunk
+            self.find_patterns(buffer, found)
+            if self._is_done(found):
+                return True
+            tail = bytes(buffer[max(len(buffer) - overlap, 0):]) if overlap else b''
+        return False
+
+
+def _grep(arxmliv_docs: ArXMLivDocs, batch: List[str], grep: BytesGrep) -> List[Tuple[str, Optional[bool]]]:
+    results: List[Tuple[str, Optional[bool]]] = []
+    for arxiv_id in batch:
+        try:
+            results.append((arxiv_id, grep.matches_chunks(arxmliv_docs.iter_chunks(arxiv_id))))
+        except MissingDataException as e:
+            logger = logging.getLogger(__name__)
+            logger.warning(f'Skipping {arxiv_id}: {e}')
+            results.append((arxiv_id, None))
+    return results
+
+
+def _grep_batch(task: Tuple[List[str], BytesGrep]) -> List[Tuple[str, Optional[bool]]]:
+    return _grep(DataManager.get().arxmliv_docs, *task)
+
+
+def grep_documents(data_manager: DataManager, grep: BytesGrep, arxiv_ids: Iterable[str],
+                   pool: Optional[WorkerPool] = None, batch_size: int = 64) -> Iterator[str]:
+    """
+        Yields the (normalized) ids of the matching documents.
+        The documents are processed in the order in which they are stored (see DataManager.iter_documents)
+        and, if a pool is provided, in parallel.
+        Missing documents are skipped.
+    """
+    batches = data_manager.arxmliv_docs.get_batches(arxiv_ids, batch_size)
+    if pool is not None:
+        results: Iterable[List[Tuple[str, Optional[bool]]]] = pool.imap(_grep_batch, [(b, grep) for b in batches])
+    else:
+        results = (_grep(data_manager.arxmliv_docs, batch, grep) for batch in batches)
+    for batch_results in results:
+        for arxiv_id, matched in batch_results:
+            if matched:
+                yield arxiv_id
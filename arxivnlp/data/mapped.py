@@ -0,0 +1,242 @@
+"""
+    Data structures that can be stored uncompressed and loaded with mmap (see MappedCachedData).
+    Lookups work directly on the mapped file, i.e. the data does not have to be loaded completely.
+
+    Supported sections:
+      * array.array (or memoryviews of the same type)
+      * StringList/StringTable (a sorted StringList that supports lookups via binary search)
+      * CsrMap (maps integers to sequences of integers)
+"""
+
+import array
+import bisect
+import json
+import mmap
+import os
+import sys
+from pathlib import Path
+from typing import Sequence, Iterable, Iterator, Optional, Dict, Union, List, Tuple, Any, overload
+
+Ints = Union[array.array, memoryview]
+
+
+class StringList(Sequence[str]):
+    """ A list of strings stored as utf-8 encoded blob with an offset array """
+    def __init__(self, offsets: Ints, blob: Union[bytes, memoryview]):
+        assert len(offsets) >= 1
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]) -> 'StringList':
+        offsets = array.array('q', [0])
+        parts: List[bytes] = []
+        length = 0
+        for string in strings:
+            encoded = string.encode('utf-8')
+            parts.append(encoded)
+            length += len(encoded)
+            offsets.append(length)
+        return cls(offsets, b''.join(parts))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def get_bytes(self, index: int) -> bytes:
+        return bytes(self.blob[self.offsets[index]:self.offsets[index + 1]])
+
+    @overload
+    def __getitem__(self, index: int) -> str: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[str]: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return str(self.blob[self.offsets[index]:self.offsets[index + 1]], 'utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        if not len(self):
+            return
+        # decoding everything at once is much faster than decoding the strings one by one
+        offsets = self.offsets
+        text = bytes(self.blob[offsets[0]:offsets[len(self)]])
+        start = 0
+        for i in range(1, len(offsets)):
+            end = offsets[i]
+            yield str(text[start:end], 'utf-8')
+            start = end
+
+
+class _BytesKeys(Sequence[bytes]):
+    """ Allows bisect to work on the raw bytes of a StringTable """
+    def __init__(self, table: 'StringList'):
+        self.table = table
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def __getitem__(self, index):
+        return self.table.get_bytes(index)
+
+
+class StringTable(StringList):
+    """ A sorted list of unique strings - the position of a string can be found with binary search """
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]) -> 'StringTable':
+        # for utf-8, the byte order corresponds to the code point order
+        table = StringList.from_strings(sorted(set(strings)))
+        return cls(table.offsets, table.blob)
+
+    def index_of(self, string: str) -> Optional[int]:
+        """ Returns the position of the string (or None if it is not in the table) """
+        key = string.encode('utf-8')
+        keys = _BytesKeys(self)
+        pos = bisect.bisect_left(keys, key)
+        if pos < len(self) and keys[pos] == key:
+            return pos
+        return None
+
+    def __contains__(self, string: object) -> bool:
+        return isinstance(string, str) and self.index_of(string) is not None
+
+
+class CsrMap(Sequence[Ints]):
+    """ Maps i (0 <= i < len) to a sequence of integers (compressed sparse row format) """
+    def __init__(self, indptr: Ints, indices: Ints):
+        assert len(indptr) >= 1
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_lists(cls, rows: Iterable[Iterable[int]], typecode: str = 'i') -> 'CsrMap':
+        indptr = array.array('q', [0])
+        indices = array.array(typecode)
+        for row in rows:
+            indices.extend(row)
+            indptr.append(len(indices))
+        return cls(indptr, indices)
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.indices[self.indptr[index]:self.indptr[index + 1]]
+
+
+Section = Union[array.array, memoryview, bytes, StringList, CsrMap]
+
+_MAGIC = b'ARXNLPM1'
+_ALIGNMENT = 8
+
+
+def _get_parts(section: Section) -> Tuple[str, Dict[str, Any]]:
+    """ splits a section into buffers """
+    if isinstance(section, StringList):
+        return ('stringtable' if isinstance(section, StringTable) else 'stringlist',
+                {'offsets': section.offsets, 'blob': section.blob})
+    if isinstance(section, CsrMap):
+        return 'csr', {'indptr': section.indptr, 'indices': section.indices}
+    if isinstance(section, (array.array, memoryview)):
+        return 'array', {'data': section}
+    if isinstance(section, bytes):
+        return 'bytes', {'data': section}
+    raise TypeError(f'Unsupported section type {type(section)}')
+
+
+def _typecode(buffer: Any) -> str:
+    if isinstance(buffer, array.array):
+        return buffer.typecode
+    if isinstance(buffer, memoryview):
+        return buffer.format
+    return 'B'
+
+
+def write_sections(path: Path, sections: Dict[str, Section]):
+    """ Writes the sections to a file (atomically - the file is replaced at the end) """
+    header: Dict[str, Any] = {'byteorder': sys.byteorder, 'sections': {}}
+    buffers: List[Tuple[int, Any]] = []
+    offset = 0
+    for name, section in sections.items():
+        kind, parts = _get_parts(section)
+        part_descrs = {}
+        for part_name, buffer in parts.items():
+            view = memoryview(buffer)
+            part_descrs[part_name] = [offset, view.nbytes, _typecode(buffer), view.itemsize]
+            buffers.append((offset, view))
+            offset += (view.nbytes + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+        header['sections'][name] = {'kind': kind, 'parts': part_descrs}
+    encoded_header = json.dumps(header).encode('utf-8')
+    data_start = (len(_MAGIC) + 8 + len(encoded_header) + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+    tmp_path = path.parent / f'.{path.name}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as fp:
+            fp.write(_MAGIC)
+            fp.write(len(encoded_header).to_bytes(8, 'little'))
+            fp.write(encoded_header)
+            for part_offset, view in buffers:
+                fp.seek(data_start + part_offset)
+                fp.write(view)
+            fp.truncate(data_start + offset)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+class MappedSections(Dict[str, Section]):
+    """ The sections of a memory-mapped file (the file is unmapped once no section is referenced anymore) """
+    pass
+
+
+def read_sections(path: Path) -> MappedSections:
+    with open(path, 'rb') as fp:
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(_MAGIC)] != _MAGIC:
+        raise ValueError(f'{path} is not a file with mapped sections')
+    header_length = int.from_bytes(mapped[len(_MAGIC):len(_MAGIC) + 8], 'little')
+    header_start = len(_MAGIC) + 8
+    header = json.loads(mapped[header_start:header_start + header_length].decode('utf-8'))
+    if header['byteorder'] != sys.byteorder:
+        raise ValueError(f'{path} was written on a machine with a different byte order')
+    data_start = (header_start + header_length + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+    view = memoryview(mapped)
+
+    def get_part(descr: List) -> memoryview:
+        part_offset, nbytes, typecode, itemsize = descr
+        part = view[data_start + part_offset:data_start + part_offset + nbytes]
+        if typecode == 'B':
+            return part
+        if array.array(typecode).itemsize != itemsize:
+            raise ValueError(f'Item size of type {typecode} differs from {path}')
+        return part.cast(typecode)
+
+    sections = MappedSections()
+    for name, section in header['sections'].items():
+        parts = {part_name: get_part(descr) for part_name, descr in section['parts'].items()}
+        kind = section['kind']
+        if kind == 'stringtable':
+            sections[name] = StringTable(parts['offsets'], parts['blob'])
+        elif kind == 'stringlist':
+            sections[name] = StringList(parts['offsets'], parts['blob'])
+        elif kind == 'csr':
+            sections[name] = CsrMap(parts['indptr'], parts['indices'])
+        elif kind == 'array':
+            sections[name] = parts['data']
+        elif kind == 'bytes':
+            sections[name] = parts['data']
+        else:
+            raise ValueError(f'Unknown section type {kind} in {path}')
+    return sections
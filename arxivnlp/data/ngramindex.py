@@ -0,0 +1,215 @@
+"""
+    An inverted index for finding candidate documents without scanning the corpus.
+
+    The indexed terms of a document are
+      * the trigrams of its DNM string (see DEFAULT_DNM_CONFIG),
+      * the (LaTeXML) class names of its nodes and
+      * the TeX control sequences in the alttext of its formulae.
+    There is one segment per container of the document index (i.e. per zip file or yymm directory), which allows
+    updating the index incrementally. Each segment is memory-mapped and consists of the following sections:
+      * 'ids': the (sorted) arxiv ids of the documents in the segment
+      * 'terms': the sorted terms (the first character indicates the kind of term: 't', 'c' or 'x')
+      * 'postings': the document numbers (positions in 'ids') for each term, delta- and varint-encoded
+      * 'postings_offsets': the start of the postings of each term in 'postings'
+"""
+
+import array
+import hashlib
+import itertools
+import logging
+import re
+from typing import List, Set, Iterable, Optional, Any, Dict, Tuple
+
+from lxml import etree
+
+from .arxmlivdocs import ArXMLivDocs
+from .cached import MappedCachedData
+from .datamanager import DataManager, WorkerPool
+from .dnm import Dnm, DEFAULT_DNM_CONFIG
+from .mapped import StringTable
+
+TEXT_TERM = 't'
+CLASS_TERM = 'c'
+TEX_TERM = 'x'
+
+_tex_token_regex = re.compile(r'\\[a-zA-Z]+|\\[^a-zA-Z]')
+
+
+def encode_postings(numbers: Iterable[int]) -> bytes:
+    """ Encodes an ascending sequence of integers (delta encoding, then LEB128 varints) """
+    result = bytearray()
+    previous = 0
+    for number in numbers:
+        delta = number - previous
+        assert delta >= 0
+        previous = number
+        while delta >= 0x80:
+            result.append((delta & 0x7F) | 0x80)
+            delta >>= 7
+        result.append(delta)
+    return bytes(result)
+
+
+def decode_postings(data: Iterable[int]) -> List[int]:
+    numbers: List[int] = []
+    value = 0
+    shift = 0
+    previous = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        previous += value
+        numbers.append(previous)
+        value = 0
+        shift = 0
+    return numbers
+
+
+def get_text_terms(string: str) -> Set[str]:
+    return {TEXT_TERM + string[i:i + 3] for i in range(len(string) - 2)}
+
+
+def get_tex_terms(tex: str) -> Set[str]:
+    return {TEX_TERM + token for token in _tex_token_regex.findall(tex)}
+
+
+def get_terms(tree: Any) -> List[str]:
+    """ Returns the terms of a parsed document """
+    terms = get_text_terms(Dnm(tree, DEFAULT_DNM_CONFIG).string)
+    for classes in tree.xpath('//@class'):
+        terms.update(CLASS_TERM + cls for cls in classes.split())
+    for alttext in tree.xpath('//math/@alttext'):
+        terms.update(get_tex_terms(alttext))
+    return sorted(terms)
+
+
+def _get_document_terms(arxiv_id: str, data: Any) -> List[str]:
+    logger = logging.getLogger(__name__)
+    try:
+        root = etree.fromstring(bytes(data), DataManager.html_bytes_parser)
+    except etree.XMLSyntaxError as e:
+        logger.warning(f'Failed to parse {arxiv_id}: {e}')
+        return []
+    if root is None:
+        logger.warning(f'{arxiv_id} is empty')
+        return []
+    return get_terms(root.getroottree())
+
+
+def _get_batch_terms(arxmliv_docs: ArXMLivDocs, batch: List[str]) -> List[Tuple[str, List[str]]]:
+    """ Documents that cannot be read are logged and indexed without terms """
+    results: List[Tuple[str, List[str]]] = []
+    for arxiv_id in batch:
+        try:
+            data = arxmliv_docs.read_bytes(arxiv_id)
+        except Exception as e:   # e.g. MissingDataException, StaleLocation, BadZipFile or zlib.error
+            logger = logging.getLogger(__name__)
+            logger.warning(f'Skipping {arxiv_id}: {e}')
+            results.append((arxiv_id, []))
+            continue
+        results.append((arxiv_id, _get_document_terms(arxiv_id, data)))
+    return results
+
+
+def _get_batch_terms_in_worker(batch: List[str]) -> List[Tuple[str, List[str]]]:
+    return _get_batch_terms(DataManager.get().arxmliv_docs, batch)
+
+
+class NgramIndex(object):
+    def __init__(self, data_manager: DataManager):
+        self.data_manager = data_manager
+        self.config = data_manager.config
+        self.doc_index = data_manager.arxmliv_docs.doc_index
+        self._segments: Dict[str, MappedCachedData] = {}
+
+    def _get_segment(self, container: str) -> MappedCachedData:
+        if container not in self._segments:
+            assert self.config.arxmliv_dir is not None
+            path = self.config.arxmliv_dir / container
+            stem = re.sub(r'[^A-Za-z0-9]+', '_', container).strip('_') or 'base'
+            name = f'{stem}-{hashlib.md5(container.encode("utf-8")).hexdigest()[:12]}'
+            self._segments[container] = MappedCachedData(self.config, name, 'ngram-index',
+                                                         f'n-gram index of {container}', version=1,
+                                                         inputs=lambda: [path])
+        return self._segments[container]
+
+    def _get_containers(self) -> List[Tuple[str, List[str]]]:
+        return [(container, ids) for container, ids in self.doc_index.group_by_container(self.doc_index.get_ids())
+                if container is not None]
+
+    def update(self, pool: Optional[WorkerPool] = None, batch_size: int = 16):
+        """ Creates the segments for containers that changed since the last update """
+        logger = logging.getLogger(__name__)
+        for container, arxiv_ids in self._get_containers():
+            segment = self._get_segment(container)
+            if segment.config.cache_dir is not None and segment.is_up_to_date():
+                continue
+            logger.info(f'Indexing {len(arxiv_ids)} documents in {container}')
+            segment.snapshot_inputs()
+            ids = StringTable.from_strings(arxiv_ids)
+            postings: Dict[str, List[int]] = {}
+            batches = self.data_manager.arxmliv_docs.get_batches(arxiv_ids, batch_size)
+            if pool is not None:
+                results: Iterable[List[Tuple[str, List[str]]]] = pool.imap(_get_batch_terms_in_worker, batches)
+            else:
+                results = (_get_batch_terms(self.data_manager.arxmliv_docs, batch) for batch in batches)
+            for arxiv_id, terms in itertools.chain.from_iterable(results):
+                number = ids.index_of(arxiv_id)
+                for term in terms:
+                    postings.setdefault(term, []).append(number)   # type: ignore
+            terms = StringTable.from_strings(postings)
+            offsets = array.array('q', [0])
+            encoded: List[bytes] = []
+            length = 0
+            for term in terms:
+                data = encode_postings(sorted(postings[term]))
+                encoded.append(data)
+                length += len(data)
+                offsets.append(length)
+            segment.data = {'ids': ids, 'terms': terms, 'postings': b''.join(encoded), 'postings_offsets': offsets}
+            segment.write_to_cache()
+
+    def _query_segment(self, segment: Dict, terms: Set[str]) -> List[str]:
+        positions: List[int] = []
+        for term in terms:
+            pos = segment['terms'].index_of(term)
+            if pos is None:
+                return []
+            positions.append(pos)
+        offsets = segment['postings_offsets']
+        positions.sort(key=lambda pos: offsets[pos + 1] - offsets[pos])   # start with the shortest postings
+        matches: Optional[Set[int]] = None
+        for pos in positions:
+            postings = decode_postings(segment['postings'][offsets[pos]:offsets[pos + 1]])
+            matches = set(postings) if matches is None else matches.intersection(postings)
+            if not matches:
+                return []
+        ids = segment['ids']
+        return [ids[i] for i in sorted(matches)] if matches is not None else list(ids)
+
+    def query(self, text: Iterable[str] = (), classes: Iterable[str] = (), tex: Iterable[str] = ()) -> List[str]:
+        """
+            Returns the (sorted) ids of the documents that contain all of the specified
+              * substrings in their DNM string (substrings with less than 3 characters are ignored),
+              * class names and
+              * TeX control sequences in their formulae (e.g. a query for '\\si{' finds documents using \\si).
+            The substrings are only checked via their trigrams, i.e. the result can contain documents that contain
+            the trigrams, but not the substring itself.
+        """
+        logger = logging.getLogger(__name__)
+        terms: Set[str] = set()
+        for string in text:
+            terms.update(get_text_terms(string))
+        terms.update(CLASS_TERM + cls for cls in classes)
+        for string in tex:
+            terms.update(get_tex_terms(string))
+        result: List[str] = []
+        for container, _ in self._get_containers():
+            segment = self._get_segment(container)
+            if not segment.ensured(check_inputs=False):
+                logger.warning(f'No n-gram index for {container} - run "update-ngram-index" first')
+                continue
+            result.extend(self._query_segment(segment.data, terms))   # type: ignore
+        return sorted(result)
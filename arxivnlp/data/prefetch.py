@@ -0,0 +1,71 @@
+"""
+    Reads documents on background threads while the current document is processed.
+    Reading memory-mapped zip members, inflating them and parsing them with lxml release the GIL, i.e. the I/O and
+    decompression of the next documents overlap with the (Python) processing of the current one.
+"""
+
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterable, Iterator, Tuple, Any, Deque, Optional
+
+from lxml import etree
+
+from .arxmlivdocs import ArXMLivDocs
+
+
+class Prefetcher(object):
+    def __init__(self, arxmliv_docs: ArXMLivDocs, arxiv_ids: Iterable[str], depth: int = 8,
+                 max_bytes: int = 256 * 2**20, threads: int = 2, parse: bool = False):
+        """
+            Yields (arxiv id, content) in the order of `arxiv_ids`, where the content is the raw html or the parsed
+            tree (if `parse` is set).
+            At most `depth` documents are read ahead. Fewer documents are read ahead if the documents that have
+            been read already take up more than `max_bytes` bytes.
+            Errors (e.g. missing documents) are raised when the document is reached.
+        """
+        assert depth >= 1 and threads >= 1
+        self.arxmliv_docs = arxmliv_docs
+        self.arxiv_ids = arxiv_ids
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.threads = threads
+        self.parse = parse
+        self._local = threading.local()   # lxml parsers must not be shared between threads
+
+    def _read(self, arxiv_id: str) -> Tuple[Any, int]:
+        data = self.arxmliv_docs.read_bytes(arxiv_id)
+        size = len(data)
+        if not self.parse:
+            return data, size
+        parser: Optional[Any] = getattr(self._local, 'parser', None)
+        if parser is None:
+            parser = etree.HTMLParser(encoding='utf-8')
+            self._local.parser = parser
+        return etree.fromstring(bytes(data), parser).getroottree(), size
+
+    @staticmethod
+    def _buffered_bytes(pending: Deque[Tuple[str, Future]]) -> int:
+        return sum(future.result()[1] for _, future in pending if future.done() and future.exception() is None)
+
+    def __iter__(self) -> Iterator[Tuple[str, Any]]:
+        ids = iter(self.arxiv_ids)
+        pending: Deque[Tuple[str, Future]] = collections.deque()
+        executor = ThreadPoolExecutor(self.threads, thread_name_prefix='prefetch')
+
+        def fill():
+            while len(pending) < self.depth and (not pending or Prefetcher._buffered_bytes(pending) < self.max_bytes):
+                arxiv_id = next(ids, None)
+                if arxiv_id is None:
+                    return
+                pending.append((arxiv_id, executor.submit(self._read, arxiv_id)))
+
+        try:
+            fill()
+            while pending:
+                arxiv_id, future = pending.popleft()
+                content, _ = future.result()
+                fill()
+                yield arxiv_id, content
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,228 @@
+"""
+    Runs a function over (a large part of) the corpus in parallel.
+    Interrupted runs can be resumed: the results are written to shards in an output directory and a checkpoint
+    file records which documents have been processed and how much of the shards is valid.
+
+    Layout of the output directory:
+      * results-NNNNN.txt: one line per result (documents for which the function returned None have no line)
+      * errors-NNNNN.jsonl: the errors (with traceback) that occurred when processing documents
+      * checkpoint.jsonl: one line per commit (shard number, valid size of the shard files, processed ids)
+"""
+
+import dataclasses
+import json
+import logging
+import os
+import re
+import time
+import traceback
+from pathlib import Path
+from typing import Callable, Any, Optional, Iterable, List, Tuple, Dict, Set, Iterator, IO
+
+from .arxmlivdocs import ArXMLivDocs
+from .datamanager import DataManager
+from ..utils import StatusLine, StatusBar
+
+# (arxiv id, result, error)
+DocResult = Tuple[str, Optional[str], Optional[Dict[str, str]]]
+
+
+@dataclasses.dataclass
+class RunSummary(object):
+    processed: int = 0
+    errors: int = 0
+    skipped: int = 0      # processed in earlier runs
+
+
+class RunnerStatus(StatusLine):
+    def __init__(self, total_docs: int):
+        StatusLine.__init__(self, 120)
+        self.total_docs = total_docs
+        self.processed_docs = 0
+        self.errors = 0
+        self.start_time = time.time()
+        self.status_bar = StatusBar(30, with_time=True)
+
+    def update_string(self):
+        self.status_bar.set(self.processed_docs / self.total_docs if self.total_docs else 1.0)
+        rate = self.processed_docs / max(time.time() - self.start_time, 1e-3)
+        self.string = f'{str(self.status_bar)}    {self.processed_docs}/{self.total_docs}, ' \
+                      f'{rate:.1f} docs/s, {self.errors} errors'
+
+
+def _run_batch(task: Tuple[List[str], Callable[[str, Any], Optional[str]], bool]) -> List[DocResult]:
+    batch, function, parse = task
+    data_manager = DataManager.get()
+    results: List[DocResult] = []
+    for arxiv_id in batch:
+        try:
+            data = data_manager.arxmliv_docs.read_bytes(arxiv_id)
+            results.append((arxiv_id, function(arxiv_id, data_manager.parse_html(data) if parse else data), None))
+        except Exception as e:
+            results.append((arxiv_id, None, {'id': arxiv_id, 'error': repr(e), 'traceback': traceback.format_exc()}))
+    return results
+
+
+class CorpusRunner(object):
+    shard_regex = re.compile(r'^(results|errors)-(?P<number>[0-9]{5})\.(txt|jsonl)$')
+
+    def __init__(self, data_manager: DataManager, function: Callable[[str, Any], Optional[str]], output_dir: Path,
+                 parse: bool = False, processes: Optional[int] = None, batch_size: int = 64,
+                 shard_size: int = 100000, checkpoint_interval: float = 10.0, show_status: bool = True):
+        """
+            `function(arxiv_id, content)` is called in pool workers (i.e. it has to be picklable) for every document.
+            The content is the raw html or the parsed tree (if `parse` is set).
+            The function returns a line of output (without line break) or None.
+            A new shard is started for every run and after `shard_size` documents.
+            Progress is committed every `checkpoint_interval` seconds.
+        """
+        self.data_manager = data_manager
+        self.function = function
+        self.output_dir = output_dir
+        self.parse = parse
+        self.processes = processes
+        self.batch_size = batch_size
+        self.shard_size = shard_size
+        self.checkpoint_interval = checkpoint_interval
+        self.show_status = show_status
+
+        self.checkpoint_path = self.output_dir / 'checkpoint.jsonl'
+        self._shard: int = 0
+        self._shard_docs: int = 0
+        self._results_fp: Optional[IO[bytes]] = None
+        self._errors_fp: Optional[IO[bytes]] = None
+        self._uncommitted: List[str] = []
+
+    def _get_shard_path(self, kind: str, shard: int) -> Path:
+        return self.output_dir / (f'results-{shard:05}.txt' if kind == 'results' else f'errors-{shard:05}.jsonl')
+
+    def _get_shards(self) -> List[int]:
+        if not self.output_dir.is_dir():
+            return []
+        matches = map(self.shard_regex.match, os.listdir(self.output_dir))
+        return sorted({int(match.group('number')) for match in matches if match})
+
+    def _restore(self) -> Set[str]:
+        """ Returns the ids processed in earlier runs and discards output that was not committed """
+        done: Set[str] = set()
+        valid_sizes: Dict[int, Tuple[int, int]] = {}
+        if self.checkpoint_path.is_file():
+            with open(self.checkpoint_path, 'rb') as fp:
+                valid_length = 0
+                for line in fp:
+                    try:
+                        commit = json.loads(line) if line.endswith(b'\n') else None
+                    except ValueError:
+                        commit = None
+                    if commit is None:
+                        break   # the last commit was interrupted
+                    valid_length += len(line)
+                    valid_sizes[commit['shard']] = (commit['results'], commit['errors'])
+                    done.update(commit['ids'])
+            os.truncate(self.checkpoint_path, valid_length)
+        for shard in self._get_shards():
+            for kind, valid_size in zip(['results', 'errors'], valid_sizes.get(shard, (0, 0))):
+                path = self._get_shard_path(kind, shard)
+                if path.is_file() and path.stat().st_size > valid_size:
+                    os.truncate(path, valid_size)
+        return done
+
+    def _open_shard(self):
+        self._close_shard()
+        shards = self._get_shards()
+        self._shard = shards[-1] + 1 if shards else 0
+        self._shard_docs = 0
+        self._results_fp = open(self._get_shard_path('results', self._shard), 'ab')
+        self._errors_fp = open(self._get_shard_path('errors', self._shard), 'ab')
+
+    def _close_shard(self):
+        for fp in [self._results_fp, self._errors_fp]:
+            if fp is not None:
+                fp.close()
+        self._results_fp = self._errors_fp = None
+
+    def _commit(self):
+        """ Makes the output durable before recording the processed ids in the checkpoint """
+        if not self._uncommitted:
+            return
+        assert self._results_fp is not None and self._errors_fp is not None
+        for fp in [self._results_fp, self._errors_fp]:
+            fp.flush()
+            os.fsync(fp.fileno())
+        commit = {'shard': self._shard, 'results': self._results_fp.tell(), 'errors': self._errors_fp.tell(),
+                  'ids': self._uncommitted}
+        with open(self.checkpoint_path, 'ab') as fp:
+            fp.write(json.dumps(commit).encode('utf-8') + b'\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        self._uncommitted = []
+
+    def _write(self, results: List[DocResult], summary: RunSummary):
+        assert self._results_fp is not None and self._errors_fp is not None
+        for arxiv_id, result, error in results:
+            if error is not None:
+                self._errors_fp.write(json.dumps(error).encode('utf-8') + b'\n')
+                summary.errors += 1
+            elif result is not None:
+                self._results_fp.write(result.encode('utf-8') + b'\n')
+            self._uncommitted.append(arxiv_id)
+        summary.processed += len(results)
+        self._shard_docs += len(results)
+
+    def run(self, arxiv_ids: Iterable[str]) -> RunSummary:
+        """ Processes the documents (skipping documents that were processed in an earlier run) """
+        logger = logging.getLogger(__name__)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        done = self._restore()
+        arxiv_ids = [ArXMLivDocs.normalize_arxiv_id(arxiv_id) for arxiv_id in arxiv_ids]
+        todo = [arxiv_id for arxiv_id in arxiv_ids if arxiv_id not in done]
+        summary = RunSummary(skipped=len(arxiv_ids) - len(todo))
+        if summary.skipped:
+            logger.info(f'Resuming run in {self.output_dir}: {summary.skipped} documents were already processed')
+        if not todo:
+            return summary
+        status = RunnerStatus(len(todo))
+        batches = self.data_manager.arxmliv_docs.get_batches(todo, self.batch_size)
+        tasks = [(batch, self.function, self.parse) for batch in batches]
+        self._open_shard()
+        last_commit = time.time()
+        try:
+            with self.data_manager.pool(self.processes) as pool:
+                for results in pool.imap_unordered(_run_batch, tasks):
+                    self._write(results, summary)
+                    if time.time() - last_commit > self.checkpoint_interval:
+                        self._commit()
+                        last_commit = time.time()
+                    if self._shard_docs >= self.shard_size:
+                        self._commit()
+                        self._open_shard()
+                    if self.show_status:
+                        status.processed_docs = summary.processed
+                        status.errors = summary.errors
+                        status.outdated = True
+                        status.update()
+        finally:
+            self._commit()
+            self._close_shard()
+            if self.show_status:
+                status.clear()
+        logger.info(f'Processed {summary.processed} documents ({summary.errors} errors)')
+        return summary
+
+    def results(self) -> Iterator[str]:
+        """ Yields the result lines of all runs """
+        for shard in self._get_shards():
+            path = self._get_shard_path('results', shard)
+            if path.is_file():
+                with open(path, encoding='utf-8') as fp:
+                    for line in fp:
+                        yield line.rstrip('\n')
+
+    def errors(self) -> Iterator[Dict[str, str]]:
+        """ Yields the errors of all runs """
+        for shard in self._get_shards():
+            path = self._get_shard_path('errors', shard)
+            if path.is_file():
+                with open(path, encoding='utf-8') as fp:
+                    for line in fp:
+                        yield json.loads(line)
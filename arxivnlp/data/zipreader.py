@@ -0,0 +1,202 @@
+"""
+    A light-weight reader for zip files.
+    The zip file is memory-mapped and members are handed out as memoryview slices (for stored members) or
+    inflated in one go (for deflated members).
+    Unlike zipfile.ZipFile, no ZipInfo objects are created and no CRC checks are made.
+"""
+
+import mmap
+import struct
+import zipfile
+import zlib
+from pathlib import Path
+from typing import Dict, Tuple, Union, Optional, List, Iterator
+
+# (see zipfile.structCentralDir etc.)
+_CENTRAL_DIR = struct.Struct('<4s4B4HL2L5H2L')
+_CENTRAL_DIR_SIGNATURE = b'PK\001\002'
+_END_RECORD = struct.Struct('<4s4H2LH')
+_END_RECORD_SIGNATURE = b'PK\005\006'
+_END_RECORD_64 = struct.Struct('<4sQ2H2L4Q')
+_END_RECORD_64_SIGNATURE = b'PK\006\006'
+_END_RECORD_64_LOCATOR = struct.Struct('<4sLQL')
+_END_RECORD_64_LOCATOR_SIGNATURE = b'PK\006\007'
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_LOCAL_HEADER_SIGNATURE = b'PK\003\004'
+
+# name -> (header offset, compress type, compress size, file size)
+MemberInfo = Tuple[int, int, int, int]
+
+
+class BadZipFile(Exception):
+    pass
+
+
+class StaleLocation(Exception):
+    """ A DocLocation does not match the actual zip file anymore """
+    pass
+
+
+def _read_end_record(buffer: Union[bytes, mmap.mmap]) -> Tuple[int, int, int]:
+    """ Returns the number of entries, the offset of the central directory and the length of a prefix """
+    size = len(buffer)
+    end_offset = buffer.rfind(_END_RECORD_SIGNATURE, max(size - (1 << 16) - _END_RECORD.size, 0))
+    if end_offset < 0:
+        raise BadZipFile('Failed to find end of central directory record')
+    _, _, _, _, count, dir_size, dir_offset, _ = _END_RECORD.unpack_from(buffer, end_offset)
+    # the archive may be prefixed with other data
+    locator_offset = end_offset - _END_RECORD_64_LOCATOR.size
+    if locator_offset >= 0 and buffer[locator_offset:locator_offset + 4] == _END_RECORD_64_LOCATOR_SIGNATURE:
+        end64_offset = locator_offset - _END_RECORD_64.size
+        fields = _END_RECORD_64.unpack_from(buffer, end64_offset)
+        if fields[0] != _END_RECORD_64_SIGNATURE:
+            raise BadZipFile('Corrupt zip64 end of central directory record')
+        count, dir_size, dir_offset = fields[7], fields[8], fields[9]
+        concat = end64_offset - dir_size - dir_offset
+    else:
+        concat = end_offset - dir_size - dir_offset
+    return count, dir_offset, concat
+
+
+def get_member_count(buffer: Union[bytes, mmap.mmap]) -> int:
+    """ The number of entries of the central directory (without parsing it) """
+    return _read_end_record(buffer)[0]
+
+
+def parse_central_directory(buffer: Union[bytes, mmap.mmap]) -> Dict[str, MemberInfo]:
+    """ Parses the central directory of a zip file (including zip64 extensions) """
+    count, dir_offset, concat = _read_end_record(buffer)
+    members: Dict[str, MemberInfo] = {}
+    offset = dir_offset + concat
+    for _ in range(count):
+        fields = _CENTRAL_DIR.unpack_from(buffer, offset)
+        if fields[0] != _CENTRAL_DIR_SIGNATURE:
+            raise BadZipFile('Bad magic number for central directory entry')
+        flag_bits, compress_type = fields[5], fields[6]
+        compress_size, file_size = fields[10], fields[11]
+        name_length, extra_length, comment_length = fields[12], fields[13], fields[14]
+        header_offset = fields[18]
+        offset += _CENTRAL_DIR.size
+        raw_name = buffer[offset:offset + name_length]
+        name = raw_name.decode('utf-8') if flag_bits & 0x800 else raw_name.decode('cp437')
+        offset += name_length
+        if 0xFFFFFFFF in (compress_size, file_size, header_offset):
+            file_size, compress_size, header_offset = _zip64_values(buffer[offset:offset + extra_length],
+                                                                     file_size, compress_size, header_offset)
+        offset += extra_length + comment_length
+        if flag_bits & 0x1:
+            raise BadZipFile(f'{name} is encrypted')
+        members[name] = (header_offset + concat, compress_type, compress_size, file_size)
+    return members
+
+
+def _zip64_values(extra: bytes, file_size: int, compress_size: int, header_offset: int) -> Tuple[int, int, int]:
+    pos = 0
+    while pos + 4 <= len(extra):
+        tp, length = struct.unpack_from('<HH', extra, pos)
+        if tp == 0x0001:
+            values = iter(struct.unpack_from(f'<{length // 8}Q', extra, pos + 4))
+            if file_size == 0xFFFFFFFF:
+                file_size = next(values)
+            if compress_size == 0xFFFFFFFF:
+                compress_size = next(values)
+            if header_offset == 0xFFFFFFFF:
+                header_offset = next(values)
+            return file_size, compress_size, header_offset
+        pos += 4 + length
+    raise BadZipFile('Missing zip64 extra field')
+
+
+class MappedZipFile(object):
+    def __init__(self, filename: Union[str, Path], members: Optional[Dict[str, MemberInfo]] = None):
+        self.filename = str(filename)
+        with open(self.filename, 'rb') as fp:
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._members: Optional[Dict[str, MemberInfo]] = members
+
+    @property
+    def members(self) -> Dict[str, MemberInfo]:
+        """ The central directory (only parsed when needed) """
+        if self._members is None:
+            self._members = parse_central_directory(self.mmap)
+        return self._members
+
+    def namelist(self) -> List[str]:
+        return list(self.members)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.members
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.members)
+
+    def _data_offset(self, header_offset: int, name: str) -> int:
+        try:
+            fields = _LOCAL_HEADER.unpack_from(self.mmap, header_offset)
+        except struct.error:
+            fields = (b'',) + (0,) * 11
+        name_length, extra_length = fields[10], fields[11]
+        start = header_offset + _LOCAL_HEADER.size
+        if fields[0] != _LOCAL_HEADER_SIGNATURE or self.mmap[start:start + name_length] != name.encode('utf-8'):
+            raise StaleLocation(f'No local file header for {name} at offset {header_offset} of {self.filename}')
+        return start + name_length + extra_length
+
+    def read_at(self, name: str, header_offset: int, compress_type: int, compress_size: int,
+                file_size: int) -> Union[memoryview, bytes]:
+        """ Reads a member using offsets from an earlier scan (without looking at the central directory) """
+        start = self._data_offset(header_offset, name)
+        if start + compress_size > len(self.mmap):
+            raise StaleLocation(f'{name} exceeds the size of {self.filename}')
+        raw = memoryview(self.mmap)[start:start + compress_size]
+        if compress_type == zipfile.ZIP_STORED:
+            return raw
+        with raw:
+            if compress_type == zipfile.ZIP_DEFLATED:
+                return zlib.decompress(raw, -15, max(file_size, 1))
+        with zipfile.ZipFile(self.filename) as zf:  # unusual compression - let zipfile deal with it
+            return zf.read(name)
+
+    def iter_chunks_at(self, name: str, header_offset: int, compress_type: int, compress_size: int, file_size: int,
+                       chunk_size: int = 2**18) -> Iterator[Union[memoryview, bytes]]:
+        """
+            Like read_at, but deflated members are inflated incrementally (chunk_size refers to the compressed data).
+            The location is checked immediately, not only when the first chunk is requested.
+        """
+        start = self._data_offset(header_offset, name)
+        if start + compress_size > len(self.mmap):
+            raise StaleLocation(f'{name} exceeds the size of {self.filename}')
+        if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return iter([self.read_at(name, header_offset, compress_type, compress_size, file_size)])
+        return self._iter_chunks(start, compress_type, compress_size, chunk_size)
+
+    def _iter_chunks(self, start: int, compress_type: int, compress_size: int,
+                     chunk_size: int) -> Iterator[Union[memoryview, bytes]]:
+        decompressor = zlib.decompressobj(-15) if compress_type == zipfile.ZIP_DEFLATED else None
+        with memoryview(self.mmap) as view:
+            for offset in range(start, start + compress_size, chunk_size):
+                raw = view[offset:min(offset + chunk_size, start + compress_size)]
+                if decompressor is None:
+                    yield raw
+                    continue
+                with raw:
+                    data = decompressor.decompress(raw)
+                if data:
+                    yield data
+        if decompressor is not None:
+            data = decompressor.flush()
+            if data:
+                yield data
+
+    def read(self, name: str) -> Union[memoryview, bytes]:
+        """ Returns the content of a member (raises KeyError if it does not exist) """
+        return self.read_at(name, *self.members[name])
+
+    @property
+    def closed(self) -> bool:
+        return self.mmap.closed
+
+    def close(self):
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass  # there are still memoryviews - the mapping gets released once they are gone
@@ -19,6 +19,9 @@ sentences = sentence_tokenize(dnm.get_full_dnmstr())
 
 for s in sentences:
     highlight_dnmstring(dnmstring=s, fontscale=1.5)
+dnm.insert_added_nodes()   # positions stay valid, so the words can be annotated in a second round
+
+for s in sentences:
     words = word_tokenize(s)
     string_list = [word.string for word in words]
     tags = [pair[1] for pair in nltk.pos_tag(string_list)]
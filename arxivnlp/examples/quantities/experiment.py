@@ -30,7 +30,7 @@ def get_relevant_documents(config: Config, dm: DataManager) -> List[str]:
             d[parts[0]] = float(parts[-2]) * float(parts[-3]) ** 0.5
             # d[parts[0]] = float(parts[-1])  # sort by count(//mrow[@class="ltx_unit"])
     print('TOTAL SCORE', sum(d.values()))
-    return sorted((a for a in d if dm.arxmliv_docs.arxiv_id_to_severity(a) != 'error'), key=lambda a: -d[a])
+    return sorted(dm.arxmliv_docs.filter_by_severity(list(d), ['no-problem', 'warning']), key=lambda a: -d[a])
 
 
 CSS = '''
@@ -7,7 +7,7 @@ from arxivnlp import xml_match as xm
 import arxivnlp.args
 from arxivnlp.config import Config
 from arxivnlp.data.datamanager import DataManager
-from arxivnlp.data.dnm import DnmStr
+from arxivnlp.data.dnm import DnmStr, Dnm, DEFAULT_DNM_CONFIG
 from arxivnlp.examples.quantities import matchers
 from arxivnlp.examples.quantities.center import PossibleFind, QuantityCenter, Scalars, ScalarNotation
 from arxivnlp.examples.quantities.experiment import get_relevant_documents
@@ -110,8 +110,7 @@ class Checker(object):
         self.done = True
 
 
-def search(arxivid: str, data_manager: DataManager) -> Iterator[PossibleFind]:
-    dnm = data_manager.load_dnm(arxivid)
+def search(dnm: Dnm) -> Iterator[PossibleFind]:
     dnmstring: DnmStr = dnm.get_full_dnmstr()
     last_end: int = 0  # until where we have processed something
     for offset in (match.span()[0] for match in re.finditer('(MathNode)|[1-9]', dnmstring.string)):
@@ -132,9 +131,10 @@ def main():
     quantity_center = QuantityCenter(data_manager, quantity_kb)
     arxivids = get_relevant_documents(config, data_manager)[:5]
     arxivids = ['1707.03517']
-    for arxivid in arxivids:
+    # the next documents are read and parsed in the background while the current one is processed
+    for arxivid, tree in data_manager.prefetch(arxivids, parse=True):
         cprint([Color.BOLD], f'Processing {arxivid}')
-        possible_finds = list(search(arxivid, data_manager))
+        possible_finds = list(search(Dnm(tree, DEFAULT_DNM_CONFIG)))
         cprint([Color.BOLD], f'    -> {len(possible_finds)} matches')
         quantity_center.process_finds(arxivid, possible_finds)
 
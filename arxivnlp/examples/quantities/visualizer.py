@@ -4,7 +4,7 @@ from lxml import etree
 
 from arxivnlp.config import Config
 from arxivnlp.data.datamanager import DataManager
-from arxivnlp.data.dnm import DEFAULT_DNM_CONFIG, DnmRange
+from arxivnlp.data.dnm import DEFAULT_DNM_CONFIG, DnmPointResolver
 from arxivnlp.examples.quantities.center import QuantityCenter
 from arxivnlp.examples.quantities.quantity_kb import QuantityKb
 from arxivnlp.examples.quantities.wikidata import QuantityWikiDataLoader
@@ -42,17 +42,19 @@ def main():
     quantity_center = QuantityCenter(data_manager, quantity_kb)
 
     dnm = data_manager.load_dnm(arxivid, DEFAULT_DNM_CONFIG)
+    occurrences = list(quantity_center.load_occurrences(arxivid))
+    dnm_ranges = DnmPointResolver(dnm.tree).resolve_ranges(occurrence.dnm_range for occurrence in occurrences)
+    positions = dnm.dnm_points_to_pos(dnm_range.to for dnm_range in dnm_ranges)
     count = 0
-    for occurrence in quantity_center.load_occurrences(arxivid):
+    for occurrence, (pos, _) in zip(occurrences, positions):
         count += 1
-        dnm_range = DnmRange.from_string(occurrence.dnm_range, dnm.tree)
         star = '*'
         message = ''
         if occurrence.amount_val is not None:
             message += str(occurrence.amount_val) + ' '
         message += quantity_kb.all_units[occurrence.unit_id].display_name
         dnm.add_node(etree.XML(f'<span><span class="arxivnlpmessagemarker">{star}</span><span class="arxivnlpmessage">{message}</span></span>'),
-                     dnm.dnm_point_to_pos(dnm_range.to)[0], after=True)
+                     pos, after=True)
     dnm.insert_added_nodes()
     dnm.tree.xpath('.//head')[0].append(etree.XML(f'<style>{CSS}</style>'))  # TODO: Escape CSS
     dnm.tree.xpath('.//head')[0].append(etree.XML('<link rel="stylesheet" href="https://ar5iv.labs.arxiv.org/assets/ar5iv.0.7.4.min.css" />'))
@@ -38,3 +38,8 @@ with datamanager.arxmliv_docs.open('2007.08392') as fpin:
     dnm = Dnm(tree, DEFAULT_DNM_CONFIG)
     print('dnm gen tim', (time.time() - start))
     print(len(dnm.string))
+
+# dnm gen from a pruned tree
+start = time.time()
+dnm = datamanager.load_dnm('2007.08392', prune=True)
+print('pruned parse + dnm gen time', (time.time() - start))
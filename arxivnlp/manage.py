@@ -6,6 +6,8 @@ from typing import List, Dict, Callable
 import arxivnlp.args
 import arxivnlp.data.arxivcategories as arxivcategories
 from arxivnlp.config import Config
+from arxivnlp.data.datamanager import DataManager
+from arxivnlp.data.ngramindex import NgramIndex
 
 COMMANDS: Dict[str, Callable[[List[str]], None]] = {}
 
@@ -26,6 +28,27 @@ def update_arxiv_metadata(arguments: List[str]):
     arxivcategories.update(Path(args.metadata), Config.get())
 
 
+@register('update-arxmliv-index')
+def update_arxmliv_index(arguments: List[str]):
+    parser = argparse.ArgumentParser(description='Create or update the index of arXMLiv document locations',
+                                     add_help=True)
+    arxivnlp.args.auto(args=arguments, parser=parser)
+    data_manager = DataManager(Config.get())
+    data_manager.arxmliv_docs.update_index()
+    data_manager.close()
+
+
+@register('update-ngram-index')
+def update_ngram_index(arguments: List[str]):
+    parser = argparse.ArgumentParser(description='Create or update the n-gram index of the arXMLiv documents',
+                                     add_help=True)
+    arxivnlp.args.auto(args=arguments, parser=parser)
+    data_manager = DataManager(Config.get())
+    with data_manager.pool() as pool:
+        NgramIndex(data_manager).update(pool)
+    data_manager.close()
+
+
 def print_help():
     print('arxivnlp management tool')
     print('Available commands:')
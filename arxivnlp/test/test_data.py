@@ -1,14 +1,53 @@
+import array
 import copy
+import datetime
+import json
+import os
+import tempfile
+import threading
 import unittest
+import zipfile
 from pathlib import Path
+from typing import Optional, Dict
 
 from arxivnlp.config import Config
-from arxivnlp.data.arxivcategories import ArxivCategories
+from arxivnlp.data import arxivcategories
+from arxivnlp.data.arxivcategories import ArxivCategories, ArxivMetadata
 from arxivnlp.data.arxmlivdocs import ArXMLivDocs
+from arxivnlp.data.bitset import Bitset
+from arxivnlp.data.cached import ZipFileCache, ZipDirectoryCache, MappedCachedData, CachedData
+from arxivnlp.data.datamanager import DataManager
 from arxivnlp.data.exceptions import MissingDataException, BadArxivId
+from arxivnlp.data.grep import BytesGrep, grep_documents
+from arxivnlp.data.ngramindex import NgramIndex, encode_postings, decode_postings
+from arxivnlp.data.runner import CorpusRunner
+from arxivnlp.data.mapped import StringTable, StringList, CsrMap
+from arxivnlp.data.zipreader import MappedZipFile, StaleLocation
 from arxivnlp.test import utils
 
 
+def _get_test_config() -> Config:
+    config = copy.copy(Config.get())
+    config.arxmliv_dir = Path(__file__).parent / 'resources' / 'arxmliv_test_dir'
+    config.cache_dir = None
+    return config
+
+
+def _read_in_worker(arxiv_id: str) -> int:
+    return len(DataManager.get().arxmliv_docs.read_bytes(arxiv_id))
+
+
+def _get_title(arxiv_id: str, tree) -> str:
+    return tree.xpath('//title/text()')[0]
+
+
+def _get_marked_title(arxiv_id: str, tree) -> Optional[str]:
+    title = tree.xpath('//title/text()')[0]
+    if title == 'fail':
+        raise ValueError(f'{arxiv_id} fails')
+    return f'{arxiv_id},{title}' if title.startswith('x') else None
+
+
 class TestData(unittest.TestCase):
     @utils.smart_skip(requires_data=True, is_slow=True)
     def test_arxivcats(self):
@@ -40,3 +79,589 @@ class TestData(unittest.TestCase):
         self.assertRaises(MissingDataException, lambda: just_open('1603.12345'))  # in zip file
         self.assertRaises(MissingDataException, lambda: just_open('9001.12345'))  # no such folder exists
         self.assertRaises(BadArxivId, lambda: just_open('bad'))
+
+    def test_doc_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = copy.copy(Config.get())
+            config.arxmliv_dir = Path(tmpdir) / 'arxmliv'
+            config.cache_dir = Path(tmpdir) / 'cache'
+            (config.arxmliv_dir / '1701').mkdir(parents=True)
+            with open(config.arxmliv_dir / '1701' / '1701.00001.html', 'w') as fp:
+                fp.write('<html>plain</html>')
+            with zipfile.ZipFile(config.arxmliv_dir / '1603.zip', 'w') as zf:
+                zf.writestr('1603/1603.00001.html', '<html>stored</html>', compress_type=zipfile.ZIP_STORED)
+                zf.writestr('1603/1603.00002.html', '<html>deflated ä</html>', compress_type=zipfile.ZIP_DEFLATED)
+
+            docs = ArXMLivDocs(config, ZipFileCache(config))
+            self.assertEqual(set(docs.arxiv_ids()), {'1701.00001', '1603.00001', '1603.00002'})
+            self.assertEqual(docs.doc_index.get('1603.00002').member, '1603/1603.00002.html')
+
+            docs = ArXMLivDocs(config, ZipFileCache(config))   # loads index from cache
+            self.assertTrue(docs.doc_index.ensured())
+            for arxiv_id, content in [('1701.00001', 'plain'), ('1603.00001', 'stored'), ('1603.00002', 'deflated ä')]:
+                with docs.open(arxiv_id) as fp:
+                    self.assertEqual(fp.read(), f'<html>{content}</html>')
+            with docs.open('1603.00002', read_as_text=False) as fp:
+                self.assertEqual(fp.read(), '<html>deflated ä</html>'.encode('utf-8'))
+
+            # incremental update
+            with zipfile.ZipFile(config.arxmliv_dir / '1604.zip', 'w') as zf:
+                zf.writestr('1604/1604.00001.html', '<html>new</html>')
+            docs.update_index()
+            self.assertIn('1604.00001', docs.arxiv_ids())
+            self.assertEqual(len(docs.arxiv_ids()), 4)
+
+            # outdated indices get updated automatically
+            (config.arxmliv_dir / '1701' / '1701.00001.html').unlink()
+            os.utime(config.arxmliv_dir / '1701', ns=(0, 0))   # make sure the modification time differs
+            docs = ArXMLivDocs(config, ZipFileCache(config))
+            self.assertEqual(docs.arxiv_ids(), ['1603.00001', '1603.00002', '1604.00001'])
+
+    def test_severity(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = copy.copy(Config.get())
+            config.arxmliv_dir = Path(tmpdir) / 'arxmliv'
+            config.cache_dir = Path(tmpdir) / 'cache'
+            (config.arxmliv_dir / 'meta').mkdir(parents=True)
+            with zipfile.ZipFile(config.arxmliv_dir / '1603.zip', 'w') as zf:
+                for i in range(1, 6):
+                    zf.writestr(f'1603/1603.0000{i}.html', '<html></html>')
+            with zipfile.ZipFile(config.arxmliv_dir / 'meta' / 'grouped_by_severity.zip', 'w') as zf:
+                zf.writestr('no-problem-tasks.txt', '1603.00001.html\n1603.00004.html\n')
+                zf.writestr('warning-tasks.txt', '1603.00002.html\n')
+                zf.writestr('error-tasks.txt', '1603.00003.html\n9999.99999.html\n')
+
+            for _ in range(2):   # the second time, the severities are loaded from the cache
+                docs = ArXMLivDocs(config, ZipFileCache(config))
+                self.assertEqual(docs.arxiv_id_to_severity('1603.00002'), 'warning')
+                self.assertEqual(docs.arxiv_id_to_severity('1603.00003.html'), 'error')
+                self.assertRaises(Exception, lambda: docs.arxiv_id_to_severity('1603.00005'))
+                ids = ['1603.00005', '1603.00004', '1603.00003', '1603.00002', '1603.00001', '1234.56789']
+                self.assertEqual(docs.filter_by_severity(ids, ['no-problem', 'warning']),
+                                 ['1603.00004', '1603.00002', '1603.00001'])
+                self.assertEqual(docs.partition_by_severity(ids),
+                                 {'no-problem': ['1603.00004', '1603.00001'], 'warning': ['1603.00002'],
+                                  'error': ['1603.00003'], 'unknown': ['1603.00005', '1234.56789']})
+                self.assertEqual(docs.get_severity_codes(ids * 10), bytes([255, 0, 2, 1, 0, 255]) * 10)
+
+            # the severities are re-aligned when the index changes
+            with zipfile.ZipFile(config.arxmliv_dir / '1602.zip', 'w') as zf:
+                zf.writestr('1602/1602.00001.html', '<html></html>')
+            docs.update_index()
+            self.assertEqual(docs.arxiv_id_to_severity('1603.00001'), 'no-problem')
+            docs = ArXMLivDocs(config, ZipFileCache(config))
+            self.assertEqual(docs.arxiv_id_to_severity('1603.00002'), 'warning')
+
+    def test_arxiv_categories_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = copy.copy(Config.get())
+            config.other_data_dir = Path(tmpdir) / 'other'
+            config.cache_dir = Path(tmpdir) / 'cache'
+            config.other_data_dir.mkdir()
+            with open(config.other_data_dir / 'categories.txt', 'w') as fp:
+                fp.write('0704.0001: hep-ph\n')
+                fp.write('0704.0002: math.CO, cs.CG\n')
+                fp.write('0704.0003: physics.gen-ph\n')
+                fp.write('cond-mat/9401234: cond-mat, math.CO\n')
+
+            for _ in range(2):   # the second time, the data is loaded from the cache
+                cats = ArxivCategories(config)
+                self.assertEqual(cats.doc_to_cats['0704.0002'], ['math.CO', 'cs.CG'])
+                self.assertEqual(cats.doc_to_cats['cond-mat/9401234'], ['cond-mat', 'math.CO'])
+                self.assertEqual(cats.get_categories('cond-mat9401234'), ['cond-mat', 'math.CO'])
+                self.assertEqual(cats.cat_to_docs['math.CO'], ['0704.0002', 'cond-mat9401234'])
+                self.assertNotIn('0704.0001', cats.cat_to_docs['cond-mat'])
+                self.assertEqual(len(cats.doc_to_cats), 4)
+                self.assertEqual(set(cats.cat_to_docs), {'hep-ph', 'math.CO', 'cs.CG', 'physics.gen-ph', 'cond-mat'})
+                self.assertRaises(KeyError, lambda: cats.doc_to_cats['0704.0004'])
+                self.assertEqual(cats.ids_of(cats.docs_in('math.CO') - cats.docs_in('cs.CG')), ['cond-mat9401234'])
+                self.assertEqual(cats.ids_of(cats.docs_in_any(['hep-ph', 'cs.CG'])), ['0704.0001', '0704.0002'])
+                self.assertEqual(len(~cats.docs_in('math.CO')), 2)
+
+            with open(config.other_data_dir / 'categories.txt', 'a') as fp:   # changes are detected
+                fp.write('0704.0004: math.CO\n')
+            self.assertEqual(ArxivCategories(config).cat_to_docs['math.CO'], ['0704.0002', '0704.0004',
+                                                                              'cond-mat9401234'])
+
+    def test_update_arxiv_metadata(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = copy.copy(Config.get())
+            config.cache_dir = Path(tmpdir) / 'cache'
+            config.other_data_dir = None
+            config.number_of_processes = 2
+            records = [
+                {'id': '0704.0002', 'categories': 'math.CO cs.CG',
+                 'title': 'Sparsity-certifying\n  Graph Decompositions',
+                 'versions': [{'version': 'v1'}, {'version': 'v2'}], 'update_date': '2008-12-13'},
+                {'id': 'cond-mat/9401234', 'categories': 'cond-mat', 'title': 'Old', 'versions': [{'version': 'v1'}],
+                 'update_date': '2009-10-31'},
+                {'id': '0704.0001', 'categories': 'hep-ph', 'title': 'Diphoton', 'versions': [], 'update_date': None},
+            ]
+            path = Path(tmpdir) / 'metadata.zip'
+            with zipfile.ZipFile(path, 'w') as zf:
+                zf.writestr('metadata.json', ''.join(json.dumps(record) + '\n' for record in records))
+            arxivcategories.update(path, config, chunk_size=2)
+
+            cats = ArxivCategories(config)
+            self.assertEqual(list(cats.doc_to_cats), ['0704.0001', '0704.0002', 'cond-mat9401234'])
+            self.assertEqual(cats.doc_to_cats['0704.0002'], ['math.CO', 'cs.CG'])
+            self.assertEqual(cats.ids_of(cats.docs_in('cond-mat')), ['cond-mat9401234'])
+            metadata = ArxivMetadata(config, cats)
+            self.assertEqual(metadata.get_versions('0704.0002'), 2)
+            self.assertEqual(metadata.get_update_date('cond-mat/9401234'), datetime.date(2009, 10, 31))
+            self.assertIsNone(metadata.get_update_date('0704.0001'))
+            self.assertEqual(metadata.get_title_length('0704.0002'), len('Sparsity-certifying Graph Decompositions'))
+            self.assertEqual(list(metadata.get_column('versions')), [0, 2, 1])
+
+    def test_bitset(self):
+        a = Bitset.from_indices(20, [0, 3, 8, 9, 19])
+        b = Bitset.from_indices(20, [3, 9, 10])
+        self.assertEqual(list(a & b), [3, 9])
+        self.assertEqual(list(a | b), [0, 3, 8, 9, 10, 19])
+        self.assertEqual(list(a - b), [0, 8, 19])
+        self.assertEqual(list(a ^ b), [0, 8, 10, 19])
+        self.assertEqual(len(~a), 15)
+        self.assertIn(19, a)
+        self.assertNotIn(20, a)
+        self.assertEqual(a, Bitset.from_indices(20, reversed(list(a))))
+        self.assertRaises(ValueError, lambda: a & Bitset(21))
+        self.assertRaises(IndexError, lambda: Bitset.from_indices(20, [20]))
+
+    def test_mapped_zip_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / 'test.zip'
+            with open(path, 'wb') as fp:
+                fp.write(b'some prefix')   # e.g. self-extracting archives
+                with zipfile.ZipFile(fp, 'w') as zf:
+                    zf.writestr('a/stored.html', b'stored content', compress_type=zipfile.ZIP_STORED)
+                    zf.writestr('a/deflated.html', b'deflated content' * 100, compress_type=zipfile.ZIP_DEFLATED)
+                    zf.writestr('a/empty.html', b'')
+            archive = MappedZipFile(path)
+            with zipfile.ZipFile(path) as zf:
+                self.assertEqual(archive.namelist(), zf.namelist())
+                for info in zf.infolist():
+                    self.assertEqual(bytes(archive.read(info.filename)), zf.read(info.filename))
+                    self.assertEqual(archive.members[info.filename][1:],
+                                     (info.compress_type, info.compress_size, info.file_size))
+            self.assertIsInstance(archive.read('a/stored.html'), memoryview)
+            self.assertRaises(KeyError, lambda: archive.read('a/missing.html'))
+            header_offset, compress_type, compress_size, file_size = archive.members['a/stored.html']
+            self.assertRaises(StaleLocation, lambda: archive.read_at('a/stored.html', header_offset + 1, compress_type,
+                                                                     compress_size, file_size))
+            archive.close()
+
+    def test_zip_directory_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = copy.copy(Config.get())
+            config.cache_dir = Path(tmpdir) / 'cache'
+            path = Path(tmpdir) / '1603.zip'
+            with zipfile.ZipFile(path, 'w') as zf:
+                zf.writestr('1603/1603.00001.html', '<html></html>')
+            directory_cache = ZipDirectoryCache(config)
+            self.assertIsNone(directory_cache.load(path, 'members'))
+
+            cache = ZipFileCache(config)
+            members = cache.get_mapped(path).members
+            self.assertEqual(cache[path].namelist(), ['1603/1603.00001.html'])
+            cache.close()
+            self.assertEqual(directory_cache.load(path, 'members'), members)
+            self.assertEqual([info.filename for info in directory_cache.load(path, 'infolist')],
+                             ['1603/1603.00001.html'])
+
+            # a cached directory should be used by new caches
+            cache = ZipFileCache(config)
+            self.assertEqual(cache[path].read('1603/1603.00001.html'), b'<html></html>')
+            cache.close()
+
+            with zipfile.ZipFile(path, 'a') as zf:   # changes size and mtime
+                zf.writestr('1603/1603.00002.html', '<html></html>')
+            self.assertIsNone(directory_cache.load(path, 'members'))
+            cache = ZipFileCache(config)
+            self.assertEqual(len(cache.get_mapped(path).members), 2)
+            cache.close()
+
+    def test_worker_pool(self):
+        for start_method in ['fork', 'spawn']:
+            data_manager = DataManager(_get_test_config())
+            with data_manager.pool(processes=2, start_method=start_method) as pool:
+                sizes = pool.map(_read_in_worker, ['1603.13523', '1603.13523', '1701.39125'], chunksize=1)
+            self.assertEqual(sizes, [0, 0, 0])   # the test files are empty
+            self.assertEqual(len(pool.worker_stats), 2)
+            self.assertEqual(sum(stats['requested'] for stats in pool.worker_stats.values()), 2)
+
+    def test_iter_documents(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = copy.copy(Config.get())
+            config.arxmliv_dir = Path(tmpdir) / 'arxmliv'
+            config.cache_dir = Path(tmpdir) / 'cache'
+            config.arxmliv_dir.mkdir()
+            for yymm in ['1603', '1604']:
+                with zipfile.ZipFile(config.arxmliv_dir / f'{yymm}.zip', 'w') as zf:
+                    for i in [3, 1, 2]:
+                        zf.writestr(f'{yymm}/{yymm}.0000{i}.html', f'<html><title>{yymm}.{i}</title></html>',
+                                    compress_type=zipfile.ZIP_DEFLATED)
+            ids = ['1604.00001', '1603.00002', '1603.00003', '9999.99999', '1604.00003', '1603.00001']
+            data_manager = DataManager(config)
+            self.assertEqual(data_manager.arxmliv_docs.get_batches(ids, 2),
+                             [['1603.00003', '1603.00001'], ['1603.00002'], ['1604.00003', '1604.00001'],
+                              ['9999.99999']])
+            ids.remove('9999.99999')
+            documents = list(data_manager.iter_documents(ids))
+            self.assertEqual([arxiv_id for arxiv_id, _ in documents],
+                             ['1603.00003', '1603.00001', '1603.00002', '1604.00003', '1604.00001'])
+            self.assertEqual(bytes(documents[0][1]), b'<html><title>1603.3</title></html>')
+            with data_manager.pool(processes=2) as pool:
+                titles = {arxiv_id: tree.xpath('//title/text()')[0]
+                          for arxiv_id, tree in data_manager.iter_documents(ids, parse=True, pool=pool, batch_size=2)}
+                self.assertEqual(titles['1604.00003'], '1604.3')
+                self.assertEqual(dict(data_manager.map_documents(_get_title, ids, pool, parse=True)), titles)
+
+    def test_prefetch(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = copy.copy(Config.get())
+            config.arxmliv_dir = Path(tmpdir) / 'arxmliv'
+            config.cache_dir = None
+            config.arxmliv_dir.mkdir()
+            with zipfile.ZipFile(config.arxmliv_dir / '1603.zip', 'w') as zf:
+                for i in range(20):
+                    zf.writestr(f'1603/1603.{i:05}.html', f'<html><title>{i}</title></html>',
+                                compress_type=zipfile.ZIP_DEFLATED)
+            data_manager = DataManager(config)
+            ids = [f'1603.{i:05}' for i in reversed(range(20))]
+            for depth, max_bytes in [(1, 1000), (8, 1000), (8, 10)]:
+                contents = list(data_manager.prefetch(ids, depth=depth, max_bytes=max_bytes, threads=3))
+                self.assertEqual([arxiv_id for arxiv_id, _ in contents], ids)
+                self.assertEqual(bytes(contents[0][1]), b'<html><title>19</title></html>')
+            titles = [tree.xpath('//title/text()')[0] for _, tree in data_manager.prefetch(ids, parse=True)]
+            self.assertEqual(titles, [str(i) for i in reversed(range(20))])
+
+            prefetched = iter(data_manager.prefetch(['1603.00001', '1603.12345', '1603.00002']))
+            self.assertEqual(next(prefetched)[0], '1603.00001')
+            self.assertRaises(MissingDataException, lambda: next(prefetched))
+
+    def test_corpus_runner(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = copy.copy(Config.get())
+            config.arxmliv_dir = Path(tmpdir) / 'arxmliv'
+            config.cache_dir = Path(tmpdir) / 'cache'
+            config.arxmliv_dir.mkdir()
+            titles = ['x0', 'y1', 'fail', 'x3', 'x4', 'y5']
+            with zipfile.ZipFile(config.arxmliv_dir / '1603.zip', 'w') as zf:
+                for i, title in enumerate(titles):
+                    zf.writestr(f'1603/1603.{i:05}.html', f'<html><title>{title}</title></html>')
+            ids = [f'1603.{i:05}' for i in range(len(titles))]
+            output_dir = Path(tmpdir) / 'run'
+            data_manager = DataManager(config)
+
+            def get_runner():
+                return CorpusRunner(data_manager, _get_marked_title, output_dir, parse=True, processes=2,
+                                    batch_size=2, shard_size=2, show_status=False)
+
+            summary = get_runner().run(ids[:3] + ['1603.12345'])
+            self.assertEqual((summary.processed, summary.errors, summary.skipped), (4, 2, 0))
+            # simulate a crash: uncommitted output and an interrupted commit
+            with open(output_dir / 'results-00000.txt', 'a') as fp:
+                fp.write('uncommitted\n')
+            with open(output_dir / 'checkpoint.jsonl', 'a') as fp:
+                fp.write('{"shard": 0, "resu')
+
+            runner = get_runner()
+            summary = runner.run(ids)
+            self.assertEqual((summary.processed, summary.errors, summary.skipped), (3, 0, 3))
+            self.assertEqual(sorted(runner.results()), ['1603.00000,x0', '1603.00003,x3', '1603.00004,x4'])
+            self.assertEqual(sorted(error['id'] for error in runner.errors()), ['1603.00002', '1603.12345'])
+            self.assertIn('ValueError', next(e for e in runner.errors() if e['id'] == '1603.00002')['traceback'])
+            self.assertEqual(get_runner().run(ids).skipped, len(ids))
+
+    def test_grep(self):
+        grep = BytesGrep(['ltx_unit', '\\si{'])
+        self.assertTrue(grep.matches(b'<span class="ltx_unit">'))
+        self.assertFalse(grep.matches(memoryview(b'ltx_uni si{')))
+        self.assertEqual(grep.find_patterns('\\si{m} ltx_unit ä'.encode('utf-8')), {1})   # stops after first hit
+        grep = BytesGrep(['ab', 'abc', 'ä'], require_all=True)
+        self.assertEqual(grep.find_patterns('xabcä'.encode('utf-8')), {0, 1, 2})
+        self.assertTrue(grep.matches_chunks([b'xa', b'bc\xc3', b'\xa4']))   # matches across chunk boundaries
+        self.assertFalse(grep.matches_chunks([b'xa', b'bc']))
+        grep = BytesGrep([rb'class="ltx_\w+"'], regex=True, max_match_length=30)
+        self.assertTrue(grep.matches_chunks([b'<span cla', b'ss="ltx_unit">']))
+        self.assertFalse(grep.matches_chunks([b'<span class="ltx_ unit">']))
+        # chunks that are shorter than the overlap
+        self.assertTrue(BytesGrep(['abcdef']).matches_chunks([b'ab', b'c', b'def']))
+        data = b'--x' + b'-' * 40 + b'y--'
+        grep = BytesGrep([rb'x.{0,50}y'], regex=True, max_match_length=52)
+        self.assertTrue(grep.matches_chunks([data[i:i + 10] for i in range(0, len(data), 10)]))
+        self.assertTrue(grep.matches_chunks([data[i:i + 1] for i in range(len(data))]))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = copy.copy(Config.get())
+            config.arxmliv_dir = Path(tmpdir) / 'arxmliv'
+            config.cache_dir = Path(tmpdir) / 'cache'
+            config.arxmliv_dir.mkdir()
+            with zipfile.ZipFile(config.arxmliv_dir / '1603.zip', 'w') as zf:
+                for i in range(4):
+                    content = ''.join(f'<p>{j * i}</p>' for j in range(1000))
+                    if i % 2:
+                        content += '<span class="ltx_unit">m</span>'
+                    zf.writestr(f'1603/1603.{i:05}.html', content, compress_type=zipfile.ZIP_DEFLATED)
+                zf.writestr('1603/1603.00004.html', '<span class="ltx_unit">', compress_type=zipfile.ZIP_STORED)
+            data_manager = DataManager(config)
+            ids = [f'1603.{i:05}' for i in range(5)] + ['1603.12345']
+            data_manager.arxmliv_docs.update_index()
+            chunks = list(data_manager.arxmliv_docs.iter_chunks('1603.00001', chunk_size=100))
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(b''.join(chunks), bytes(data_manager.arxmliv_docs.read_bytes('1603.00001')))
+            grep = BytesGrep(['ltx_unit'])
+            self.assertEqual(list(grep_documents(data_manager, grep, ids)), ['1603.00001', '1603.00003', '1603.00004'])
+            with data_manager.pool(processes=2) as pool:
+                self.assertEqual(sorted(grep_documents(data_manager, grep, ids, pool=pool, batch_size=2)),
+                                 ['1603.00001', '1603.00003', '1603.00004'])
+
+    def test_ngram_index(self):
+        self.assertEqual(decode_postings(encode_postings([0, 3, 200, 100000])), [0, 3, 200, 100000])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = copy.copy(Config.get())
+            config.arxmliv_dir = Path(tmpdir) / 'arxmliv'
+            config.cache_dir = Path(tmpdir) / 'cache'
+            documents = {
+                '1603.00001': '<p>The speed is <span class="ltx_unit">m/s</span></p>',
+                '1603.00002': '<p>A speed of <math alttext="\\SI{3}{\\meter}"><mi>m</mi></math></p>',
+                '1604.00001': '<p class="ltx_para">Slow speed</p><math alttext="\\si{m}"></math>',
+                '1604.00002': '',
+            }
+            config.arxmliv_dir.mkdir()
+            for yymm in ['1603', '1604']:
+                with zipfile.ZipFile(config.arxmliv_dir / f'{yymm}.zip', 'w') as zf:
+                    for arxiv_id, content in documents.items():
+                        if arxiv_id.startswith(yymm):
+                            zf.writestr(f'{yymm}/{arxiv_id}.html', f'<html><body>{content}</body></html>')
+            data_manager = DataManager(config)
+            NgramIndex(data_manager).update()
+
+            index = NgramIndex(data_manager)   # loads the index from the cache
+            self.assertEqual(index.query(text=['speed']), ['1603.00001', '1603.00002', '1604.00001'])
+            self.assertEqual(index.query(text=['speed'], classes=['ltx_unit']), ['1603.00001'])
+            self.assertEqual(index.query(tex=['\\si{']), ['1604.00001'])
+            self.assertEqual(index.query(tex=['\\SI', '\\meter']), ['1603.00002'])
+            self.assertEqual(index.query(text=['Slow'], classes=['ltx_para']), ['1604.00001'])
+            self.assertEqual(index.query(text=['nothing']), [])
+
+            # incremental update
+            with zipfile.ZipFile(config.arxmliv_dir / '1604.zip', 'a') as zf:
+                zf.writestr('1604/1604.00003.html', '<html><body><p>fast speed</p></body></html>')
+            os.utime(config.arxmliv_dir / '1604.zip', ns=(1, 1))
+            data_manager = DataManager(config)
+            data_manager.arxmliv_docs.update_index()
+            index = NgramIndex(data_manager)
+            index.update()
+            self.assertEqual(index.query(text=['fast speed']), ['1604.00003'])
+
+            # documents that cannot be read do not stop the update
+            path = config.arxmliv_dir / '1605.zip'
+            with zipfile.ZipFile(path, 'w') as zf:
+                zf.writestr('1605/1605.00001.html', '<html><body><p>good speed</p></body></html>')
+                zf.writestr('1605/1605.00002.html', '<html><body><p>bad speed</p></body></html>' * 10,
+                            compress_type=zipfile.ZIP_DEFLATED)
+                info = zf.getinfo('1605/1605.00002.html')
+            with open(path, 'r+b') as fp:   # corrupt the deflated data
+                fp.seek(info.header_offset + 30 + len(info.filename))
+                fp.write(b'\xff' * info.compress_size)
+            data_manager = DataManager(config)
+            data_manager.arxmliv_docs.update_index()
+            index = NgramIndex(data_manager)
+            with self.assertLogs('arxivnlp.data.ngramindex', 'WARNING'):
+                index.update()
+            self.assertEqual(index.query(text=['speed'], classes=['ltx_para']), ['1604.00001'])
+            self.assertEqual(index.query(text=['good speed']), ['1605.00001'])
+            self.assertEqual(index.query(text=['bad speed']), [])
+
+    def test_dnm_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = copy.copy(Config.get())
+            config.arxmliv_dir = Path(tmpdir) / 'arxmliv'
+            config.cache_dir = Path(tmpdir) / 'cache'
+            config.arxmliv_dir.mkdir()
+            with zipfile.ZipFile(config.arxmliv_dir / '1603.zip', 'w') as zf:
+                zf.writestr('1603/1603.00001.html', '<html><head><title>x</title></head><body><p>A speed of '
+                                                    '<math><mi>v</mi></math> is <b>fast</b> enough.</p></body></html>')
+            data_manager = DataManager(config)
+            dnm = data_manager.load_dnm('1603.00001')
+            self.assertEqual(data_manager.load_dnm('1603.00001', prune=True).string, dnm.string)
+            data_manager.load_cached_dnm('1603.00001')   # creates the cache entry
+
+            loaded_trees = []
+
+            def load_tree(arxiv_id: str):
+                loaded_trees.append(arxiv_id)
+                return data_manager.load_tree(arxiv_id)
+
+            data_manager.dnm_cache.load_tree = load_tree
+            cached = data_manager.load_cached_dnm('1603.00001')
+            self.assertEqual(cached.string, dnm.string)
+            self.assertEqual(loaded_trees, [])
+            for pos in range(len(dnm.string)):
+                self.assertEqual(cached.get_dnm_point(pos).to_string(), dnm.get_dnm_point(pos).to_string())
+                self.assertEqual(cached.get_node(pos).tag, dnm.backrefs_token[pos].get_surrounding_node().tag)
+            self.assertEqual(loaded_trees, ['1603.00001'])
+            self.assertEqual(cached.dnm.string, dnm.string)
+
+            # changing the document invalidates the cache entry
+            with zipfile.ZipFile(config.arxmliv_dir / '1603.zip', 'w') as zf:
+                zf.writestr('1603/1603.00001.html', '<html><body><p>Changed</p></body></html>')
+            os.utime(config.arxmliv_dir / '1603.zip', ns=(1, 1))
+            data_manager = DataManager(config)
+            data_manager.arxmliv_docs.update_index()
+            self.assertEqual(data_manager.load_cached_dnm('1603.00001').string, 'Changed')
+
+    def test_zip_file_cache_lru(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = _get_test_config()
+            config.max_open_zip_files = 2
+            paths = [Path(tmpdir) / f'{i}.zip' for i in range(4)]
+            for path in paths:
+                with zipfile.ZipFile(path, 'w') as zf:
+                    for j in range(100):
+                        zf.writestr(f'{j}.html', '<html></html>')
+            cache = ZipFileCache(config)
+            cache[paths[0]]
+            cache[paths[1]]
+            cache[paths[0]]
+            cache[paths[2]]          # evicts paths[1]
+            stats = cache.get_archive_stats()
+            self.assertEqual(stats[str(paths[1].resolve())].evictions, 1)
+            self.assertEqual(stats[str(paths[0].resolve())].evictions, 0)
+            self.assertEqual((stats[str(paths[0].resolve())].hits, stats[str(paths[0].resolve())].misses), (1, 1))
+
+            fp = cache[paths[0]].open('0.html')
+            cache[paths[2]]
+            cache[paths[3]]          # paths[0] is least recently used, but still has an open file
+            self.assertEqual(stats[str(paths[2].resolve())].evictions, 1)
+            self.assertEqual(stats[str(paths[0].resolve())].pushed_because_open, 1)
+            fp.close()
+            self.assertEqual(len(cache.zipfiles), 2)
+            self.assertEqual(cache.get_stats()['requested'], 7)
+            cache.close()
+
+            # memory limit
+            config.max_open_zip_files = 10
+            config.max_zip_cache_memory_mb = 1
+            cache = ZipFileCache(config)
+            cache.max_memory = 250 * 500   # space for the directories of two zip files
+            for path in paths:
+                cache[path]
+            self.assertEqual(len(cache.zipfiles), 2)
+            self.assertEqual(cache.get_stats()['evictions'], 2)
+            cache.close()
+
+            # mapped archives are counted before their directories are parsed
+            cache = ZipFileCache(config)
+            cache.max_memory = 250 * 200
+            for path in paths:
+                cache.get_mapped(path)
+            self.assertEqual(len(cache.zipfiles), 2)
+            self.assertEqual(cache.total_memory, 250 * 200)
+            self.assertEqual(len(cache.get_mapped(paths[3]).members), 100)
+            self.assertEqual(cache.total_memory, 250 * 200)
+            cache.close()
+
+    def test_zip_file_cache_pins(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = _get_test_config()
+            config.max_open_zip_files = 1
+            paths = [Path(tmpdir) / f'{i}.zip' for i in range(2)]
+            for i, path in enumerate(paths):
+                with zipfile.ZipFile(path, 'w') as zf:
+                    zf.writestr('a.html', f'<html>{i}</html>', compress_type=zipfile.ZIP_DEFLATED)
+            cache = ZipFileCache(config)
+            barrier = threading.Barrier(2, timeout=10)
+            results: Dict[int, bytes] = {}
+
+            def read(i: int):
+                with cache.mapped(paths[i]) as archive:
+                    barrier.wait()   # both archives are requested before either is read
+                    results[i] = bytes(archive.read('a.html'))
+                    barrier.wait()
+
+            threads = [threading.Thread(target=read, args=(i,)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(results, {0: b'<html>0</html>', 1: b'<html>1</html>'})
+            self.assertEqual(cache.get_stats()['pushed_because_open'], 1)
+            cache.get_mapped(paths[1])
+            self.assertEqual(len(cache.zipfiles), 1)   # unpinned archives are closed again
+            cache.close()
+
+            # many reads from several threads
+            config.arxmliv_dir = Path(tmpdir) / 'arxmliv'
+            config.arxmliv_dir.mkdir()
+            ids = []
+            for yymm in ['1601', '1602', '1603']:
+                with zipfile.ZipFile(config.arxmliv_dir / f'{yymm}.zip', 'w') as zf:
+                    for i in range(20):
+                        zf.writestr(f'{yymm}/{yymm}.{i:05}.html', f'<html>{yymm}.{i:05}</html>',
+                                    compress_type=zipfile.ZIP_DEFLATED)
+                        ids.append(f'{yymm}.{i:05}')
+            data_manager = DataManager(config)
+            data_manager.arxmliv_docs.update_index()
+            ids = ids[::7] + ids * 3
+            contents = list(data_manager.prefetch(ids, depth=8, threads=4))
+            self.assertEqual([bytes(content) for _, content in contents],
+                             [f'<html>{arxiv_id}</html>'.encode() for arxiv_id in ids])
+
+    def test_mapped_cached_data(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = _get_test_config()
+            config.cache_dir = Path(tmpdir)
+            cached = MappedCachedData(config, 'test')
+            self.assertFalse(cached.ensured())
+            cached.data = {'table': StringTable.from_strings(['b', 'ä', 'a', 'cond-mat9401234', 'b']),
+                           'list': StringList.from_strings(['z', '', 'y']),
+                           'csr': CsrMap.from_lists([[1, 2], [], [3]]),
+                           'array': array.array('d', [0.5, 1.5])}
+            cached.write_to_cache()
+            self.assertEqual([path.name for path in Path(tmpdir).iterdir()], ['test.map'])
+
+            cached = MappedCachedData(config, 'test')
+            self.assertTrue(cached.ensured())
+            table = cached.data['table']
+            self.assertEqual(list(table), ['a', 'b', 'cond-mat9401234', 'ä'])
+            self.assertEqual(table.index_of('cond-mat9401234'), 2)
+            self.assertIsNone(table.index_of('c'))
+            self.assertIn('ä', table)
+            self.assertEqual(list(cached.data['list']), ['z', '', 'y'])
+            self.assertEqual(cached.data['list'][-1], 'y')
+            self.assertEqual([list(row) for row in cached.data['csr']], [[1, 2], [], [3]])
+            self.assertEqual(list(cached.data['array']), [0.5, 1.5])
+
+    def test_cached_data_inputs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = _get_test_config()
+            config.cache_dir = Path(tmpdir) / 'cache'
+            inputs = [Path(tmpdir) / 'a.txt', Path(tmpdir) / 'b.txt']
+            inputs[0].write_text('a')
+
+            def get_cached(version: int = 1) -> CachedData[str]:
+                return CachedData(config, 'test', version=version, inputs=lambda: inputs)
+
+            cached = get_cached()
+            self.assertFalse(cached.ensured())
+            self.assertIsNone(cached.changed_inputs())
+            cached.data = 'data'
+            cached.write_to_cache()
+
+            cached = get_cached()
+            self.assertTrue(cached.ensured())
+            self.assertEqual(cached.changed_inputs(), set())
+
+            inputs[1].write_text('b')
+            self.assertEqual(get_cached().changed_inputs(), {inputs[1]})
+            self.assertFalse(get_cached().ensured())
+            self.assertTrue(get_cached().ensured(check_inputs=False))
+
+            cached = get_cached()
+            cached.data = 'new data'
+            cached.write_to_cache()
+            self.assertTrue(get_cached().ensured())
+            self.assertFalse(get_cached(version=2).ensured())
+            self.assertIsNone(get_cached(version=2).changed_inputs())
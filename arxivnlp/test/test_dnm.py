@@ -1,11 +1,13 @@
 import io
 import os
+import re
 import unittest
 from typing import Any
 
 from lxml import etree
 
-from arxivnlp.data.dnm import Dnm, DnmConfig, DEFAULT_DNM_CONFIG
+from arxivnlp.data.dnm import Dnm, DnmConfig, LazyDnm, CompiledDnmConfig, DEFAULT_DNM_CONFIG, EMPTY_DNM_CONFIG, \
+    DnmPoint, DnmPointResolver, DnmRange, parse_pruned
 
 
 class TestDnm(unittest.TestCase):
@@ -39,3 +41,215 @@ class TestDnm(unittest.TestCase):
         dnm.insert_added_nodes()
         new_html = etree.tostring(tree.getroot())
         self.assertEqual(new_html, b'<a>abc <d>Inserted</d><math>this is math string</math> nope<c/></a>')
+
+    def test_parse_pruned(self):
+        html = '<html><head><title>Title</title></head><body><p>A <math alttext="x"><semantics><mi>x</mi>' \
+               '<annotation encoding="application/x-tex">x</annotation></semantics></math> and <!-- c -->' \
+               '<span class="ltx_cite">[<a>1</a>]</span>.</p><div class="ltx_bibliography"><p>Ref</p></div>' \
+               'tail <b>bold</b></body></html>'
+        tree = etree.parse(io.BytesIO(html.encode('utf-8')), etree.HTMLParser(encoding='utf-8'))
+        pruned = parse_pruned(io.BytesIO(html.encode('utf-8')), DEFAULT_DNM_CONFIG)
+        self.assertEqual(pruned.xpath('//annotation'), [])
+        self.assertEqual(pruned.xpath('//math/@alttext'), ['x'])
+        dnm = Dnm(tree, DEFAULT_DNM_CONFIG)
+        pruned_dnm = Dnm(pruned, DEFAULT_DNM_CONFIG)
+        self.assertEqual(pruned_dnm.string, dnm.string)
+        for pos in range(len(dnm.string)):
+            self.assertEqual(pruned_dnm.get_dnm_point(pos).to_string(), dnm.get_dnm_point(pos).to_string())
+
+    def test_backrefs(self):
+        html = '<a>ab<b>c</b><e/>d<f>ef</f></a>'
+        tree = etree.parse(io.StringIO(html))
+        dnm = Dnm(tree, dnm_config=DnmConfig(nodes_to_skip=set(), classes_to_skip=set(),
+                                             nodes_to_replace={'e': '', 'f': 'F'}, classes_to_replace={}))
+        self.assertEqual(dnm.string, 'abcdF')
+        self.assertEqual(list(dnm.token_starts), [0, 2, 3, 3, 4, 5])
+        self.assertEqual([dnm.get_token(pos).get_surrounding_node().tag for pos in range(5)], ['a', 'a', 'b', 'a', 'f'])
+        self.assertEqual(list(dnm.backrefs_pos), [0, 1, 0, 0, 0])
+        self.assertEqual(dnm.get_dnm_point(3).to_string(), '/a/e+tail0')
+        self.assertIs(dnm.backrefs_token[-1], dnm.tokens[-1])
+        self.assertRaises(IndexError, lambda: dnm.get_token(5))
+
+    def test_dnmstr_views(self):
+        tree = etree.parse(io.StringIO('<a>  Some   <b>text</b>  here. </a>'))
+        dnm = Dnm(tree, dnm_config=EMPTY_DNM_CONFIG)
+        full = dnm.get_full_dnmstr()
+        self.assertIsInstance(full.backrefs, range)
+        stripped = full[1:].strip()
+        self.assertEqual(stripped.string, 'Some   text  here.')
+        self.assertEqual(stripped.backrefs, range(2, 20))
+        self.assertEqual(stripped[-1].backrefs, range(19, 20))
+        normalized = stripped.normalize_spaces()
+        self.assertEqual(normalized.string, 'Some text here.')
+        self.assertEqual(list(normalized[3:6].backrefs), [5, 6, 9])
+        self.assertEqual(normalized[5].get_node(0).tag, 'b')
+        self.assertEqual(normalized[-1].get_dnm_point(0).to_string(), '/a/b+tail6')
+
+    def test_dnmstr_transforms(self):
+        tree = etree.parse(io.StringIO('<a>  Straße  <b>İst\n\t</b>\n  ΟΔΟΣ. \r</a>'))
+        dnm = Dnm(tree, dnm_config=EMPTY_DNM_CONFIG)
+        full = dnm.get_full_dnmstr()
+        for dnmstr in [full, full[1:-1], full.replace('ΟΔΟΣ', 'x')]:
+            # compare with a straightforward implementation
+            stripped = dnmstr.strip()
+            start = next((i for i, c in enumerate(dnmstr.string) if not c.isspace()), 0)
+            self.assertEqual(stripped.string, dnmstr.string.strip())
+            self.assertEqual(list(stripped.backrefs), list(dnmstr.backrefs[start:start + len(stripped)]))
+            normalized = dnmstr.normalize_spaces()
+            expected = [(' ' if c.isspace() else c, b) for i, (c, b) in enumerate(zip(dnmstr.string, dnmstr.backrefs))
+                        if not (c.isspace() and i > 0 and dnmstr.string[i - 1].isspace())]
+            self.assertEqual(list(zip(normalized.string, normalized.backrefs)), expected)
+
+        lower = full.strip().lower()
+        self.assertEqual(lower.string[:13], 'straße  i̇st\n')
+        self.assertEqual(list(lower.backrefs[7:11]), [9, 10, 10, 11])
+        self.assertEqual(full.strip().casefold().string[:7], 'strasse')
+        self.assertTrue(lower.string.endswith('οδος.'))
+
+        replaced = full.strip().replace('ß', 'ss').replace(re.compile(r'\s+'), '_', count=2)
+        self.assertEqual(replaced.string[:13], 'Strasse_İst_Ο')
+        self.assertEqual(list(replaced.backrefs[4:9]), [6, 6, 7, 8, 10])
+        self.assertIs(full.replace('nothing', 'x'), full)
+
+    def test_compiled_config(self):
+        html = '<a><math class="ltx_cite"/><span class="x ltx_ref ltx_cite">r</span>' \
+               '<p class="ltx_bibliography ltx_ref"/><head class="ltx_ref"/><figure/>' \
+               '<span class="ltx_equation">e</span><p>text</p><!-- c --></a>'
+        tree = etree.parse(io.StringIO(html))
+        compiled = DEFAULT_DNM_CONFIG.compile()
+        for node in tree.iter():
+            action = compiled.get_action(node)
+            self.assertEqual(action is CompiledDnmConfig.SKIP, DEFAULT_DNM_CONFIG.skip_node(node))
+            if action is not CompiledDnmConfig.SKIP:
+                self.assertEqual(action, DEFAULT_DNM_CONFIG.replace_node(node))
+
+    def test_deep_tree(self):
+        root = etree.Element('div')
+        node = root
+        for i in range(5000):
+            node = etree.SubElement(node, 'span')
+            node.tail = str(i % 10)
+        node.text = 'deep'
+        dnm = Dnm(root.getroottree(), dnm_config=DEFAULT_DNM_CONFIG)
+        self.assertEqual(dnm.string, 'deep' + ''.join(str(i % 10) for i in reversed(range(5000))))
+        self.assertEqual(dnm.node_to_token_range[root], (0, 5001))
+        self.assertEqual(dnm.get_dnm_point(4).node.tail, '9')
+
+    def test_incremental_insert(self):
+        html = '<a>First sentence. <b>Second</b> one with <math>x</math> math.<c>End</c></a>'
+        tree = etree.parse(io.StringIO(html))
+        config = DnmConfig(nodes_to_skip={'mark'}, classes_to_skip=set(), nodes_to_replace={'math': 'MathNode'},
+                           classes_to_replace={})
+        dnm = Dnm(tree, config)
+        string = dnm.string
+        self.assertEqual(string, 'First sentence. Second one with MathNode math.End')
+        # sentences, then words, then something around the math node
+        rounds = [[(0, False), (14, True), (16, False), (45, True)],
+                  [(0, False), (4, True), (6, False), (13, True), (16, False), (21, True), (23, False), (25, True)],
+                  [(32, False), (39, True), (46, False), (47, True)]]
+        for positions in rounds:
+            for pos, after in positions:
+                dnm.add_node(etree.XML('<mark>annotation</mark>'), pos, after)
+            dnm.insert_added_nodes()
+            self.assertEqual(dnm.string, string)
+            # the Dnm must be equivalent to a new one for the modified tree
+            new_dnm = Dnm(tree, config)
+            self.assertEqual(new_dnm.string, string)
+            for pos in range(len(string)):
+                self.assertEqual(dnm.get_dnm_point(pos).to_string(), new_dnm.get_dnm_point(pos).to_string())
+                self.assertEqual(dnm.get_token(pos).get_surrounding_node(),
+                                 new_dnm.get_token(pos).get_surrounding_node())
+            for node, (start, end) in new_dnm.node_to_token_range.items():
+                new_start, new_end = dnm.node_to_token_range[node]
+                self.assertEqual((dnm.token_starts[new_start], dnm.token_starts[new_end]),
+                                 (new_dnm.token_starts[start], new_dnm.token_starts[end]))
+            nodes = list(tree.iter())
+            self.assertEqual(dnm.dnm_points_to_pos(nodes), new_dnm.dnm_points_to_pos(nodes))
+        self.assertEqual(etree.tostring(tree.getroot()).replace(b'<mark>annotation</mark>', b'|'),
+                         b'<a>||First| |sentence|.| <b>||Second|</b> |one| with '
+                         b'|<math>x</math>| math.|<c>|En|d</c></a>')
+
+    def test_lazy_dnm(self):
+        html = '<html><head><title>T</title></head><body><h1>Title</h1><div class="ltx_section">Intro ' \
+               '<p class="ltx_para">A <math><mi>x</mi></math> and <span class="ltx_cite">[1]</span>.</p>tail' \
+               '<!-- comment --></div><div class="ltx_section"><p class="ltx_para">Second <b>bold</b></p>' \
+               '<p class="ltx_bibliography">skipped</p> end</div></body></html>'
+        tree = etree.parse(io.StringIO(html), etree.HTMLParser())
+        dnm = Dnm(tree, DEFAULT_DNM_CONFIG)
+        lazy = LazyDnm(tree, DEFAULT_DNM_CONFIG)
+        for pos in range(len(dnm.string)):
+            self.assertEqual(lazy.get_dnm_point(pos).to_string(), dnm.get_dnm_point(pos).to_string())
+        for node in tree.iter():
+            sub_dnm = lazy.get_dnm(node)
+            self.assertEqual(dnm.string[sub_dnm.offset:sub_dnm.offset + len(sub_dnm.string)], sub_dnm.string)
+            for pos in range(len(sub_dnm.string)):
+                self.assertEqual(sub_dnm.get_dnm_point(pos).to_string(),
+                                 dnm.get_dnm_point(sub_dnm.offset + pos).to_string())
+        para = tree.xpath('//p[@class="ltx_para"]')[1]
+        self.assertEqual(lazy.get_dnm(para).string, 'Second bold')
+        self.assertEqual(lazy.get_dnm(tree.xpath('//mi')[0]).string, 'MathNode')
+        self.assertEqual(lazy.get_dnm(tree.xpath('//title')[0]).string, '')
+        self.assertIs(lazy.get_dnm(tree.xpath('//mi')[0]), lazy.get_dnm(tree.xpath('//math')[0]))
+        self.assertEqual(lazy.get_dnm().string, dnm.string)
+        for start in range(len(dnm.string) + 1):
+            lazy = LazyDnm(tree, DEFAULT_DNM_CONFIG)   # nothing cached yet
+            for end in range(start, len(dnm.string) + 2):
+                self.assertEqual(lazy.get_string(start, end), dnm.string[start:end])
+        start, end = lazy.get_range(para)
+        self.assertEqual(lazy.get_string(start, end), lazy.get_dnm(para).string)
+        self.assertEqual(lazy.get_range(tree.xpath('//mi')[0]), lazy.get_range(tree.xpath('//math')[0]))
+
+    def test_node_ranges(self):
+        html = '<html><head><title>T</title></head><body><h1>Title</h1><div class="ltx_section">Intro ' \
+               '<p class="ltx_para">A <math><mi>x</mi></math> and <span class="ltx_cite">[<a>1</a>]</span>.</p>tail' \
+               '<!-- comment --></div><div class="ltx_section"><p class="ltx_para">Second <b>bold</b></p>' \
+               '<p class="ltx_bibliography">skipped</p> end</div></body></html>'
+        tree = etree.parse(io.StringIO(html), etree.HTMLParser())
+        dnm = Dnm(tree, DEFAULT_DNM_CONFIG)
+        lazy = LazyDnm(tree, DEFAULT_DNM_CONFIG)
+        nodes = list(tree.iter())
+        ranges = dnm.dnm_points_to_pos(nodes)
+        for node, (start, end) in zip(nodes, ranges):
+            offset = lazy.get_offset(node)
+            self.assertEqual((start, end), (offset, offset + lazy.get_length(lazy._get_container(node))))
+            self.assertEqual(dnm.dnm_point_to_pos(DnmPoint(node)), (start, end))
+        self.assertEqual(dnm.get_node_range(tree.xpath('//mi')[0]), dnm.get_node_range(tree.xpath('//math')[0]))
+        self.assertEqual(dnm.string[slice(*dnm.get_node_range(tree.xpath('//a')[0]))], 'LtxCite')
+        start, end = dnm.get_node_range(tree.xpath('//p[@class="ltx_bibliography"]')[0])
+        self.assertEqual((dnm.string[start - 4:start], dnm.string[end:]), ('bold', ' end'))
+        points = [dnm.get_dnm_point(pos) for pos in range(len(dnm.string))]
+        for pos, (start, end) in enumerate(dnm.dnm_points_to_pos(points)):
+            if end is None:
+                self.assertEqual(start, pos)
+            else:   # replaced node
+                self.assertTrue(start <= pos < end)
+                self.assertEqual(dnm.string[start:end], dnm.get_token(pos).get_string())
+        self.assertEqual(dnm.dnm_points_to_pos([DnmPoint(tree.xpath('//title')[0], text_offset=0)]),
+                         [dnm.get_node_range(tree.xpath('//head')[0])])
+
+    def test_dnm_point_strings(self):
+        html = '<html><body><div id="S1" class="ltx_section">Intro <p id="S1.p1">A <b>bold</b> and <b>more</b>' \
+               '</p>tail<!-- comment --><p>no <i>id</i></p></div><div>without ids <span>x</span></div>' \
+               '<p id="bad id">y</p></body></html>'
+        tree = etree.parse(io.StringIO(html), etree.HTMLParser())
+        dnm = Dnm(tree, EMPTY_DNM_CONFIG)
+        self.assertEqual(dnm.get_dnm_point(dnm.string.index('more')).to_string(), '#S1.p1/b[2]+text0')
+        self.assertEqual(dnm.get_dnm_point(dnm.string.index('tail')).to_string(), '#S1.p1+tail0')
+        self.assertEqual(dnm.get_dnm_point(dnm.string.index('x')).to_string(), '/html/body/div[2]/span+text0')
+        self.assertEqual(dnm.get_dnm_point(dnm.string.index('y')).to_string(), '/html/body/p+text0')
+        resolver = DnmPointResolver(tree)
+        dnmstr = dnm.get_full_dnmstr()
+        strings = []
+        for pos in range(len(dnm.string)):
+            point = dnm.get_dnm_point(pos)
+            for use_ids in [True, False]:
+                string = point.to_string(use_ids)
+                for resolved in [DnmPoint.from_string(string, tree), resolver.resolve_point(string)]:
+                    self.assertIs(resolved.node, point.node)
+                    self.assertEqual((resolved.text_offset, resolved.tail_offset),
+                                     (point.text_offset, point.tail_offset))
+            strings.append(dnmstr.get_dnm_range(pos // 2, pos, right_closed=pos % 2 == 0).to_string())
+        for string, dnm_range in zip(strings, DnmPointResolver(tree).resolve_ranges(strings)):
+            self.assertEqual(dnm_range.to_string(), string)
+            self.assertEqual(DnmRange.from_string(string, tree).to_string(), string)
+        self.assertIs(DnmPoint.from_string('/html/body/div[1]/comment()', tree).node.tag, etree.Comment)